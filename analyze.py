@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import argparse
+import numpy as np
+
+import cms
+from binlog import RECORDS, CAR, STATION, POWER, stream_kind, seconds, open_log
+
+def load_text(path, start, read_delay):
+    # Parses a text log in one pass into the same structured array binlog.open_log() returns
+    stream = os.path.splitext(os.path.basename(path))[0]
+    dtype = RECORDS[stream_kind(stream)]
+    # hh, mm, ss instead of the tick
+    width = len(dtype.names) + 2
+    with open(path, "r") as f:
+        text = f.read()
+
+    flat = np.fromstring(text.replace(":", ",").replace("\n", ",").rstrip(","), sep=",") if text.strip() else np.zeros(0)
+    if flat.size % width:
+        # rows with another number of values (older logs, a write cut off) are skipped
+        lines = [line for line in text.splitlines() if line.count(",") == len(dtype.names) - 1]
+        flat = np.fromstring(",".join(lines).replace(":", ","), sep=",") if lines else np.zeros(0)
+    values = flat.reshape(-1, width)
+
+    offset = (values[:, 0] * 3600 + values[:, 1] * 60 + values[:, 2] - start) % 86400
+    # logs only have hh:mm:ss, count days when the time wraps around
+    day = np.concatenate(([0], np.cumsum(np.diff(offset) < 0)))
+    records = np.zeros(len(values), dtype)
+    records["tick"] = (day * 86400 + offset) // read_delay
+    for column, name in enumerate(dtype.names[1:]):
+        records[name] = values[:, 3 + column]
+    return records
+
+def load_directory(directory, start, read_delay):
+    # {stream: records} of every text and binary log in a directory, binary if there are both
+    logs = {}
+    for f in sorted(os.listdir(directory)):
+        stream, extension = os.path.splitext(f)
+        if extension == ".bin":
+            logs[stream] = open_log(os.path.join(directory, f))[1]
+        elif extension == ".txt" and stream not in logs and not os.path.exists(os.path.join(directory, stream + ".bin")):
+            logs[stream] = load_text(os.path.join(directory, f), start, read_delay)
+    return logs
+
+def by_tick(ticks, values, length):
+    # values in an array indexed by tick, the last row wins where a continued run logged a tick twice
+    array = np.zeros(length)
+    inside = ticks < length
+    array[ticks[inside].astype(np.int64)] = values[inside]
+    return array
+
+def load_capacities(car_file):
+    # {car name: battery capacity (kWh)} from a car dataset
+    capacities = {}
+    for line in open(car_file, "r"):
+        values = line.split(",")
+        capacities[values[0].strip()] = cms.MAKE_MODEL[values[3].strip().lower()]
+    return capacities
+
+def analyze_cars(logs, voltage, read_delay, capacities):
+    kwh = voltage * read_delay / 3600 / 1000
+    last_tick = max((int(records["tick"][-1]) for records in logs.values() if len(records)), default=0)
+    rows = []
+    for stream, records in logs.items():
+        if stream_kind(stream) != CAR or len(records) == 0:
+            continue
+        values = np.column_stack([records[name] for name in RECORDS[CAR].names[1:]])
+        # rows of a car that is not charging (not arrived yet, or an idle charger) are all zero
+        charging = records[(values != 0).any(axis=1)]
+        if len(charging) == 0:
+            continue
+
+        delivered = float(charging["measured_current"].sum()) * kwh
+        soc_requested = float(charging["soc"][0])
+        soc_unmet = float(charging["soc"][-1])
+        if stream in capacities:
+            capacity = capacities[stream]
+        elif soc_requested > soc_unmet:
+            # SoC only drops by what was delivered (exact unless it reached 0)
+            capacity = 100 * delivered / (soc_requested - soc_unmet)
+        else:
+            capacity = float("nan")
+
+        rows.append({"car": stream,
+                     "arrival_tick": int(charging["tick"][0]),
+                     "departure_tick": int(charging["tick"][-1]),
+                     "left": int(charging["tick"][-1]) < last_tick,
+                     "requested_kwh": soc_requested * capacity / 100,
+                     "delivered_kwh": delivered,
+                     "from_battery_kwh": float(charging["battery_current"].sum()) * kwh,
+                     "soc_requested": soc_requested,
+                     "soc_unmet": soc_unmet,
+                     "mean_current": float(charging["charging_current"].mean())})
+    return rows
+
+def analyze_stations(logs, voltage, read_delay, efficiency, battery_capacity):
+    kwh = voltage * read_delay / 3600 / 1000
+    rows = []
+    for stream, records in logs.items():
+        if stream_kind(stream) != STATION or len(records) == 0:
+            continue
+        net = records["charging_current"] - records["battery_current"]
+        direction = np.sign(net[net != 0])
+        discharged = float(records["battery_current"].sum()) * kwh / efficiency
+        rows.append({"station": stream,
+                     "discharged_kwh": discharged,
+                     "recharged_kwh": float(records["charging_current"].sum()) * kwh * efficiency,
+                     # a cycle is the battery capacity discharged once
+                     "cycles": discharged / battery_capacity,
+                     "direction_changes": int((direction[1:] != direction[:-1]).sum()),
+                     "min_capacity_kwh": float(records["battery_capacity"].min()),
+                     "end_capacity_kwh": float(records["battery_capacity"][-1])})
+    return rows
+
+def analyze_fleet(logs, voltage, read_delay, cars, building_file):
+    left = [car for car in cars if car["left"]]
+    summary = {"cars": len(cars),
+               "cars_left": len(left),
+               "requested_kwh": sum(car["requested_kwh"] for car in cars if not np.isnan(car["requested_kwh"])),
+               "delivered_kwh": sum(car["delivered_kwh"] for car in cars),
+               "mean_soc_unmet": float(np.mean([car["soc_unmet"] for car in left])) if left else 0.0,
+               "cars_fully_charged": sum(1 for car in left if car["soc_unmet"] < 1)}
+
+    power = [records for stream, records in logs.items() if stream_kind(stream) == POWER and len(records)]
+    if power:
+        power = power[0]
+        length = int(power["tick"].max()) + 1
+        used = by_tick(power["tick"], power["building_power_used"], length)
+        available = by_tick(power["tick"], power["available_building_power"], length)
+        # station batteries recharge from the building too
+        recharge = np.zeros(length)
+        for stream, records in logs.items():
+            if stream_kind(stream) == STATION and len(records):
+                recharge += by_tick(records["tick"], records["charging_current"], length) * voltage
+        logged = np.unique(power["tick"].astype(np.int64))
+        draw = (used + recharge)[logged]
+        available = available[logged]
+        headroom = np.clip(available, 0, None)
+
+        summary["headroom_used"] = float(draw.sum() / headroom.sum()) if headroom.sum() > 0 else 0.0
+        summary["peak_over_limit_kw"] = float((draw - available).max()) / 1000
+        summary["ticks_over_limit"] = int((draw > available + 1e-6).sum())
+        if building_file:
+            sim = cms.Simulation()
+            sim.load_building(building_file)
+            inside = logged < len(sim.building_dataset)
+            total = np.asarray(sim.building_dataset, float)[logged[inside]] * 1000 + draw[inside]
+            summary["max_building_kw"] = sim.max_building
+            summary["peak_draw_kw"] = float(total.max()) / 1000
+            summary["peak_draw_of_max"] = float(total.max()) / (sim.max_building * 1000)
+
+    if "zeka" in logs and len(logs["zeka"]):
+        zeka = logs["zeka"]
+        hours = np.diff(zeka["tick"].astype(float)) * read_delay / 3600
+        summary["zeka_mean_current"] = float(zeka["current"].mean())
+        summary["zeka_max_current"] = float(zeka["current"].max())
+        summary["zeka_ah"] = float((zeka["current"][:-1] * hours).sum())
+        summary["zeka_mean_voltage"] = float(zeka["voltage"].mean())
+    return summary
+
+def print_table(rows):
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [[format_cell(row[column]) for column in columns] for row in rows]
+    widths = [max(len(column), *(len(row[n]) for row in cells)) for n, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in cells:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def format_cell(value):
+    if isinstance(value, float):
+        return "%.2f" % value
+    return str(value)
+
+def write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        if rows:
+            writer.writerow(list(rows[0]))
+            for row in rows:
+                writer.writerow(list(row.values()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize a CMS log directory')
+    parser.add_argument("directory", help="Log directory (text or binary logs)")
+    parser.add_argument("--start-time", "--st", dest="start_time", default="18:00:00", help="Start time of the run, for text logs (default: %(default)s)")
+    parser.add_argument("--read-delay", dest="read_delay", type=float, default=cms.READ_DELAY, help="Seconds between log rows (default: %(default)s)")
+    parser.add_argument("--voltage", dest="voltage", type=float, default=cms.VOLTAGE, help="Charger voltage (default: %(default)s)")
+    parser.add_argument("--efficiency", dest="efficiency", type=float, default=cms.EFFICIENCY, help="Charging efficiency (default: %(default)s)")
+    parser.add_argument("--battery-capacity", "--bc", dest="battery_capacity", type=float, default=cms.BATTERY_CAPACITY, help="Station battery capacity in kWh (default: %(default)s)")
+    parser.add_argument("--car-dataset", "--cd", dest="car_file", default="", help="Car dataset of the run, for exact battery capacities (estimated from the logs otherwise)")
+    parser.add_argument("--building-dataset", "--bd", dest="building_file", default="", help="Building dataset of the run, for peak draw against the max building load")
+    parser.add_argument("--output", "-o", dest="output", default="", help="Directory to write cars.csv, stations.csv and summary.csv to")
+    args = parser.parse_args()
+
+    logs = load_directory(args.directory, seconds(args.start_time), args.read_delay)
+    capacities = load_capacities(args.car_file) if args.car_file else {}
+    cars = analyze_cars(logs, args.voltage, args.read_delay, capacities)
+    stations = analyze_stations(logs, args.voltage, args.read_delay, args.efficiency, args.battery_capacity)
+    summary = analyze_fleet(logs, args.voltage, args.read_delay, cars, args.building_file)
+
+    print_table(cars)
+    print()
+    print_table(stations)
+    print()
+    print_table([{"metric": name, "value": value} for name, value in summary.items()])
+
+    if args.output:
+        if not os.path.exists(args.output):
+            os.makedirs(args.output)
+        write_csv(os.path.join(args.output, "cars.csv"), cars)
+        write_csv(os.path.join(args.output, "stations.csv"), stations)
+        write_csv(os.path.join(args.output, "summary.csv"), [{"metric": name, "value": value} for name, value in summary.items()])
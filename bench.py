@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import sys
+import json
+import math
+import random
+import resource
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+
+import cms
+from vector_engine import VectorEngine
+
+def write_fleet(directory, cars, ticks, seed, load_step=1):
+    # Synthetic building and car datasets: every car arrives in the first tenth of the run and
+    # stays past the end, the building leaves 0 to 4 kW per car for charging. The building load
+    # changes every load_step ticks.
+    rng = random.Random(seed)
+    building_file = os.path.join(directory, "building.txt")
+    with open(building_file, "w") as f:
+        for tick in range(ticks):
+            f.write(str(round(50 + cars * 2 * (1 + math.sin((tick - tick % load_step) / 150)), 1)) + "\n")
+
+    sim = cms.Simulation()
+    seconds = ticks * cms.READ_DELAY
+    car_file = os.path.join(directory, "cars.txt")
+    with open(car_file, "w") as f:
+        for n in range(cars):
+            arrival = rng.randrange(max(1, seconds // 10))
+            departure = sim.int_to_str(seconds + rng.randrange(3600, 6 * 3600))
+            model = rng.choice(list(cms.MAKE_MODEL))
+            f.write("bench" + str(n) + ", " + str(arrival) + ", " + departure + ", " + model + ", " + str(rng.randrange(10, 90)) + ", " + str(rng.random() < 0.2) + "\n")
+    return building_file, car_file
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {"p50": 0, "p95": 0, "p99": 0, "max": 0}
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": samples[-1] * 1000}
+
+def timed(step, samples):
+    # step, recording how long each call takes in samples
+    def run_step():
+        start = perf_counter()
+        step()
+        samples.append(perf_counter() - start)
+    return run_step
+
+def run(config):
+    # Runs one fleet headless in its own process (so peak memory is its own), returns its results
+    cars, ticks, allocator, engine, seed, mode, load_step = config
+
+    with tempfile.TemporaryDirectory() as directory:
+        building_file, car_file = write_fleet(directory, cars, ticks, seed, load_step)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        sim = cms.Simulation()
+        sim.load_building(building_file)
+        sim.load_cars(car_file)
+    sim.allocator = allocator
+    if engine == "numpy":
+        sim.engine = VectorEngine(sim.voltage, sim.efficiency, cms.READ_DELAY, sim.battery_capacity, sim.battery_charging_current)
+
+    # the loop of --fast-sim or --event-sim, with every full tick and control step timed
+    tick_times = []
+    control_times = []
+    sim.tick = timed(sim.tick, tick_times)
+    sim.control_step = timed(sim.control_step, control_times)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = perf_counter()
+        if mode == "events":
+            sim.run_events(False)
+        else:
+            sim.run_ticks(False)
+        elapsed = perf_counter() - start
+
+    return {"cars": cars,
+            "stations": len(sim.stations),
+            "ticks": ticks,
+            "seconds": elapsed,
+            "ticks_per_second": ticks / elapsed,
+            # ticks run in full, the event sim skips the rest
+            "full_ticks": len(tick_times),
+            "tick_ms": percentiles(tick_times),
+            "control_ms": percentiles(control_times),
+            # ru_maxrss is in kB on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "rss_growth_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024}
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the CMS tick and control loops on synthetic fleets')
+    parser.add_argument("--cars", dest="cars", type=int, nargs="+", default=[10, 100, 1000, 10000], help="Fleet sizes, one station per car (default: %(default)s)")
+    parser.add_argument("--ticks", dest="ticks", type=int, default=600, help="Ticks to run for each fleet (default: %(default)s)")
+    parser.add_argument("--allocator", dest="allocator", choices=["greedy", "waterfill"], default="greedy", help="Current allocator (default: %(default)s)")
+    parser.add_argument("--engine", dest="engine", choices=["loop", "numpy"], default="loop", help="Tick engine (default: %(default)s)")
+    parser.add_argument("--sim", dest="sim", choices=["ticks", "events"], default="ticks", help="Run every tick as --fast-sim or only the ticks where something changes as --event-sim (default: %(default)s)")
+    parser.add_argument("--load-step", dest="load_step", type=int, default=1, help="Ticks the synthetic building load is held for (default: %(default)s)")
+    parser.add_argument("--seed", dest="seed", type=int, default=1, help="Seed for the synthetic fleets (default: %(default)s)")
+    parser.add_argument("--output", "-o", dest="output", default="", help="JSON file to write the results to")
+    parser.add_argument("--compare", dest="compare", default="", help="JSON results of an earlier run to compare ticks/s with")
+    args = parser.parse_args()
+    if args.engine == "numpy" and args.allocator != "greedy":
+        parser.error("--engine numpy only runs the greedy allocator")
+
+    results = {"commit": commit(),
+               "python": platform.python_version(),
+               "machine": platform.machine(),
+               "allocator": args.allocator,
+               "engine": args.engine,
+               "sim": args.sim,
+               "load_step": args.load_step,
+               "seed": args.seed,
+               "fleets": []}
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {fleet["cars"]: fleet for fleet in json.load(f)["fleets"]}
+
+    print("cars   ticks/s   full ticks  tick p50/p95/p99/max (ms)       control p50/p99 (ms)   peak MB")
+    for cars in args.cars:
+        # a new process per fleet, one at a time so they do not compete for the CPU
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            fleet = executor.submit(run, (cars, args.ticks, args.allocator, args.engine, args.seed, args.sim, max(1, args.load_step))).result()
+        results["fleets"].append(fleet)
+
+        tick = fleet["tick_ms"]
+        line = "%-6d %-9.1f %-11d %-31s %-22s %.1f" % (cars, fleet["ticks_per_second"], fleet["full_ticks"],
+            "%.2f/%.2f/%.2f/%.2f" % (tick["p50"], tick["p95"], tick["p99"], tick["max"]),
+            "%.2f/%.2f" % (fleet["control_ms"]["p50"], fleet["control_ms"]["p99"]), fleet["peak_rss_mb"])
+        if cars in previous:
+            line += "   %+.1f%% ticks/s" % (100 * (fleet["ticks_per_second"] / previous[cars]["ticks_per_second"] - 1))
+        print(line)
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import argparse
+import numpy as np
+
+from log_writer import LogWriter
+
+# Binary logs are one .bin file per stream: a 32 byte header, then fixed width records.
+# Times are stored as the tick index, the header has the start time and seconds per tick.
+MAGIC = b"CMSLOG"
+VERSION = 1
+HEADER = struct.Struct("<6sHHIf")
+HEADER_SIZE = 32
+
+CAR = 0
+STATION = 1
+POWER = 2
+ZEKA = 3
+
+RECORDS = {
+    CAR: np.dtype([("tick", "<u4"), ("measured_current", "<f8"), ("charging_current", "<f8"), ("battery_current", "<f8"), ("soc", "<f8"), ("battery_no", "<i4"), ("priority", "<f8")]),
+    STATION: np.dtype([("tick", "<u4"), ("battery_current", "<f8"), ("charging_current", "<f8"), ("battery_capacity", "<f8")]),
+    POWER: np.dtype([("tick", "<u4"), ("building_power_used", "<f8"), ("available_building_power", "<f8"), ("total_power_used", "<f8")]),
+    ZEKA: np.dtype([("tick", "<u4"), ("current", "<f8"), ("voltage", "<f8")]),
+}
+
+def stream_kind(stream):
+    if stream.startswith("station"):
+        return STATION
+    if stream.endswith("power_use"):
+        return POWER
+    if stream == "zeka":
+        return ZEKA
+    return CAR
+
+def seconds(string):
+    # hh:mm:ss to seconds after midnight
+    hours, minutes, secs = string.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(secs)
+
+def header(kind, start, read_delay):
+    return HEADER.pack(MAGIC, VERSION, kind, start, read_delay).ljust(HEADER_SIZE, b"\0")
+
+def read_header(path):
+    with open(path, "rb") as file:
+        magic, version, kind, start, read_delay = HEADER.unpack(file.read(HEADER_SIZE)[:HEADER.size])
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(path + " is not a CMS binary log")
+    return {"kind": kind, "start": start, "read_delay": read_delay}
+
+def open_log(path):
+    """Memory maps a binary log, returns (header, records).
+
+    records is a read-only structured array backed by the file, so columns such as
+    records["soc"] are views and nothing is parsed or copied until it is used.
+    """
+    info = read_header(path)
+    dtype = RECORDS[info["kind"]]
+    rows = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if rows == 0:
+        return info, np.zeros(0, dtype)
+    return info, np.memmap(path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(rows,))
+
+def open_directory(directory):
+    # {stream: (header, records)} for every binary log in a directory
+    logs = {}
+    for f in sorted(os.listdir(directory)):
+        if f.endswith(".bin"):
+            logs[f[:-4]] = open_log(os.path.join(directory, f))
+    return logs
+
+def times(info, records):
+    # seconds after the start of the building dataset
+    return records["tick"] * info["read_delay"]
+
+class BinaryLogWriter(LogWriter):
+    """LogWriter that appends fixed width binary records instead of text lines."""
+
+    extension = ".bin"
+    mode = "ab"
+
+    def __init__(self, directory, start, read_delay, **kwargs):
+        self.start = start
+        self.read_delay = read_delay
+        super().__init__(directory, **kwargs)
+
+    def encode(self, stream, rows):
+        return np.array([(tick,) + tuple(values) for tick, values in rows], dtype=RECORDS[stream_kind(stream)]).tobytes()
+
+    def open_stream(self, stream):
+        file = super().open_stream(stream)
+        if file.tell() == 0:
+            file.write(header(stream_kind(stream), self.start, self.read_delay))
+        return file
+
+def convert(source, destination, start, read_delay, chunk=100000):
+    # Converts a text log to a binary log, returns the number of records
+    stream = os.path.splitext(os.path.basename(source))[0]
+    kind = stream_kind(stream)
+    dtype = RECORDS[kind]
+    start_seconds = seconds(start)
+
+    count = 0
+    with open(source, "r") as text, open(destination, "wb") as binary:
+        binary.write(header(kind, start_seconds, read_delay))
+        rows = []
+        day = 0
+        previous = 0
+        for line in text:
+            values = line.split(",")
+            if len(values) != len(dtype.names):
+                continue
+            offset = (seconds(values[0]) - start_seconds) % 86400
+            # logs only have hh:mm:ss, count days when the time wraps around
+            if offset < previous:
+                day += 1
+            previous = offset
+            tick = int((day * 86400 + offset) / read_delay)
+            rows.append((tick,) + tuple(float(value) for value in values[1:]))
+            if len(rows) == chunk:
+                binary.write(np.array(rows, dtype=dtype).tobytes())
+                count += len(rows)
+                rows = []
+        if rows:
+            binary.write(np.array(rows, dtype=dtype).tobytes())
+            count += len(rows)
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert CMS text logs to binary logs')
+    parser.add_argument("source", help="Directory of text logs")
+    parser.add_argument("destination", help="Directory to write binary logs to")
+    parser.add_argument("--start-time", "--st", dest="start_time", default="18:00:00", help="Start time of the building dataset used for the run (default: %(default)s)")
+    parser.add_argument("--read-delay", dest="read_delay", type=float, default=2, help="Seconds between log rows (default: %(default)s)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.destination):
+        os.makedirs(args.destination)
+
+    for f in sorted(os.listdir(args.source)):
+        if not f.endswith(".txt"):
+            continue
+        count = convert(os.path.join(args.source, f), os.path.join(args.destination, f[:-4] + ".bin"), args.start_time, args.read_delay)
+        print("Log: " + f + ": " + str(count) + " records")
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import argparse
+import numpy as np
+
+from binlog import seconds
+
+# Binary building datasets: a 32 byte header, then one little endian float64 per sample (kW).
+# The header has the start time, seconds between samples, the highest load and the sample count.
+MAGIC = b"CMSBLD"
+VERSION = 1
+HEADER = struct.Struct("<6sHIfdQ")
+HEADER_SIZE = 32
+SAMPLE = np.dtype("<f8")
+
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def time_string(secs):
+    return str(secs // 3600).zfill(2) + ":" + str(secs % 3600 // 60).zfill(2) + ":" + str(secs % 60).zfill(2)
+
+def read_header(path):
+    with open(path, "rb") as f:
+        magic, version, start, period, max_load, count = HEADER.unpack(f.read(HEADER_SIZE)[:HEADER.size])
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(path + " is not a CMS building dataset")
+    return {"start": time_string(start), "period": period, "max": max_load, "count": count}
+
+def open_dataset(path):
+    """Memory maps a binary building dataset, returns (header, samples).
+
+    samples is a read-only float64 array backed by the file, opening it does not read
+    the samples so startup and resident memory do not grow with the dataset.
+    """
+    info = read_header(path)
+    if info["count"] == 0:
+        return info, np.zeros(0, SAMPLE)
+    return info, np.memmap(path, dtype=SAMPLE, mode="r", offset=HEADER_SIZE, shape=(info["count"],))
+
+def convert(source, destination, start, period, chunk=100000):
+    # Converts a text building dataset (one kW value per line), returns the header
+    count = 0
+    max_load = float("-inf")
+    with open(source, "r") as text, open(destination, "wb") as binary:
+        binary.write(bytes(HEADER_SIZE))
+        samples = []
+        for line in text:
+            if line.strip() == "":
+                continue
+            samples.append(float(line.strip()))
+            if len(samples) == chunk:
+                max_load = max(max_load, max(samples))
+                binary.write(np.array(samples, dtype=SAMPLE).tobytes())
+                count += len(samples)
+                samples = []
+        if samples:
+            max_load = max(max_load, max(samples))
+            binary.write(np.array(samples, dtype=SAMPLE).tobytes())
+            count += len(samples)
+
+        binary.seek(0)
+        binary.write(HEADER.pack(MAGIC, VERSION, seconds(start), period, max_load if count else 0, count).ljust(HEADER_SIZE, b"\0"))
+    return read_header(destination)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a text building dataset to the binary format')
+    parser.add_argument("source", help="Text building dataset, one kW value per line")
+    parser.add_argument("destination", help="Binary building dataset to write")
+    parser.add_argument("--start-time", "--st", dest="start_time", default="18:00:00", help="Time of the first sample (default: %(default)s)")
+    parser.add_argument("--period", dest="period", type=float, default=2, help="Seconds between samples (default: %(default)s)")
+    args = parser.parse_args()
+
+    info = convert(args.source, args.destination, args.start_time, args.period)
+    print("Log: " + str(info["count"]) + " samples, max building power: " + str(info["max"]) + ", " + str(os.path.getsize(args.destination)) + " bytes")
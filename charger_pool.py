@@ -0,0 +1,62 @@
+from concurrent.futures import wait
+from time import time
+
+class ChargerPool:
+    """RAPI clients of the hardware chargers by station number.
+
+    read_currents() sends $GG to every charger at once and waits at most deadline seconds
+    for the replies, so a tick takes as long as the slowest charger that answers in time
+    rather than the sum of all of them. Chargers that miss the deadline are left out and the
+    CMS uses the simulated current for them. Round trip times are kept per charger.
+    """
+
+    def __init__(self, clients, deadline=0.5):
+        self.clients = clients
+        self.deadline = deadline
+        # station number: [replies, total seconds, max seconds, late]
+        self.latency = {station_no: [0, 0.0, 0.0, 0] for station_no in clients}
+
+    def timed(self, station_no, future):
+        sent = time()
+
+        def done(future):
+            elapsed = time() - sent
+            latency = self.latency[station_no]
+            latency[0] += 1
+            latency[1] += elapsed
+            latency[2] = max(latency[2], elapsed)
+
+        future.add_done_callback(done)
+        return future
+
+    def read_currents(self, station_nos):
+        # {station number: measured current (A)} of the chargers that answered in time
+        futures = {}
+        for station_no in station_nos:
+            futures[station_no] = self.timed(station_no, self.clients[station_no].send("GG"))
+        wait(futures.values(), timeout=self.deadline)
+
+        currents = {}
+        for station_no, future in futures.items():
+            if not future.done():
+                self.latency[station_no][3] += 1
+                continue
+            try:
+                currents[station_no] = float(future.result()[0]) / 1000
+            except Exception:
+                pass
+        return currents
+
+    def set_current(self, station_no, current):
+        # not waited for, the charger's next $GG is queued behind it
+        self.timed(station_no, self.clients[station_no].send("SC " + str(int(current)) + " V"))
+
+    def report(self):
+        for station_no in sorted(self.latency):
+            replies, total, longest, late = self.latency[station_no]
+            average = total / replies if replies else 0
+            print("Log: Charger " + str(station_no) + " latency(ms) avg: " + "%.1f" % (average * 1000) + " max: " + "%.1f" % (longest * 1000) + ", " + str(late) + " late reads")
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
@@ -6,13 +6,29 @@ import pickle
 import argparse
 import can
 import os
-import subprocess
+import shutil
+import numpy as np
 from threading import Thread, Lock, Condition
-from time import time, sleep
+from collections import namedtuple
+from heapq import heappush, heappop, heapify
+from time import time, sleep, perf_counter
 from serial import Serial
 from random import randint
 
 import zeka
+import building_data
+from vector_engine import VectorEngine
+from log_writer import LogWriter
+from station_index import StationIndex
+from waterfill import WaterFill
+from lookahead import Headroom
+from status_protocol import StatusEncoder
+from status_server import StatusServer
+from rapi import RapiClient
+from charger_pool import ChargerPool
+from metrics import TickMetrics
+from binlog import BinaryLogWriter, seconds
+from log_segments import SegmentedLogWriter
 
 ip_address = "127.0.0.1"
 
@@ -20,17 +36,22 @@ DEBUG = True
 
 VOLTAGE = 208
 ZEKA_VOLTAGE = 500
+ZEKA_PERIOD = 0.1 # seconds between Zeka status requests and setpoint updates
+ZEKA_TIMEOUT = 1.0 # seconds to wait for a Zeka reply
 EFFICIENCY = 0.9
 
 BATTERY_CAPACITY = 10
-# Lithium ion batteries should charge at 0.8C
-BATTERY_CHARGING_CURRENT = (BATTERY_CAPACITY * 1000 / VOLTAGE) * 0.8
 
 CONTROL_DELAY = 6 # 6 seconds
 READ_DELAY = 2 # 2 seconds
+QUIET_BACKOFF = 64 # most ticks the event sim goes without looking for ticks to skip
+CHANGE_WINDOW = 65536 # most building loads next_change() reads at once
+PLAN_WINDOW = 3600 # seconds of building load in each lookahead min/max window
+
+# log row of a car that is not charging
+EMPTY_CAR_LOG = (0, 0, 0, 0, 0, 0)
 
 FAST_CONTROL_DELAY =  0.006
-FAST_READ_DELAY = 0.002
 
 MAKE_MODEL = {"nissan leaf": 24,
               "tesla model y": 75,
@@ -40,25 +61,6 @@ MAKE_MODEL = {"nissan leaf": 24,
               "tesla model s": 90,
               "tesla model x": 100}
 
-openevse = None
-zeka_bus = None
-i = 0
-num_stations = 0
-station_number = 1
-start = ""
-low_current_num = 0
-
-building_dataset = []
-car_dataset = []
-
-max_building = 0
-
-cars = []
-cars_mutex = Lock()
-stations = []
-
-wait = Condition()
-
 class Car:
     name = ""
     simulation = True
@@ -77,6 +79,22 @@ class Car:
     battery_no = -1
     prev_current = 0
     measured_current = 0
+    low_current_num = 0 # readings in a row well below the advertised current
+
+def charger_name(station_no):
+    # name (and log stream) of the car on a hardware charger
+    if station_no == 0:
+        return "openevse"
+    return "openevse" + str(station_no)
+
+# one line of the car dataset, parsed when it is loaded (arrival and departure in seconds)
+CarRecord = namedtuple("CarRecord", ["name", "arrival", "departure", "model", "desired_soc", "sleep_mode"])
+
+# Read only copy of a tick for the logger and the status publisher, see publish_state().
+# waiting has the names of the cars that have not arrived yet.
+TickState = namedtuple("TickState", ["tick", "building_load", "cars", "stations", "waiting"])
+CarState = namedtuple("CarState", ["name", "station_no", "measured_current", "charging_current", "battery_current", "delta_kWh", "delta_soc", "battery_no", "priority", "departure"])
+StationState = namedtuple("StationState", ["station_no", "battery_current", "charging_current", "battery_capacity"])
 
 class Station:
     station_no = -1
@@ -90,82 +108,285 @@ class Station:
         self.battery_current = battery_current
         self.charging_current = charging_current
 
-def str_to_int(string):
-    start_time = start.split(":")
-    current_time = string.split(":")
-    start_time = int(start_time[0]) * 3600 + int(start_time[1]) * 60 + int(start_time[2])
-    current_time = int(current_time[0]) * 3600 + int(current_time[1]) * 60 + int(current_time[2])
-    return (current_time - start_time) % 86400
-
-def int_to_str(integer):
-    start_time = start.split(":")
-    start_time = int(start_time[0]) * 3600 + int(start_time[1]) * 60 + int(start_time[2])
-    current_time = (integer + start_time) % 86400
-    hours = current_time // 3600
-    minutes = (current_time - (hours * 3600)) // 60
-    seconds = current_time - hours * 3600 - minutes * 60
-    return str(hours).zfill(2) + ":" + str(minutes).zfill(2) + ":" + str(seconds).zfill(2) 
-
-def read(fast_sim, log):
-    # delay in seconds
-    global i
-    global stations
-    global low_current_num
-
-    while i < len(building_dataset):
-        start_loop = time()
-        if i % CONTROL_DELAY // READ_DELAY == 0:
-            wait.acquire()
-            wait.notify()
-            wait.release()
-
-        cars_mutex.acquire()
+class Simulation:
+    """State of one CMS run: building and car datasets, cars, stations and the tick index.
 
-        # read building power
-        # building dataset in kW
-        available_current = (max_building - building_dataset[i]) * 1000 / VOLTAGE 
+    The constants that are swept when sizing batteries (voltage, efficiency, battery
+    capacity and control delay) are per simulation, so several can run in one process.
+    """
 
-        # read current (read from openevse or dataset for simulation)
-        for car in cars:
-            if car.simulation:
-                measured_current = car.charging_current * EFFICIENCY
-            else:
-                cmd = b"$GG\r"
-                if openevse.is_open:
-                    openevse.write(cmd)
-                while openevse.in_waiting == 0:
-                    pass
-                if openevse.in_waiting > 0:
-                    msg = openevse.read(openevse.in_waiting)
-                try:
-                    measured_current = float(msg.decode().split(" ")[1]) / 1000
-                except Exception as e:
-                    measured_current = car.charging_current * EFFICIENCY
+    def __init__(self, voltage=VOLTAGE, efficiency=EFFICIENCY, battery_capacity=BATTERY_CAPACITY, control_delay=CONTROL_DELAY, start="18:00:00"):
+        self.voltage = voltage
+        self.efficiency = efficiency
+        self.battery_capacity = battery_capacity
+        # Lithium ion batteries should charge at 0.8C
+        self.battery_charging_current = (battery_capacity * 1000 / voltage) * 0.8
+        self.control_delay = control_delay
+        self.start = start
+
+        # ChargerPool of the hardware chargers, and the currents they read this tick
+        self.chargers = None
+        self.readings = {}
+        self.zeka_bus = None
+        self.engine = None
+        # Headroom of the building dataset with --plan lookahead, see plan_batteries()
+        self.headroom = None
+        # TickMetrics when --metrics-port or --trace is given
+        self.metrics = None
+        # when read() last woke state_control(), for its latency
+        self.control_requested = 0.0
+        # "greedy" (allocate_current) or "waterfill" (allocate_waterfill)
+        self.allocator = "greedy"
+        self.waterfill = WaterFill()
+        self.log_writer = None
+        # snapshot file for --continue, written every snapshot_interval ticks when set
+        self.snapshot_path = None
+        self.snapshot_interval = 30
+        self.last_snapshot = 0
+        self.i = 0
+        self.num_stations = 0
+        self.station_number = 1
+
+        self.building_dataset = []
+        # cars that have not arrived yet by dataset line, and (arrival, line) heap of them
+        self.car_dataset = {}
+        self.arrivals = []
+        # names in car_dataset for the next TickState, None when it changed
+        self.waiting_names = None
+
+        self.max_building = 0
+
+        self.cars = []
+        self.cars_mutex = Lock()
+        # (departure, count, car) heap of the cars charging, see schedule_departure()
+        self.departures = []
+        self.departures_pushed = 0
+        self.stations = []
+        self.station_index = None
+        # TickState of the last tick, replaced (never changed) by the tick loop. Only made
+        # every tick when logging, otherwise when a reader sets state_wanted.
+        self.state = None
+        self.state_wanted = True
+
+        self.wait = Condition()
+
+        # (name, time, SoC remaining(%)) of each car that left
+        self.departed = []
+        # highest draw on the building supply so far, building load plus chargers and battery recharging (W)
+        self.peak_building = 0
+
+    def load_building(self, filename):
+        if building_data.is_binary(filename):
+            # memory mapped, the header has the start time and max so nothing is read here
+            info, self.building_dataset = building_data.open_dataset(filename)
+            if info["period"] != READ_DELAY:
+                raise ValueError("building dataset period is " + str(info["period"]) + "s, the CMS reads every " + str(READ_DELAY) + "s")
+            self.start = info["start"]
+            self.max_building = info["max"]
+            return
+
+        for line in open(filename, "r"):
+            self.building_dataset.append(float(line.strip()))
+        self.max_building = max(self.building_dataset)
+
+    def building_load(self):
+        # building load at the current tick (kW)
+        return float(self.building_dataset[self.i])
+
+    def load_cars(self, filename):
+        # departure times are relative to the start time, so load the building dataset first
+        for line in open(filename, "r"):
+            name, arrival, departure, model, desired_soc, sleep_mode = line.split(",")
+            record = CarRecord(name, int(arrival), self.str_to_int(departure), model.strip().lower(), int(desired_soc), sleep_mode.strip() == 'True')
+            self.car_dataset[len(self.car_dataset)] = record
+            self.arrivals.append((record.arrival, len(self.car_dataset) - 1))
+        heapify(self.arrivals)
+        self.waiting_names = None
+
+        self.num_stations = len(self.car_dataset) + 1
+        for num in range(self.num_stations):
+            self.stations.append(Station(station_no=num, battery_capacity=self.battery_capacity))
+        self.station_index = StationIndex(self.stations)
+
+    def sync_objects(self, changing=False):
+        # With the NumPy engine its arrays are the car and station state between ticks. Brings
+        # the Car and Station objects up to date before code that reads them; with changing,
+        # the engine loads them again before its next tick, after the caller has changed them.
+        # Call with cars_mutex held (or from the tick loop's thread).
+        if not self.engine:
+            return
+        if self.engine.dirty:
+            self.engine.store(self.cars, self.stations)
+        if changing:
+            self.engine.stale = True
+
+    def station_battery_current(self, station_no):
+        # battery current of a station as of the last tick, for other threads (e.g. the Zeka)
+        if self.engine and not self.engine.stale:
+            return float(self.engine.station_battery_current[station_no])
+        return self.stations[station_no].battery_current
+
+    def save_snapshot(self):
+        # Writes the full run state to a temporary file and renames it over the last
+        # snapshot, so a crash leaves either the old or the new snapshot, never half of one.
+        # Buffered log rows go to disk first and the snapshot keeps where each log ends, so
+        # load_snapshot() can cut off rows logged after it.
+        self.sync_objects()
+        logs = None
+        if self.log_writer:
+            logs = self.log_writer.positions()
+        state = {"i": self.i + 1,
+                 "logs": logs,
+                 "station_number": self.station_number,
+                 "cars": [vars(car).copy() for car in self.cars],
+                 "stations": [vars(station).copy() for station in self.stations],
+                 "car_dataset": [(line, tuple(record)) for line, record in self.car_dataset.items()],
+                 "departed": list(self.departed),
+                 "peak_building": self.peak_building}
+
+        temp = self.snapshot_path + ".tmp"
+        with open(temp, "wb") as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.snapshot_path)
+        self.last_snapshot = self.i
+
+    def snapshot(self):
+        if self.snapshot_path and self.i - self.last_snapshot >= self.snapshot_interval:
+            self.save_snapshot()
+
+    def load_snapshot(self, path):
+        # Continue from the snapshot at path, returns True if the OpenEVSE car was charging
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+
+        self.i = state["i"]
+        self.last_snapshot = self.i
+        if self.engine:
+            self.engine.stale = True
+        if self.log_writer and state.get("logs") is not None:
+            # ticks from the snapshot on are logged again
+            self.log_writer.truncate(state["logs"])
+        self.station_number = state["station_number"]
+        self.departed = state["departed"]
+        self.peak_building = state["peak_building"]
+
+        openevse_arrived = False
+        self.cars_mutex.acquire()
+        self.cars = []
+        self.departures = []
+        for attributes in state["cars"]:
+            car = Car()
+            car.__dict__.update(attributes)
+            if car.name == charger_name(car.station_no):
+                # back to simulated current until wait_for_car() finds the car again
+                openevse_arrived = True
+                car.simulation = True
+            self.cars.append(car)
+            self.schedule_departure(car)
+        self.stations = []
+        for attributes in state["stations"]:
+            station = Station(attributes["station_no"])
+            station.__dict__.update(attributes)
+            self.stations.append(station)
+        self.station_index = StationIndex(self.stations)
+        self.cars_mutex.release()
+
+        self.car_dataset = {line: CarRecord(*record) for line, record in state["car_dataset"]}
+        self.arrivals = [(record.arrival, line) for line, record in self.car_dataset.items()]
+        heapify(self.arrivals)
+        self.waiting_names = None
+        return openevse_arrived
+
+    def str_to_int(self, string):
+        start_time = self.start.split(":")
+        current_time = string.split(":")
+        start_time = int(start_time[0]) * 3600 + int(start_time[1]) * 60 + int(start_time[2])
+        current_time = int(current_time[0]) * 3600 + int(current_time[1]) * 60 + int(current_time[2])
+        return (current_time - start_time) % 86400
+
+    def int_to_str(self, integer):
+        start_time = self.start.split(":")
+        start_time = int(start_time[0]) * 3600 + int(start_time[1]) * 60 + int(start_time[2])
+        current_time = (integer + start_time) % 86400
+        hours = current_time // 3600
+        minutes = (current_time - (hours * 3600)) // 60
+        seconds = current_time - hours * 3600 - minutes * 60
+        return str(hours).zfill(2) + ":" + str(minutes).zfill(2) + ":" + str(seconds).zfill(2) 
+
+    def measure_current(self, car):
+        # read current (read from the charger or dataset for simulation)
+
+        if car.simulation:
+            return car.charging_current * self.efficiency
+
+        # read_chargers() asked every charger at the start of the tick, late ones are simulated
+        if car.station_no in self.readings:
+            measured_current = self.readings[car.station_no]
+        else:
+            measured_current = car.charging_current * self.efficiency
+
+        # check saturation
+        if measured_current > 0 and measured_current <= car.charging_current * (self.efficiency - 0.1):
+            car.low_current_num = car.low_current_num + 1
+        else:
+            car.low_current_num = 0
+
+        if car.low_current_num >= 10:
+            car.max_current = measured_current
+            car.low_current_num = 0
+
+        return measured_current
+
+    def set_charger_current(self, car):
+        if self.metrics:
+            start = perf_counter()
+        self.chargers.set_current(car.station_no, car.charging_current)
+        if self.metrics:
+            self.metrics.inner("setpoints", perf_counter() - start)
+
+    def read_chargers(self):
+        # reads every hardware charger with a car at once
+        if self.chargers:
+            self.readings = self.chargers.read_currents([car.station_no for car in self.cars if not car.simulation])
+
+    def measure_cars(self):
+        for car in self.cars:
+            measured_current = self.measure_current(car)
             car.measured_current = measured_current
-            car.delta_kWh -= measured_current * VOLTAGE * (READ_DELAY / 3600) * 0.001
+            car.delta_kWh -= measured_current * self.voltage * (READ_DELAY / 3600) * 0.001
             if car.delta_kWh < 0:
                 car.delta_kWh = 0
 
-            # check saturation
-            if not car.simulation:
-                if measured_current > 0 and measured_current <= car.charging_current * (EFFICIENCY - 0.1):
-                    low_current_num = low_current_num + 1
-                else:
-                    low_current_num = 0
-
-                if low_current_num >= 10:
-                    car.max_current = measured_current
-                    low_current_num = 0
-
-        for station in stations:
-            station.battery_capacity -= station.battery_current * VOLTAGE * (READ_DELAY / 3600) * 0.001 * (1.0/EFFICIENCY)
-            station.battery_capacity += station.charging_current * VOLTAGE * (READ_DELAY / 3600) * 0.001 * EFFICIENCY
+    def discharge_batteries(self):
+        for station in self.stations:
+            station.battery_capacity -= station.battery_current * self.voltage * (READ_DELAY / 3600) * 0.001 * (1.0/self.efficiency)
+            station.battery_capacity += station.charging_current * self.voltage * (READ_DELAY / 3600) * 0.001 * self.efficiency
             station.battery_current = 0
-
+            self.station_index.update(station)
+        self.station_index.release()
+
+    def battery_for(self, car, current):
+        # Station battery that can run car at current (A) for a tick, None if there is none.
+        # Hardware cars use station 0 (Zeka), simulated cars their own station's battery first.
+        energy = current * self.voltage * (READ_DELAY / 3600) * 0.001
+        if not car.simulation:
+            if self.stations[0].battery_capacity > energy:
+                return self.stations[0]
+            return None
+        station = self.stations[car.station_no]
+        if station.battery_current == 0 and station.battery_capacity > energy:
+            return station
+        station = self.station_index.take_largest(energy)
+        if not station:
+            print("Warn: no batteries available")
+        return station
+
+    def allocate_current(self, available_current):
         # assign current (cars are already sorted from highest priority to lowest priority)
-        remove_cars = 0
         used_current = 0
-        for car in cars:
+        for car in self.cars:
             car.prev_current = car.charging_current
             car.charging_current = int(available_current * car.priority)
 
@@ -177,28 +398,13 @@ def read(fast_sim, log):
             elif car.battery_on:
                 not_max = False
                 if car.charging_current < car.max_current:
-                    if not car.simulation:
-                        if stations[0].battery_capacity > car.max_current * VOLTAGE * (READ_DELAY / 3600) * 0.001:
-                            car.battery_no = 0
-                            stations[0].battery_current = car.max_current - car.charging_current
-                            car.battery_current = car.max_current - car.charging_current
-                        else:
-                            not_max = True
-                    elif stations[car.station_no].battery_current == 0 and stations[car.station_no].battery_capacity > car.max_current * VOLTAGE * (READ_DELAY / 3600) * 0.001:
-                        stations[car.station_no].battery_current = car.max_current - car.charging_current
+                    station = self.battery_for(car, car.max_current)
+                    if station:
+                        station.battery_current = car.max_current - car.charging_current
                         car.battery_current = car.max_current - car.charging_current
-                        car.battery_no = car.station_no
+                        car.battery_no = station.station_no
                     else:
-                        stations_tmp = [station for station in stations if (station.battery_current == 0 and station.battery_capacity > car.max_current * VOLTAGE * (READ_DELAY / 3600) * 0.001 and station.station_no != 0)]
-                        stations_tmp.sort(key=lambda x: x.battery_capacity, reverse=True)
-
-                        if len(stations_tmp) > 0:
-                            stations[stations_tmp[0].station_no].battery_current = car.max_current - car.charging_current
-                            car.battery_current = car.max_current - car.charging_current
-                            car.battery_no = stations_tmp[0].station_no
-                        else:
-                            print("Warn: no batteries available")
-                            not_max = True
+                        not_max = True
                 if not not_max:
                     car.charging_current = car.max_current
 
@@ -206,28 +412,13 @@ def read(fast_sim, log):
                 if available_current - used_current < car.min_current:
                     if car.sleep_mode:
                         car.charging_current = car.min_current
-
-                        if not car.simulation:
-                            if stations[0].battery_capacity > car.min_current * VOLTAGE * (READ_DELAY / 3600) * 0.001:
-                                car.battery_no = 0
-                                stations[0].battery_current = car.min_current - (available_current - used_current)
-                                car.battery_current = car.min_current - (available_current - used_current)
-                            else:
-                                car.charging_current = 0
-                        elif stations[car.station_no].battery_current == 0 and stations[car.station_no].battery_capacity > car.min_current * VOLTAGE * (READ_DELAY / 3600) * 0.001:
-                            stations[car.station_no].battery_current = car.min_current - (available_current - used_current)
+                        station = self.battery_for(car, car.min_current)
+                        if station:
+                            station.battery_current = car.min_current - (available_current - used_current)
                             car.battery_current = car.min_current - (available_current - used_current)
-                            car.battery_no = car.station_no
+                            car.battery_no = station.station_no
                         else:
-                            stations_tmp = [station for station in stations if (station.battery_current == 0 and station.station_no != 0)]
-                            stations_tmp.sort(key=lambda x: x.battery_capacity, reverse=True)
-                            if len(stations_tmp) > 0 and stations_tmp[0].battery_capacity > car.min_current * VOLTAGE * (READ_DELAY / 3600) * 0.001:
-                                stations[stations_tmp[0].station_no].battery_current = car.min_current - (available_current - used_current)
-                                car.battery_current = car.min_current - (available_current - used_current)
-                                car.battery_no = stations_tmp[0].station_no
-                            else:
-                                print("Warn: no batteries available")
-                                car.charging_current = 0
+                            car.charging_current = 0
                     else:
                         car.charging_current = 0
                 elif car.charging_current > car.max_current:
@@ -237,418 +428,870 @@ def read(fast_sim, log):
 
             used_current += (car.charging_current - car.battery_current)
 
-            if car.name == "openevse" and car.charging_current != car.prev_current:
-                cmd = "$SC " + str(int(car.charging_current)) + " V\r"
-                if openevse.is_open:
-                    openevse.write(cmd.encode())
-                while openevse.in_waiting == 0:
-                    pass
-                if openevse.in_waiting > 0:
-                    msg = openevse.read(openevse.in_waiting)
+            if not car.simulation and car.charging_current != car.prev_current:
+                self.set_charger_current(car)
+
+        return used_current
+
+    def allocate_waterfill(self, available_current):
+        # Same battery rules as allocate_current(), but the building current is split in exact
+        # proportion to priority within each car's min and max current (see waterfill.py), so
+        # current a clamped car cannot use goes to the others instead of being left over.
+        # Cars are admitted in priority order while the building can cover their min current;
+        # the rest charge from a battery in sleep mode and stop otherwise.
+        budget = max(available_current, 0)
+        admitted = []
+        floors = 0
+        for car in self.cars:
+            car.prev_current = car.charging_current
+            car.battery_no = -1
+            car.battery_current = 0
+            if car.priority == 0:
+                continue
+            if car.battery_on:
+                # the battery makes up whatever the building does not give
+                admitted.append((car, 0))
+            elif floors + car.min_current <= budget:
+                floors += car.min_current
+                admitted.append((car, car.min_current))
+
+        fill = self.waterfill
+        keep = set(car for car, _ in admitted)
+        for car in list(fill):
+            if car not in keep:
+                fill.remove(car)
+        for car, low in admitted:
+            # only moves the breakpoints of cars whose priority or bounds changed
+            fill.update(car, car.priority, low, car.max_current)
+
+        # whole amps, the ones lost rounding down go to the largest remainders
+        level = fill.level(budget)
+        shares = [(car, fill.current(car, level)) for car, _ in admitted]
+        currents = {car: int(share) for car, share in shares}
+        spare = int(round(min(budget, sum(share for _, share in shares)), 6)) - sum(currents.values())
+        if spare > 0:
+            for car, share in sorted(shares, key=lambda x: x[1] - int(x[1]), reverse=True):
+                if spare == 0:
+                    break
+                if currents[car] < car.max_current:
+                    currents[car] += 1
+                    spare -= 1
+
+        used_current = 0
+        for car in self.cars:
+            if car in currents:
+                car.charging_current = currents[car]
+                if car.battery_on and car.charging_current < car.max_current:
+                    station = self.battery_for(car, car.max_current)
+                    if station:
+                        station.battery_current = car.max_current - car.charging_current
+                        car.battery_current = car.max_current - car.charging_current
+                        car.battery_no = station.station_no
+                        car.charging_current = car.max_current
+            elif car.priority != 0 and car.sleep_mode:
+                car.charging_current = car.min_current
+                station = self.battery_for(car, car.min_current)
+                if station:
+                    station.battery_current = car.min_current
+                    car.battery_current = car.min_current
+                    car.battery_no = station.station_no
+                else:
+                    car.charging_current = 0
+            else:
+                car.charging_current = 0
+
+            used_current += (car.charging_current - car.battery_current)
+
+            if not car.simulation and car.charging_current != car.prev_current:
+                self.set_charger_current(car)
 
-        stations_tmp = [station for station in stations if (station.battery_current == 0 and station.battery_capacity < (BATTERY_CAPACITY * 0.9))]
-        stations_tmp.sort(key=lambda x: x.battery_capacity)
+        return used_current
 
-        for station in stations:
+    def charge_batteries(self, available_current, used_current):
+        for station in self.stations:
             station.charging_current = 0
 
-        while available_current - used_current >= BATTERY_CHARGING_CURRENT and len(stations_tmp) > 0:
-            stations[stations_tmp[0].station_no].charging_current = BATTERY_CHARGING_CURRENT
-            available_current -= BATTERY_CHARGING_CURRENT
-            stations_tmp.pop(0)
+        # lowest batteries first
+        while available_current - used_current >= self.battery_charging_current:
+            station = self.station_index.take_smallest(self.battery_capacity * 0.9)
+            if not station:
+                break
+            station.charging_current = self.battery_charging_current
+            available_current -= self.battery_charging_current
+
+    def publish_state(self):
+        # Copies this tick into a new TickState. Readers on other threads take self.state and
+        # never see live Car and Station objects, so they need no lock.
+        if not (self.log_writer or self.state_wanted):
+            return
+        self.state_wanted = False
+        if self.waiting_names is None:
+            self.waiting_names = tuple(record.name for record in self.car_dataset.values())
+        if self.engine and not self.engine.stale:
+            # straight from the engine's arrays
+            measured, charging, battery, delta, battery_no, priority, station_battery, station_charging, capacity = self.engine.columns()
+            cars = tuple(CarState(car.name, car.station_no, car_measured, car_charging, car_battery, car_delta, 100 * car_delta/car.capacity, car_battery_no, car_priority, car.departure)
+                         for car, car_measured, car_charging, car_battery, car_delta, car_battery_no, car_priority in zip(self.cars, measured, charging, battery, delta, battery_no, priority))
+            stations = tuple(StationState(station.station_no, *values) for station, values in zip(self.stations, zip(station_battery, station_charging, capacity)))
+        else:
+            cars = tuple(CarState(car.name, car.station_no, car.measured_current, car.charging_current, car.battery_current, car.delta_kWh, 100 * car.delta_kWh/car.capacity, car.battery_no, car.priority, car.departure) for car in self.cars)
+            stations = tuple(StationState(station.station_no, station.battery_current, station.charging_current, station.battery_capacity) for station in self.stations)
+        self.state = TickState(self.i, self.building_load(), cars, stations, self.waiting_names)
 
+    def log_tick(self, state):
         # Log building current, battery current, remaining SoC
-        if log:
-            write_openevse = False
-            current_time = int_to_str(i * READ_DELAY)
-            total_power_used = 0.0
-            total_building_power_used = 0.0
-
-            for car in cars:
-                file = open("logs/" + car.name + ".txt", "a")
-                file.write(current_time + ", " + str(car.measured_current) + ", " + str(car.charging_current) + ", " + str(car.battery_current) + ", " + str(100 * car.delta_kWh/car.capacity) + ", " + str(car.battery_no) + ", " + str(car.priority) + "\n")
-                if car.name == "openevse":
-                    write_openevse = True
-                total_power_used += car.charging_current * VOLTAGE
-                total_building_power_used += (car.charging_current - car.battery_current) * VOLTAGE
-
-            if not write_openevse:
-                file = open("logs/openevse.txt", "a")
-                file.write(current_time + ", 0, 0, 0, 0, 0, 0\n")
-
-            for station in stations:
-                if station.station_no < 10:
-                    file = open("logs/" + "station0" + str(station.station_no) + ".txt", "a")
-                else:
-                    file = open("logs/" + "station" + str(station.station_no) + ".txt", "a")
-                file.write(current_time + ", " + str(station.battery_current) + ", " + str(station.charging_current) + ", " + str(station.battery_capacity) + "\n")
+        if self.metrics:
+            start = perf_counter()
+        empty_chargers = set(self.chargers.clients if self.chargers else [0])
+        total_power_used = 0.0
+        total_building_power_used = 0.0
+
+        for car in state.cars:
+            self.log_writer.write(car.name, state.tick, (car.measured_current, car.charging_current, car.battery_current, car.delta_soc, car.battery_no, car.priority))
+            if car.name == charger_name(car.station_no):
+                empty_chargers.discard(car.station_no)
+            total_power_used += car.charging_current * self.voltage
+            total_building_power_used += (car.charging_current - car.battery_current) * self.voltage
+
+        for station_no in sorted(empty_chargers):
+            self.log_writer.write(charger_name(station_no), state.tick, EMPTY_CAR_LOG)
+
+        for station in state.stations:
+            if station.station_no < 10:
+                stream = "station0" + str(station.station_no)
+            else:
+                stream = "station" + str(station.station_no)
+            self.log_writer.write(stream, state.tick, (station.battery_current, station.charging_current, station.battery_capacity))
+
+        for name in state.waiting:
+            self.log_writer.write(name, state.tick, EMPTY_CAR_LOG)
 
-            for car in car_dataset:
-                file = open("logs/" + car[0] + ".txt", "a")
-                file.write(current_time + ", 0, 0, 0, 0, 0, 0\n")
+        self.log_writer.write("power_use", state.tick, (total_building_power_used, (self.max_building - state.building_load) * 1000, total_power_used))
+        if self.metrics:
+            self.metrics.add("log", perf_counter() - start)
 
-            file = open("logs/power_use" + ".txt", "a")
-            file.write(current_time + ", " + str(total_building_power_used) + ", " + str((max_building - building_dataset[i]) * 1000) + ", " + str(total_power_used) + "\n")
+    def tick(self):
+        metrics = self.metrics
+        if metrics:
+            metrics.begin(self.i)
 
-        cars_mutex.release()
+        # read building power
+        # building dataset in kW
+        available_current = (self.max_building - self.building_load()) * 1000 / self.voltage 
 
-        end_loop = time()
-        offset = end_loop - start_loop
+        self.read_chargers()
+        if metrics:
+            metrics.lap("read_chargers")
 
-        if (offset) > READ_DELAY:
-            pass
-        elif fast_sim:
-            sleep(FAST_READ_DELAY)
+        if self.engine:
+            self.engine.tick(self.cars, self.stations, available_current, self.measure_current, self.set_charger_current)
+            if metrics:
+                metrics.lap("engine")
         else:
-            sleep(READ_DELAY - (offset))
-
-        i += 1
-
-def state_control(fast_sim):
-    global car_dataset
-    global station_number
-    while i < len(building_dataset):
-        wait.acquire()
-        wait.wait()
-        wait.release()
-
-        current_time = i * READ_DELAY
-        time_readable = int_to_str(current_time)
-
-        # check for new simulated cars that have arrived
-        for car_data in car_dataset:
-            name, arrival, departure, model, desired_soc, sleep_mode = car_data
-            if int(arrival) <= current_time:
-                if DEBUG:
-                    print("Log: Simulated car " + name + " arrived")
-                car = Car()
-                car.name = name
-                car.make_model = model.strip().lower()
-                car.capacity = MAKE_MODEL[car.make_model]
-                car.delta_kWh = int(desired_soc) * car.capacity * 0.01
-                car.departure = str_to_int(departure)
-                car.sleep_mode = sleep_mode.strip() == 'True'
-                car.station_no = station_number
-                station_number += 1
-                cars_mutex.acquire()
-                cars.append(car)
-                cars_mutex.release()
-        car_dataset = [x for x in car_dataset if int(x[1]) > current_time]
-
-        cars_mutex.acquire()
-
-        # check for cars that have left
-        for car in cars[:]:
-            if car.departure <= current_time:
+            self.measure_cars()
+            if metrics:
+                metrics.lap("measure")
+            self.discharge_batteries()
+            if metrics:
+                metrics.lap("discharge")
+            if self.allocator == "waterfill":
+                used_current = self.allocate_waterfill(available_current)
+            else:
+                used_current = self.allocate_current(available_current)
+            if metrics:
+                metrics.lap("allocate")
+            self.charge_batteries(available_current, used_current)
+            if metrics:
+                metrics.lap("charge")
+
+        draw = self.building_load() * 1000
+        if self.engine:
+            draw = self.engine.draw(draw)
+        else:
+            for car in self.cars:
+                draw += (car.charging_current - car.battery_current) * self.voltage
+            for station in self.stations:
+                draw += station.charging_current * self.voltage
+        if draw > self.peak_building:
+            self.peak_building = draw
+
+        self.publish_state()
+        if metrics:
+            metrics.lap("publish")
+            metrics.end()
+
+    def read(self, log):
+        # delay in seconds
+
+        while self.i < len(self.building_dataset):
+            start_loop = time()
+            if self.i % self.control_delay // READ_DELAY == 0:
+                self.wait.acquire()
+                self.control_requested = perf_counter()
+                self.wait.notify()
+                self.wait.release()
+
+            if self.metrics:
+                waiting = perf_counter()
+            self.cars_mutex.acquire()
+            if self.metrics:
+                self.metrics.waited("read", perf_counter() - waiting)
+
+            self.tick()
+
+            if log:
+                self.log_tick(self.state)
+
+            self.snapshot()
+
+            if self.chargers and self.i % 300 == 0:
+                self.chargers.report()
+
+            self.cars_mutex.release()
+
+            end_loop = time()
+            offset = end_loop - start_loop
+
+            if (offset) > READ_DELAY:
+                if self.metrics:
+                    self.metrics.overrun(offset - READ_DELAY)
+            else:
+                sleep(READ_DELAY - (offset))
+
+            self.i += 1
+
+        self.cars_mutex.acquire()
+        self.sync_objects()
+        self.cars_mutex.release()
+
+    def state_control(self):
+        while self.i < len(self.building_dataset):
+            self.wait.acquire()
+            self.wait.wait()
+            self.wait.release()
+
+            self.control_step()
+            if self.metrics:
+                self.metrics.control_latency.observe(perf_counter() - self.control_requested)
+
+    def control_step(self):
+
+        current_time = self.i * READ_DELAY
+        time_readable = self.int_to_str(current_time)
+
+        metrics = self.metrics
+        if metrics:
+            start = perf_counter()
+        self.cars_mutex.acquire()
+        if metrics:
+            metrics.waited("control", perf_counter() - start)
+
+        # check for new simulated cars that have arrived, in dataset order
+        arrived = []
+        while self.arrivals and self.arrivals[0][0] <= current_time:
+            arrived.append(heappop(self.arrivals)[1])
+        if arrived:
+            self.waiting_names = None
+
+        if self.engine and not arrived and not self.headroom and not (self.departures and self.departures[0][0] <= current_time):
+            # nothing arrives or leaves, the engine runs the rest of the step on its arrays
+            self.cars = self.engine.control(self.cars, self.stations, current_time)
+            self.cars_mutex.release()
+            if metrics:
+                metrics.add("control", perf_counter() - start)
+            return
+        self.sync_objects(changing=True)
+
+        for line in sorted(arrived):
+            record = self.car_dataset.pop(line)
+            if DEBUG:
+                print("Log: Simulated car " + record.name + " arrived")
+            car = Car()
+            car.name = record.name
+            car.make_model = record.model
+            car.capacity = MAKE_MODEL[car.make_model]
+            car.delta_kWh = record.desired_soc * car.capacity * 0.01
+            car.departure = record.departure
+            car.sleep_mode = record.sleep_mode
+            car.station_no = self.station_number
+            self.station_number += 1
+            self.cars.append(car)
+            self.schedule_departure(car)
+
+        # check for cars that have left, in charging order
+        leaving = set()
+        while self.departures and self.departures[0][0] <= current_time:
+            departure, _, car = heappop(self.departures)
+            # entries left behind when a departure time was changed are skipped
+            if departure == car.departure:
+                leaving.add(id(car))
+        if leaving:
+            staying = []
+            for car in self.cars:
+                if id(car) not in leaving:
+                    staying.append(car)
+                    continue
                 print("Car: " + str(car.name) + " left at " + str(time_readable) + " with SoC remaining(%): " + str(100 * car.delta_kWh/car.capacity))
-                stations[car.battery_no].battery_current = 0
-                cars.remove(car)
+                self.departed.append((car.name, time_readable, 100 * car.delta_kWh/car.capacity))
+                self.stations[car.battery_no].battery_current = 0
+            self.cars = staying
 
         # check if battery needs to be turned on
-        for car in cars:
-            if not car.battery_on and car.delta_kWh >= EFFICIENCY * car.max_current * VOLTAGE * 0.001 * (car.departure - current_time) / 3600:
-                print("Log: Turning on battery for " + car.name)
-                car.battery_on = True 
+        if self.headroom:
+            self.plan_batteries(current_time)
+        else:
+            for car in self.cars:
+                if not car.battery_on and car.delta_kWh >= self.efficiency * car.max_current * self.voltage * 0.001 * (car.departure - current_time) / 3600:
+                    print("Log: Turning on battery for " + car.name)
+                    car.battery_on = True 
 
         # assign priorities
         normalize = 0
-        for car in cars:
+        for car in self.cars:
             car.priority = car.delta_kWh / (car.departure - current_time)
             normalize += car.priority
         if normalize > 0:
-            for car in cars:
+            for car in self.cars:
                 car.priority = car.priority / normalize
-        cars.sort(key=lambda x: (x.sleep_mode, x.priority), reverse=True)
-
-        cars_mutex.release()
-
-def wait_for_car(port, cont):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        print("Listening on " + str(port))
-        s.bind(("127.0.0.1", port))
-        s.listen()
-        while i < len(building_dataset):
-            conn, addr = s.accept()
-            with conn:
-                data = conn.recv(4096)
-                if len(data) == 0:
+        self.cars.sort(key=lambda x: (x.sleep_mode, x.priority), reverse=True)
+
+        self.cars_mutex.release()
+        if metrics:
+            metrics.add("control", perf_counter() - start)
+
+    def plan_batteries(self, current_time):
+        # Battery dispatch with --plan lookahead, call with cars_mutex held. Going by departure,
+        # the building headroom left until a car leaves has to cover its delta_kWh and that of
+        # every car leaving before it, less what the batteries already on can give. A car's
+        # battery goes on when that falls short, or when its max current cannot deliver
+        # delta_kWh in time (the only check without planning).
+        tick_no = current_time // READ_DELAY
+        need = 0.0
+        for car in sorted(self.cars, key=lambda car: car.departure):
+            need += car.delta_kWh
+            if not car.battery_on:
+                departure = car.departure // READ_DELAY
+                # kW summed over ticks, to kWh
+                headroom = (self.max_building * self.headroom.count(tick_no, departure) - self.headroom.total(tick_no, departure)) * READ_DELAY / 3600
+                if car.delta_kWh >= self.efficiency * car.max_current * self.voltage * 0.001 * (car.departure - current_time) / 3600:
+                    print("Log: Turning on battery for " + car.name)
+                    car.battery_on = True
+                elif need > self.efficiency * headroom:
+                    print("Log: Turning on battery for " + car.name + ", headroom before departure is " + str(round(need - self.efficiency * headroom, 2)) + " kWh short, lowest in the next hour " + str(round(self.max_building - self.headroom.maximum(tick_no), 2)) + " kW")
+                    car.battery_on = True
+            if car.battery_on:
+                station = self.stations[car.station_no if car.simulation else 0]
+                need -= min(car.delta_kWh, station.battery_capacity * self.efficiency)
+
+    def add_car(self, car):
+        self.cars_mutex.acquire()
+        self.sync_objects(changing=True)
+        self.cars.append(car)
+        self.schedule_departure(car)
+        self.cars_mutex.release()
+
+    def schedule_departure(self, car):
+        # call with cars_mutex held, again whenever car.departure changes
+        heappush(self.departures, (car.departure, self.departures_pushed, car))
+        self.departures_pushed += 1
+
+    def control_due(self, tick_no):
+        # same check read() uses to wake state_control()
+        return tick_no % self.control_delay // READ_DELAY == 0
+
+    def next_control(self, tick_no):
+        # first control tick from tick_no on that can change anything, len(building_dataset) if none
+        if not self.cars:
+            if not self.arrivals:
+                return len(self.building_dataset)
+            arrival = self.arrivals[0][0]
+            tick_no = max(tick_no, -(-arrival // READ_DELAY))
+        while tick_no < len(self.building_dataset) and not self.control_due(tick_no):
+            tick_no += 1
+        return tick_no
+
+    def quiet_ticks(self, limit):
+        # Number of ticks after this one that repeat its allocation. Allocation only changes with
+        # priorities, building load or the order and thresholds of station battery capacities, so
+        # look for the first tick where a capacity crosses a threshold or another station.
+        if limit <= 0 or any(not car.simulation for car in self.cars):
+            return 0
+
+        thresholds = {self.battery_capacity * 0.9}
+        for car in self.cars:
+            thresholds.add(car.max_current * self.voltage * (READ_DELAY / 3600) * 0.001)
+            thresholds.add(car.min_current * self.voltage * (READ_DELAY / 3600) * 0.001)
+
+        rates = {}
+        for station in self.stations:
+            rate = station.charging_current * self.voltage * (READ_DELAY / 3600) * 0.001 * self.efficiency - station.battery_current * self.voltage * (READ_DELAY / 3600) * 0.001 * (1.0/self.efficiency)
+            rates[station.station_no] = rate
+            if rate == 0:
+                continue
+            for threshold in thresholds:
+                if (station.battery_capacity - threshold) * rate >= 0:
+                    # moving away from (or sitting on) this threshold
+                    if station.battery_capacity == threshold:
+                        return 0
                     continue
-                car_info = pickle.loads(data)
-                if DEBUG:
-                    print("Log: User input received")
-                if car_info["station_no"] == 0 and openevse:
-                    cmd = b"$GS\r"
-                    print("OpenEVSE station")
-
-                    if openevse.is_open:
-                        openevse.write(cmd)
-                    while openevse.in_waiting <= 5:
-                        pass
-                    if openevse.in_waiting > 5:
-                        msg = openevse.read(openevse.in_waiting)
-
-                    sleep(2)
-
-                    if openevse.is_open:
-                        openevse.write(cmd)
-                    while openevse.in_waiting <= 5:
-                        pass
-                    if openevse.in_waiting > 5:
-                        msg = openevse.read(openevse.in_waiting)
-                    if msg.decode()[:6] == "$OK 02" or msg.decode()[:6] == "$OK 03":
-                        print("Log: Car connected")
-                    else:
-                        print("Warn: Car not connected. OpenEVSE returned: " + msg.decode())
-                        continue
+                # stop a tick early so rounding never puts us past a crossing
+                limit = min(limit, int((threshold - station.battery_capacity) / rate) - 1)
+                if limit <= 0:
+                    return 0
+
+        # Capacity order only matters if a car borrowed (or failed to get) another station's
+        # battery, or if there was only headroom to recharge some of the low batteries
+        borrowing = False
+        for car in self.cars:
+            if car.priority == 0:
+                continue
+            if car.battery_no not in (-1, car.station_no):
+                borrowing = True
+            elif car.battery_no == -1 and car.battery_on and car.charging_current < car.max_current:
+                borrowing = True
+            elif car.battery_no == -1 and car.sleep_mode and car.charging_current == 0:
+                borrowing = True
+        recharge_full = all(station.charging_current != 0 for station in self.stations if station.battery_current == 0 and station.battery_capacity < (self.battery_capacity * 0.9))
+        if not borrowing and recharge_full:
+            return limit
+
+        # crossings in capacity order always happen between neighbours first
+        ordered = sorted(self.stations, key=lambda x: x.battery_capacity)
+        for low, high in zip(ordered, ordered[1:]):
+            closing = rates[low.station_no] - rates[high.station_no]
+            if closing > 0:
+                limit = min(limit, int((high.battery_capacity - low.battery_capacity) / closing) - 1)
+                if limit <= 0:
+                    return 0
+
+        return limit
+
+    def advance(self, n):
+        # Energy accounting of n ticks that keep the previous allocation. Currents are constant
+        # over them, so each car and station moves by n times the energy of one tick. This can
+        # differ from adding it tick by tick in the last digits, quiet_ticks() stops a tick
+        # before any threshold or capacity order crossing so battery choices are the same.
+        for car in self.cars:
+            car.prev_current = car.charging_current
+            car.measured_current = car.charging_current * self.efficiency
+            car.delta_kWh -= n * car.measured_current * self.voltage * (READ_DELAY / 3600) * 0.001
+            if car.delta_kWh < 0:
+                car.delta_kWh = 0
 
-                    cmd = "$SV " + str(VOLTAGE * 1000) + "\r"
-                    if openevse.is_open:
-                        openevse.write(cmd.encode())
-                    while openevse.in_waiting == 0:
-                        pass
-                    if openevse.in_waiting > 0:
-                        msg = openevse.read(openevse.in_waiting)
-
-                    if not cont:
-                        car = Car()
-                        car.name = "openevse"
-                        car.simulation = False
-                        car.make_model = car_info["make_model"].strip('\n').lower()
-                        car.capacity = MAKE_MODEL[car.make_model]
-                        car.delta_kWh = car_info["delta_soc"] * car.capacity * 0.01
-                        car.departure = str_to_int(car_info["departure"])
-                        car.station_no = 0
-                        cars_mutex.acquire()
-                        cars.append(car)
-                        cars_mutex.release()
-                    else:
-                        for car in cars:
-                            if car.name == "openevse":
-                                cars_mutex.acquire()
-                                car.simulation = False
-                                car.departure = str_to_int(car_info["departure"])
-                                cars_mutex.release()
-                        break
-
-def publish_status(delay, port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.bind((ip_address, port))
-        s.listen()
-        conn, addr = s.accept()
-        with conn:
-            while i < len(building_dataset):
-                visualization_info = {}
-                visualization_info["current_time"] = int_to_str(i * READ_DELAY)
-                visualization_info["avail_building_power"] = (max_building - building_dataset[i]) * 1000
-                visualization_info["max_power"] = max_building*1000
-                visualization_info["cars"] = {}
-
-                total_power_used = 0.0
-                total_building_power_used = 0.0
-                total_power_to_batteries = 0.0
-                total_energy_req = 0.0
-
-                for car in cars:
-                    visualization_info["cars"][car.station_no] = {"name": car.name, "delta_soc": 100 * car.delta_kWh/car.capacity, "current": car.charging_current, "battery": car.battery_current, "remaining_time": car.departure - i * READ_DELAY}
-                    total_power_used += car.charging_current * VOLTAGE
-                    total_building_power_used += (car.charging_current - car.battery_current) * VOLTAGE
-                    total_energy_req += car.delta_kWh
-
-                for station in stations:
-                    total_power_to_batteries += station.charging_current*VOLTAGE
-
-                visualization_info["total_building_power_used"] = total_building_power_used
-                visualization_info["total_power_used"] = total_power_used
-                visualization_info["total_power_to_batteries"] = total_power_to_batteries
-                visualization_info["total_energy_req"] = total_energy_req
-
-                for num in range(num_stations):
-                    if num not in visualization_info["cars"]:
-                        visualization_info["cars"][num] = "empty"
-                
-                data = pickle.dumps(visualization_info)
-                try:
-                    conn.send(data)
-                except:
-                    conn, addr = s.accept()
-                sleep(delay)
-
-def zeka_control():
-    zeka_obj = zeka.Zeka()
-    zeka_obj.zeka_init(zeka_bus)
-    zeka_obj.zeka_receive(zeka_bus)
-    while not zeka_obj.zeka_precharge_done:
-        zeka_obj.zeka_main_status(zeka_bus)
-        zeka_obj.zeka_receive(zeka_bus)
-        sleep(1)
-    zeka_obj.zeka_set_voltage_current(zeka_bus, ZEKA_VOLTAGE + 50, 1)
-    zeka_obj.zeka_receive(zeka_bus)
-    zeka_obj.zeka_start(zeka_bus)
-    zeka_obj.zeka_receive(zeka_bus)
-    current_set = 1.0
-
-    while i < len(building_dataset):
-        zeka_obj.zeka_feedback_status(zeka_bus)
-        zeka_obj.zeka_receive(zeka_bus)
-        sleep(0.5)
-        current_set = (VOLTAGE * float(stations[0].battery_current)) / ZEKA_VOLTAGE
-        if current_set < 1.0:
+        for station in self.stations:
+            if station.battery_current == 0 and station.charging_current == 0:
+                continue
+            discharged = station.battery_current * self.voltage * (READ_DELAY / 3600) * 0.001 * (1.0/self.efficiency)
+            charged = station.charging_current * self.voltage * (READ_DELAY / 3600) * 0.001 * self.efficiency
+            station.battery_capacity -= n * discharged
+            station.battery_capacity += n * charged
+
+    def next_change(self, tick_no):
+        # First tick after tick_no with a different building load, len(building_dataset) if none.
+        # Looks at the next tick, then scans windows that double up to CHANGE_WINDOW ticks, so
+        # a memory mapped dataset is only read as far as the change.
+        loads = self.building_dataset
+        if tick_no + 1 >= len(loads):
+            return len(loads)
+        if loads[tick_no + 1] != loads[tick_no]:
+            return tick_no + 1
+        start = tick_no
+        window = 64
+        while start + 1 < len(loads):
+            end = min(start + window, len(loads))
+            changes = np.flatnonzero(np.diff(np.asarray(loads[start:end], float)))
+            if len(changes):
+                return start + int(changes[0]) + 1
+            # the last tick of this window is the first of the next
+            start = end - 1
+            window = min(window * 2, CHANGE_WINDOW)
+        return len(loads)
+
+    def run_ticks(self, log):
+        # Single threaded fast sim: measurement, allocation and state control run every tick in
+        # the same order (the order run_events() uses), so runs of the same data always give the
+        # same result. cars_mutex is only taken for the status publisher.
+
+        while self.i < len(self.building_dataset):
+            self.tick()
+            if log:
+                self.log_tick(self.state)
+            if self.control_due(self.i):
+                self.control_step()
+
+            self.snapshot()
+
+            if self.chargers and self.i % 300 == 0:
+                self.chargers.report()
+
+            self.i += 1
+        self.sync_objects()
+
+    def run_events(self, log):
+        # Single threaded fast sim that only runs full ticks when something can change: control
+        # ticks with cars present or arriving, building load changes and battery threshold
+        # crossings. Ticks in between only repeat the energy accounting (see advance()).
+
+        next_change = 0
+        # quiet_ticks() costs about as much as a tick, so after it finds nothing to skip it is
+        # not asked again for backoff ticks, doubling up to QUIET_BACKOFF while it keeps failing
+        backoff = 0
+        retry = 0
+
+        while self.i < len(self.building_dataset):
+            self.tick()
+            if log:
+                self.log_tick(self.state)
+            controlled = self.control_due(self.i) and self.next_control(self.i) == self.i
+            if controlled:
+                self.control_step()
+
+            if next_change <= self.i:
+                next_change = self.next_change(self.i)
+
+            # ticks up to and including the next control tick can repeat this one, a building
+            # load change cannot
+            n = 0
+            if not controlled and self.i >= retry and next_change - 1 > self.i:
+                limit = min(self.next_control(self.i + 1), next_change - 1, len(self.building_dataset) - 1) - self.i
+                self.sync_objects()
+                n = self.quiet_ticks(limit)
+                if n == 0 and limit > 0:
+                    backoff = min(max(1, backoff * 2), QUIET_BACKOFF)
+                    retry = self.i + backoff
+                else:
+                    backoff = 0
+
+            if n > 0:
+                self.sync_objects(changing=True)
+                if log:
+                    for _ in range(n):
+                        self.i += 1
+                        self.advance(1)
+                        self.publish_state()
+                        self.log_tick(self.state)
+                else:
+                    self.advance(n)
+                    self.i += n
+                    self.publish_state()
+                if self.control_due(self.i) and self.next_control(self.i) == self.i:
+                    self.control_step()
+
+            self.snapshot()
+            self.i += 1
+        self.sync_objects()
+
+    def wait_for_car(self, port, cont):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            print("Listening on " + str(port))
+            s.bind(("127.0.0.1", port))
+            s.listen()
+            while self.i < len(self.building_dataset):
+                conn, addr = s.accept()
+                with conn:
+                    data = conn.recv(4096)
+                    if len(data) == 0:
+                        continue
+                    car_info = pickle.loads(data)
+                    if DEBUG:
+                        print("Log: User input received")
+                    station_no = car_info["station_no"]
+                    if self.chargers and station_no in self.chargers.clients:
+                        charger = self.chargers.clients[station_no]
+                        print("OpenEVSE station " + str(station_no))
+
+                        try:
+                            charger.request("GS")
+                            sleep(2)
+                            state = charger.request("GS")
+                        except Exception as ex:
+                            print("Warn: Car not connected. OpenEVSE returned: " + str(ex))
+                            continue
+                        if state[0] == "02" or state[0] == "03":
+                            print("Log: Car connected")
+                        else:
+                            print("Warn: Car not connected. OpenEVSE returned: $OK " + " ".join(state))
+                            continue
+
+                        try:
+                            charger.request("SV " + str(self.voltage * 1000))
+                        except Exception as ex:
+                            print("Warn: OpenEVSE did not set voltage: " + str(ex))
+
+                        self.cars_mutex.acquire()
+                        restored = [car for car in self.cars if car.name == charger_name(station_no)]
+                        if restored:
+                            self.sync_objects(changing=True)
+                        for car in restored:
+                            car.simulation = False
+                            car.departure = self.str_to_int(car_info["departure"])
+                            self.schedule_departure(car)
+                        self.cars_mutex.release()
+
+                        if not restored:
+                            car = Car()
+                            car.name = charger_name(station_no)
+                            car.simulation = False
+                            car.make_model = car_info["make_model"].strip('\n').lower()
+                            car.capacity = MAKE_MODEL[car.make_model]
+                            car.delta_kWh = car_info["delta_soc"] * car.capacity * 0.01
+                            car.departure = self.str_to_int(car_info["departure"])
+                            car.station_no = station_no
+                            self.add_car(car)
+
+                        # continuing stops listening once every restored charger car is back
+                        if cont and not any(car.simulation and car.name == charger_name(car.station_no) for car in self.cars):
+                            break
+
+    def status(self, state):
+        # what publish_status() sends for a TickState
+        visualization_info = {}
+        visualization_info["current_time"] = self.int_to_str(state.tick * READ_DELAY)
+        visualization_info["elapsed"] = state.tick * READ_DELAY
+        visualization_info["avail_building_power"] = (self.max_building - state.building_load) * 1000
+        visualization_info["max_power"] = self.max_building*1000
+        visualization_info["cars"] = {}
+
+        total_power_used = 0.0
+        total_building_power_used = 0.0
+        total_power_to_batteries = 0.0
+        total_energy_req = 0.0
+
+        for car in state.cars:
+            visualization_info["cars"][car.station_no] = {"name": car.name, "delta_soc": car.delta_soc, "current": car.charging_current, "battery": car.battery_current, "remaining_time": car.departure - state.tick * READ_DELAY}
+            total_power_used += car.charging_current * self.voltage
+            total_building_power_used += (car.charging_current - car.battery_current) * self.voltage
+            total_energy_req += car.delta_kWh
+
+        for station in state.stations:
+            total_power_to_batteries += station.charging_current*self.voltage
+
+        visualization_info["total_building_power_used"] = total_building_power_used
+        visualization_info["total_power_used"] = total_power_used
+        visualization_info["total_power_to_batteries"] = total_power_to_batteries
+        visualization_info["total_energy_req"] = total_energy_req
+
+        for num in range(self.num_stations):
+            if num not in visualization_info["cars"]:
+                visualization_info["cars"][num] = "empty"
+
+        return visualization_info
+
+    def publish_status(self, delay, port):
+        # status frames to every connected client, see status_protocol.py and status_server.py
+        try:
+            server = StatusServer(ip_address, port)
+        except OSError as ex:
+            print("Warn: cannot serve status on port " + str(port) + ": " + str(ex))
+            return
+        encoder = StatusEncoder()
+        while self.i < len(self.building_dataset):
+            # the tick loop publishes a new TickState after the next tick
+            self.state_wanted = True
+            sleep(delay)
+            state = self.state
+            if state is not None:
+                delta = encoder.encode(self.status(state))
+                server.publish(encoder.snapshot(), delta)
+        server.close()
+
+    def zeka_control(self):
+        zeka_obj = zeka.Zeka()
+        zeka_obj.listen(self.zeka_bus)
+        try:
+            self.zeka_wait(zeka_obj.zeka_init(self.zeka_bus))
+            while not zeka_obj.zeka_precharge_done:
+                self.zeka_wait(zeka_obj.zeka_main_status(self.zeka_bus))
+                if not zeka_obj.zeka_precharge_done:
+                    sleep(1)
+            self.zeka_wait(zeka_obj.zeka_set_voltage_current(self.zeka_bus, ZEKA_VOLTAGE + 50, 1))
+            self.zeka_wait(zeka_obj.zeka_start(self.zeka_bus))
             current_set = 1.0
-        zeka_obj.controller(zeka_bus, ZEKA_VOLTAGE, current_set)
+            logged = -1
+            feedback = None
+
+            while self.i < len(self.building_dataset):
+                # the reply updates the cached voltage and current when it arrives
+                if feedback:
+                    feedback.cancel()
+                feedback = zeka_obj.zeka_feedback_status(self.zeka_bus)
+                sleep(ZEKA_PERIOD)
+                if zeka_obj.last_status and time() - zeka_obj.last_status > ZEKA_TIMEOUT:
+                    print("Warn: no Zeka status for " + "%.1f" % (time() - zeka_obj.last_status) + "s")
+                current_set = (self.voltage * float(self.station_battery_current(0))) / ZEKA_VOLTAGE
+                if current_set < 1.0:
+                    current_set = 1.0
+                zeka_obj.controller(self.zeka_bus, ZEKA_VOLTAGE, current_set)
+
+                if self.i % 4 == 0 and self.i != logged:
+                    logged = self.i
+                    if self.log_writer:
+                        self.log_writer.write("zeka", self.i, (zeka_obj.zeka_read_current, zeka_obj.zeka_read_voltage))
+                    else:
+                        file = open("logs/zeka.txt", "a")
+                        file.write(self.int_to_str(self.i * READ_DELAY) + ", " + str(zeka_obj.zeka_read_current) + ", " + str(zeka_obj.zeka_read_voltage) + "\n")
 
-        if i % 4 == 0:
-            file = open("logs/zeka.txt", "a")
-            file.write(int_to_str(i * READ_DELAY) + ", " + str(zeka_obj.zeka_read_current) + ", " + str(zeka_obj.zeka_read_voltage) + "\n")
+            self.zeka_wait(zeka_obj.zeka_stop(self.zeka_bus))
+        finally:
+            zeka_obj.stop_listening()
 
-    zeka_obj.zeka_stop(zeka_bus)
+    def zeka_wait(self, future):
+        # a lost frame is logged instead of hanging the Zeka thread
+        try:
+            future.result(ZEKA_TIMEOUT)
+        except Exception as ex:
+            future.cancel()
+            print("Warn: no Zeka reply: " + (str(ex) or type(ex).__name__))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Charging Management System')
     parser.add_argument("--building-dataset", "--bd", dest="building_file", required=True, help="Building dataset file")
     parser.add_argument("--car-dataset", "--cd", dest="car_file", required=True, help="Car dataset file")
-    parser.add_argument("--start-time", "--st", dest="start_time", default="18:00:00", help="Start time of building dataset (default: %(default)s)")
+    parser.add_argument("--start-time", "--st", dest="start_time", default="18:00:00", help="Start time of building dataset, binary datasets store their own (default: %(default)s)")
     parser.add_argument("--user-input-port", "--up", dest="user_port", type=int, default=8000, help="Port to listen for user input (default: %(default)s)")
     parser.add_argument("--visualization-port", "--vp", dest="visualization_port", type=int, default=9000, help="Port to send visualization output (default: %(default)s)")
-    parser.add_argument("--openevse-port", "--op", dest="openevse_port", default="", help="OpenEVSE serial port")
+    parser.add_argument("--openevse-port", "--op", dest="openevse_port", default="", help="OpenEVSE serial port, same as --charger 0=PORT")
+    parser.add_argument("--charger", dest="chargers", action="append", default=[], help="Hardware charger as STATION=PORT, e.g. 3=/dev/ttyUSB1 (repeatable)")
+    parser.add_argument("--charger-deadline", dest="charger_deadline", type=float, default=0.5, help="Seconds to wait for charger current readings each tick, late chargers use the simulated current (default: %(default)s)")
     parser.add_argument("--zeka-port", "--zp", dest="zeka_port", default="", help="Zeka CAN port")
-    parser.add_argument("--fast-sim", "--fs", dest="fast_sim", action="store_true", help="Run dataset without delay")
+    parser.add_argument("--fast-sim", "--fs", dest="fast_sim", action="store_true", help="Run dataset without delay, on one thread so runs are reproducible")
+    parser.add_argument("--event-sim", "--es", dest="event_sim", action="store_true", help="Fast sim that jumps between arrivals, departures, control ticks and building load changes")
     parser.add_argument("--log", dest="log", action="store_true", help="Log building current, battery current and remaining SoC of each car")
-    parser.add_argument("--continue", dest="cont", action="store_true", help="Continue previous simulation using logs")
+    parser.add_argument("--continue", dest="cont", action="store_true", help="Continue previous simulation from the last snapshot in logs, snapshots are only written by runs with --log")
+    parser.add_argument("--snapshot-interval", dest="snapshot_interval", type=int, default=60, help="Seconds of simulated time between snapshots written with --log (default: %(default)s)")
+    parser.add_argument("--engine", dest="engine", choices=["loop", "numpy"], default="loop", help="Tick engine, numpy runs each tick as array operations (default: %(default)s)")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, default=0, help="Serve tick phase timings, overruns and lock waits in Prometheus format on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--trace", dest="trace", default="", help="CSV file to write every tick's phase timings (ms) to")
+    parser.add_argument("--allocator", dest="allocator", choices=["greedy", "waterfill"], default="greedy", help="Current allocation, waterfill splits the building current exactly by priority within each car's min and max current (default: %(default)s)")
+    parser.add_argument("--plan", dest="plan", choices=["now", "lookahead"], default="now", help="Battery dispatch, lookahead also turns a car's battery on when the building headroom until it leaves cannot meet its energy request (default: %(default)s)")
+    parser.add_argument("--log-segment", dest="log_segment", type=int, default=0, help="Split text logs into compressed segments of this many seconds (at most a day) with an index, see log_segments.py")
+    parser.add_argument("--log-keep", dest="log_keep", type=int, default=0, help="Compressed segments to keep per stream, 0 keeps all (default: %(default)s)")
+    parser.add_argument("--log-format", dest="log_format", choices=["text", "binary"], default="text", help="Format of --log files, binary writes fixed width records that binlog.py can memory map (default: %(default)s)")
     args = parser.parse_args()
+    if args.engine == "numpy" and args.allocator != "greedy":
+        parser.error("--engine numpy only runs the greedy allocator")
+    if args.log_segment and args.log_format != "text":
+        parser.error("--log-segment only splits text logs")
+    if args.log_segment > 86400:
+        parser.error("--log-segment can be at most a day (86400 seconds)")
+
+    sim = Simulation(start=args.start_time)
 
     try:
-        file = open(args.building_file, "r")
+        sim.load_building(args.building_file)
     except Exception as ex:
         print("Cannot open building dataset")
         exit(0)
-    for line in file:
-        building_dataset.append(float(line.strip()))
 
-    max_building = max(building_dataset)
     if DEBUG:
-        print("Max building power: " + str(max_building))
+        print("Max building power: " + str(sim.max_building))
 
     try:
-        file = open(args.car_file, "r")
+        sim.load_cars(args.car_file)
     except Exception as ex:
         print("Cannot open car dataset")
         exit(0)
-    for line in file:
-        car_dataset.append(line.split(","))
-
-    num_stations = len(car_dataset) + 1
-    for num in range(num_stations):
-        stations.append(Station(station_no=num))
  
-    if not args.cont:
-        start = args.start_time
-    else:
-        start = args.start_time
-        line = subprocess.check_output(['tail', '-1', "logs/station00.txt"])
-        data = line.decode().split(",")
-        i = int(str_to_int(data[0]) / 2) + 1
-
+    sim.allocator = args.allocator
+    if args.metrics_port or args.trace:
+        sim.metrics = TickMetrics(args.trace or None)
+        if args.metrics_port:
+            sim.metrics.serve(args.metrics_port)
+    if args.plan == "lookahead":
+        sim.headroom = Headroom(PLAN_WINDOW // READ_DELAY, sim.building_dataset)
+    if args.engine == "numpy":
+        sim.engine = VectorEngine(sim.voltage, sim.efficiency, READ_DELAY, sim.battery_capacity, sim.battery_charging_current)
+
+    # station number: serial port of each hardware charger
+    charger_ports = {}
     if (args.openevse_port != ""):
+        charger_ports[0] = args.openevse_port
+    for charger in args.chargers:
+        station_no, port = charger.split("=", 1)
+        charger_ports[int(station_no)] = port
+
+    clients = {}
+    for station_no, port in charger_ports.items():
         try:
-            openevse = Serial(args.openevse_port, 115200, xonxoff=True)
+            clients[station_no] = RapiClient(Serial(port, 115200, xonxoff=True))
         except Exception as ex:
-            openevse = None
+            print("Warn: cannot open charger " + str(station_no) + " on " + port)
+    if clients:
+        sim.chargers = ChargerPool(clients, args.charger_deadline)
 
     if (args.zeka_port != ""):
         try:
-            zeka_bus = can.interface.Bus(bustype='slcan', channel=args.zeka_port, bitrate=500000)
+            sim.zeka_bus = can.interface.Bus(bustype='slcan', channel=args.zeka_port, bitrate=500000)
         except Exception as ex:
-            zeka_bus = None
+            sim.zeka_bus = None
 
     if args.log:
         if not os.path.exists("logs"):
             os.makedirs("logs")
         elif not args.cont:
             for f in os.listdir("logs"):
-                os.remove(os.path.join("logs",f))
+                if os.path.isdir(os.path.join("logs",f)):
+                    # streams of a segmented log
+                    shutil.rmtree(os.path.join("logs",f))
+                else:
+                    os.remove(os.path.join("logs",f))
+        if args.log_format == "binary":
+            sim.log_writer = BinaryLogWriter("logs", seconds(sim.start), READ_DELAY)
+        elif args.log_segment:
+            sim.log_writer = SegmentedLogWriter("logs", seconds(sim.start), READ_DELAY, max(1, args.log_segment // READ_DELAY), args.log_keep)
+        else:
+            sim.log_writer = LogWriter("logs", lambda tick: sim.int_to_str(tick * READ_DELAY))
+        sim.snapshot_path = os.path.join("logs", "snapshot.pickle")
+        sim.snapshot_interval = max(1, args.snapshot_interval // READ_DELAY)
 
     openevse_arrived = False
-    # Load previous logs
+    # Load previous state
     if args.cont:
-        for f in os.listdir("logs"):
-            if f[0:3] == "sim" or f[0:8] == "openevse":
-                line = subprocess.check_output(['tail', '-1', os.path.join("logs",f)])
-                timestamp, measured_current, current, battery_current, soc, battery_no, priority = line.decode().split(",")
-
-                if float(soc.strip()) == 0:
-                    continue
+        try:
+            openevse_arrived = sim.load_snapshot(os.path.join("logs", "snapshot.pickle"))
+        except Exception as ex:
+            print("Cannot open snapshot in logs")
+            exit(0)
 
-                if f[0:8] == "openevse":
-                    openevse_arrived = True
-                    car = Car()
-                    car.name = "openevse"
-                    car.make_model = "nissan leaf"
-                    car.capacity = MAKE_MODEL[car.make_model]
-                    car.delta_kWh = float(soc.strip()) * car.capacity * 0.01
-                    car.station_no = 0
-                    car.charging_current = float(current.strip())
-                    car.battery_current = float(battery_current.strip())
-                    car.measured_current = float(measured_current.strip())
-                    car.battery_no = int(battery_no.strip())
-                    car.battery_on = (int(battery_no.strip()) != -1)
-                    car.priority = float(priority.strip())
-                    cars_mutex.acquire()
-                    cars.append(car)
-                    cars_mutex.release()
-                    continue
-                for car_data in car_dataset:
-                    name, arrival, departure, model, desired_soc, sleep_mode = car_data
-                    if name.strip() == f[0:5]:
-                        car = Car()
-                        car.name = name
-                        car.make_model = model.strip().lower()
-                        car.capacity = MAKE_MODEL[car.make_model]
-                        car.delta_kWh = float(soc.strip()) * car.capacity * 0.01
-                        car.departure = str_to_int(departure)
-                        car.sleep_mode = sleep_mode.strip() == 'True'
-                        car.station_no = int(f[3:5])
-                        car.charging_current = float(current.strip())
-                        car.battery_current = float(battery_current.strip())
-                        car.measured_current = float(measured_current.strip())
-                        car.battery_no = int(battery_no.strip())
-                        car.battery_on = (int(battery_no.strip()) != -1)
-                        car.priority = float(priority.strip())
-                        cars_mutex.acquire()
-                        cars.append(car)
-                        cars_mutex.release()
-
-            if f[0:7] == "station":
-                line = subprocess.check_output(['tail', '-1', os.path.join("logs",f)])
-                timestamp, battery_current, charging_current, capacity = line.decode().split(",")
-                stations[int(f[7:9])].battery_current = float(battery_current.strip())
-                stations[int(f[7:9])].charging_current = float(charging_current.strip())
-                stations[int(f[7:9])].battery_capacity = float(capacity.strip())
-
-        car_dataset = [x for x in car_dataset if int(x[1]) > (i * READ_DELAY)]
-
-        if zeka_bus and openevse_arrived:
-            zeka_thread = Thread(target=zeka_control)
+        if sim.zeka_bus and openevse_arrived:
+            zeka_thread = Thread(target=sim.zeka_control)
             zeka_thread.start()
-        if openevse and openevse_arrived:
-            wait_for_car(args.user_port, True)
+        if sim.chargers and openevse_arrived:
+            sim.wait_for_car(args.user_port, True)
 
-    read_thread = Thread(target=read, args=(args.fast_sim, args.log)) # every two seconds
-    state_control_thread = Thread(target=state_control, args=(args.fast_sim,))
+    if args.event_sim or args.fast_sim:
+        publish_status_thread = Thread(target=sim.publish_status, args=(2, args.visualization_port), daemon=True)
+        publish_status_thread.start()
 
-    read_thread.start()
-    state_control_thread.start()
+        if args.event_sim:
+            sim.run_events(args.log)
+        else:
+            sim.run_ticks(args.log)
+    else:
+        read_thread = Thread(target=sim.read, args=(args.log,)) # every two seconds
+        state_control_thread = Thread(target=sim.state_control)
 
-    if not args.fast_sim:
-        if openevse and not openevse_arrived:
-            wait_for_car_thread = Thread(target=wait_for_car, args=(args.user_port, False))
+        read_thread.start()
+        state_control_thread.start()
+
+        if sim.chargers and not openevse_arrived:
+            wait_for_car_thread = Thread(target=sim.wait_for_car, args=(args.user_port, False))
             wait_for_car_thread.start()
-        if zeka_bus and not openevse_arrived:
-            zeka_thread = Thread(target=zeka_control)
+        if sim.zeka_bus and not openevse_arrived:
+            zeka_thread = Thread(target=sim.zeka_control)
             zeka_thread.start()
 
-    publish_status_thread = Thread(target=publish_status, args=(2, args.visualization_port))
-    publish_status_thread.start()
+        publish_status_thread = Thread(target=sim.publish_status, args=(2, args.visualization_port))
+        publish_status_thread.start()
+
+        read_thread.join()
 
-    read_thread.join()
+    if sim.log_writer:
+        sim.log_writer.close()
+    if sim.metrics:
+        sim.metrics.close()
+    if sim.chargers:
+        sim.chargers.report()
+        sim.chargers.close()
 
     print("Log: Building dataset complete")
@@ -1,14 +1,14 @@
 import sys
-import socket
-import pickle
-import curses
-import signal
-from datetime import datetime	
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import requests
 
-from requests.api import post
-
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+from status_protocol import StatusDecoder
 
 
 # REST_API_URL = "https://api.powerbi.com/beta/0304ab7d-ac17-40f5-af5c-79da66b2889c/datasets/ec775be6-ca91-403b-b235-32a1c93980dd/rows?key=75hmJIaaIZ%2B0mhyhsT4iYkg64OUwcwcUFRLSu1RPS0dnBAxi%2FyvhtVCb1r%2FmX2vn4BSEhzr711Ql1nEl97QcEg%3D%3D"
@@ -16,92 +16,213 @@ s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 REST_API_URL ="https://api.powerbi.com/beta/0304ab7d-ac17-40f5-af5c-79da66b2889c/datasets/ec775be6-ca91-403b-b235-32a1c93980dd/rows?key=75hmJIaaIZ%2B0mhyhsT4iYkg64OUwcwcUFRLSu1RPS0dnBAxi%2FyvhtVCb1r%2FmX2vn4BSEhzr711Ql1nEl97QcEg%3D%3D"
 
 
-def signal_handler(sig, frame):
-    curses.endwin()
-    s.close()
-    sys.exit(0)
-
-
 def convert(seconds):
     seconds = seconds % (24 * 3600)
     hour = seconds // 3600
     seconds %= 3600
     minutes = seconds // 60
-      
-    return "%dh %02dmin" % (hour, minutes)
 
+    return "%dh %02dmin" % (hour, minutes)
 
 
-if __name__ == "__main__":
-    s.connect(("127.0.0.1", int(sys.argv[1])))
-    signal.signal(signal.SIGINT, signal_handler)
+def dashboard_row(visualization_info):
+    # one Power BI row for a status frame
+    now = datetime.strftime(datetime.now(), "%Y-%m-%dT%H:%M:%S%Z")
 
-    count =0
-    num = 0
+    row = {"timestamp": now,
+           "building_power": str(visualization_info["avail_building_power"]),
+           "total_power_used": str(visualization_info["total_power_used"]),
+           "total_buildingpower_used": str(visualization_info["total_building_power_used"])}
 
-    while True:
-        #Retrieve data from socket
-        data = s.recv(4096)
-        if len(data) == 0:
+    for car_id, car in visualization_info["cars"].items():
+        if car_id >4 or car_id==0: #skip station 0
             continue
-        visualization_info = pickle.loads(data)
-        print('=============')
-        print("visualization: ", visualization_info)
-
-        i = 1
-
-        now = datetime.strftime(datetime.now(), "%Y-%m-%dT%H:%M:%S%Z")
-        # now = visualization_info["current_time"]
 
-        #start JSON string (will be used to post data)
-        post_data= '[{{"timestamp": "{0}", "building_power": "{1}", "total_power_used":"{2}", "total_buildingpower_used": "{3}"'.format(now, visualization_info["building_power"], visualization_info["total_power_used"], visualization_info["total_buildingpower_used"])
-
-        for car_id, car in visualization_info["cars"].items():
-            # car_id=car_id+1
-            
-            if car_id >4 or car_id==0: #skip station 0
+        if car == 'empty':
+            car_name = 'Available Station'
+            car_delta_soc = "0"
+            car_status = "Available for charge"
+            car_current = "0"
+            car_battery = "0"
+            car_rem_time = convert(0)
+        else:
+            car_name = str(car["name"])
+            car_delta_soc = car["delta_soc"]
+            if car_delta_soc <= 0.1:
+                car_status = "Charged"
+            else:
+                car_status = "Charging..."
+
+            car_current = str(car["current"])
+            car_battery = str(car["battery"])
+            car_rem_time = convert(car["remaining_time"])
+
+        row["car_name" + str(car_id)] = str(car_name)
+        row["car_delta_soc" + str(car_id)] = str(car_delta_soc) + "%"
+        row["car_current" + str(car_id)] = car_current
+        row["car_battery" + str(car_id)] = str(car_battery)
+        row["car_rem_time" + str(car_id)] = str(car_rem_time)
+        row["car_status" + str(car_id)] = str(car_status)
+
+    return row
+
+
+class Uploader:
+    """Reads status frames and posts them to the REST API in batches.
+
+    A reader task turns frames into rows as fast as they arrive, into a queue of at most
+    max_rows rows. When the uploads fall behind and it is full, the oldest row waiting is
+    dropped: the dashboard only shows the latest status. The upload task posts up to
+    batch_size rows at a time (waiting at most batch_delay seconds to fill a batch) over one
+    keep-alive session. Batches that fail wait in a retry queue of at most max_retry batches,
+    the oldest batch is dropped when it is full, and are retried with exponential backoff
+    up to max_attempts times.
+    """
+
+    def __init__(self, url, batch_size=50, batch_delay=1.0, max_retry=100, max_attempts=8, backoff=1.0, max_backoff=60.0, timeout=10.0, max_rows=1000):
+        self.url = url
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_rows = max_rows
+        self.max_retry = max_retry
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        # one thread so batches go out in order on the pooled connection
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.rows = None
+        # rows are being dropped from a full queue
+        self.full = False
+        # (rows, attempts) of failed batches
+        self.retry = deque()
+        self.done = False
+        self.upload_done = False
+
+        self.uploaded = 0
+        self.dropped = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+
+    async def read(self, reader):
+        decoder = StatusDecoder()
+        while True:
+            visualization_info = await decoder.read_stream(reader)
+            if visualization_info is None:
+                break
+            if self.rows.full():
+                self.rows.get_nowait()
+                self.dropped += 1
+                if not self.full:
+                    print("Warn: upload queue full, dropping the oldest rows")
+                    self.full = True
+            else:
+                self.full = False
+            self.rows.put_nowait((time.time(), dashboard_row(visualization_info)))
+        self.done = True
+
+    async def post(self, batch):
+        # returns True if the API took the batch
+        data = json.dumps([row for _, row in batch])
+        loop = asyncio.get_running_loop()
+        try:
+            response = await loop.run_in_executor(self.executor, lambda: self.session.post(self.url, data=data, headers={"Content-Type": "application/json"}, timeout=self.timeout))
+        except requests.RequestException as ex:
+            print("Warn: upload failed: " + str(ex))
+            return False
+        if not response.ok:
+            print("Warn: upload failed: " + str(response.status_code))
+            return False
+
+        now = time.time()
+        for received, _ in batch:
+            self.lag_total += now - received
+            self.lag_max = max(self.lag_max, now - received)
+        self.uploaded += len(batch)
+        return True
+
+    def queue_retry(self, batch, attempts):
+        # batch failed its attempts-th post
+        if attempts >= self.max_attempts:
+            self.dropped += len(batch)
+            print("Warn: gave up on " + str(len(batch)) + " rows after " + str(attempts) + " attempts")
+            return
+        if len(self.retry) >= self.max_retry:
+            dropped, _ = self.retry.popleft()
+            self.dropped += len(dropped)
+            print("Warn: retry queue full, dropped " + str(len(dropped)) + " rows")
+        self.retry.append((batch, attempts))
+
+    async def upload(self):
+        while not (self.done and self.rows.empty()):
+            batch = []
+            deadline = time.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.rows.get(), max(0, deadline - time.time())))
+                except asyncio.TimeoutError:
+                    break
+                if self.done and self.rows.empty():
+                    break
+            if batch and not await self.post(batch):
+                self.queue_retry(batch, 1)
+        self.upload_done = True
+
+    async def resend(self):
+        while not (self.upload_done and not self.retry):
+            if not self.retry:
+                await asyncio.sleep(self.batch_delay)
+                continue
+            batch, attempts = self.retry[0]
+            await asyncio.sleep(min(self.backoff * 2 ** (attempts - 1), self.max_backoff))
+            if not self.retry or self.retry[0][0] is not batch:
                 continue
-            print(car)
-            print('----------------')
-
-            if car == 'empty':
-                car_name = 'Available Station'
-                car_delta_soc = "0"
-                car_status = "Available for charge"
-                car_current = "0"
-                car_battery = "0"
-                car_rem_time = convert(0)
+            self.retry.popleft()
+            if await self.post(batch):
+                continue
+            if attempts + 1 < self.max_attempts:
+                self.retry.appendleft((batch, attempts + 1))
             else:
-                car_name = str(car["name"])
-                car_delta_soc = car["delta_soc"]
-                if car_delta_soc <= 0.1:
-                    car_status = "Charged"
-                else:
-                    car_status = "Charging..."
-
-                         
-                car_current = str(car["current"])
-                car_battery = str(car["battery"])
-                car_rem_time = convert(car["remaining_time"])
-            
-            sub_data = ', "car_name{0}": "{1}", "car_delta_soc{0}": "{2}%", "car_current{0}": "{3}", "car_battery{0}": "{4}", "car_rem_time{0}": "{5}", "car_status{0}": "{6}" '.format(car_id, str(car_name), str(car_delta_soc), car_current, str(car_battery), str(car_rem_time), str(car_status) )
-            post_data += sub_data
-            i += 1
-        
-        post_data += '}]'
-
-        # make HTTP POST request to Power BI REST API
-        req = requests.post(REST_API_URL, post_data)
-        
-        count +=1
-        print("count: ", count)
-        print("POST: {0}".format(post_data))
-        print("req status ====")
-        print(req)
-        print('=============')
-
-        
-
-
+                self.queue_retry(batch, attempts + 1)
+
+    async def report(self, interval):
+        last_uploaded = 0
+        while True:
+            await asyncio.sleep(interval)
+            lag = self.lag_total / self.uploaded if self.uploaded else 0
+            print("Log: " + "%.1f" % ((self.uploaded - last_uploaded) / interval) + " rows/s, lag(s) avg: " + "%.2f" % lag + " max: " + "%.2f" % self.lag_max
+                  + ", " + str(sum(len(batch) for batch, _ in self.retry)) + " rows waiting to retry, " + str(self.dropped) + " dropped")
+            last_uploaded = self.uploaded
+
+    async def run(self, host, port, report_interval=10):
+        self.rows = asyncio.Queue(self.max_rows)
+        reader, writer = await asyncio.open_connection(host, port)
+        reporter = asyncio.ensure_future(self.report(report_interval))
+        try:
+            await asyncio.gather(self.read(reader), self.upload(), self.resend())
+        finally:
+            reporter.cancel()
+            writer.close()
+            self.executor.shutdown()
+            self.session.close()
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Upload CMS status to the Power BI dashboard')
+    parser.add_argument("port", type=int, help="CMS visualization port")
+    parser.add_argument("--url", dest="url", default=REST_API_URL, help="REST API to post rows to (default: Power BI dataset)")
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=50, help="Most rows in one POST (default: %(default)s)")
+    parser.add_argument("--batch-delay", dest="batch_delay", type=float, default=1.0, help="Seconds to wait for a batch to fill (default: %(default)s)")
+    parser.add_argument("--max-retry", dest="max_retry", type=int, default=100, help="Failed batches kept for retrying (default: %(default)s)")
+    parser.add_argument("--max-attempts", dest="max_attempts", type=int, default=8, help="Times a batch is posted before its rows are dropped (default: %(default)s)")
+    parser.add_argument("--max-rows", dest="max_rows", type=int, default=1000, help="Rows waiting to be uploaded, the oldest is dropped when more arrive (default: %(default)s)")
+    parser.add_argument("--report-interval", dest="report_interval", type=float, default=10, help="Seconds between rows/s and lag reports (default: %(default)s)")
+    args = parser.parse_args()
+
+    uploader = Uploader(args.url, args.batch_size, args.batch_delay, args.max_retry, args.max_attempts, max_rows=args.max_rows)
+    try:
+        asyncio.run(uploader.run("127.0.0.1", args.port, args.report_interval))
+    except KeyboardInterrupt:
+        sys.exit(0)
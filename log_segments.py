@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import zlib
+import gzip
+import argparse
+
+from log_writer import LogWriter
+from binlog import seconds
+
+# Segmented logs: <directory>/<stream>/<segment>.txt while the segment is being written, then
+# <segment>.txt.gz made of gzip members of CHUNK_ROWS rows. <stream>/index.jsonl has a line per
+# member: {"file", "first", "last", "offset", "size"} with first and last as tick numbers.
+# segments.json has the start time, read delay and segment length of the run.
+META = "segments.json"
+INDEX = "index.jsonl"
+CHUNK_ROWS = 500
+
+def time_string(start, read_delay, tick):
+    # hh:mm:ss of a tick, as written by the CMS
+    current = int(start + tick * read_delay) % 86400
+    return "%02d:%02d:%02d" % (current // 3600, current % 3600 // 60, current % 60)
+
+def row_ticks(start, read_delay, first, lines):
+    # ticks of consecutive log lines starting at tick first, which is less than a day before them
+    base = seconds(time_string(start, read_delay, first))
+    return [first + int(((seconds(line[:line.index(",")]) - base) % 86400) // read_delay) for line in lines]
+
+class SegmentedLogWriter(LogWriter):
+    """LogWriter that splits each stream into segments of segment_ticks ticks.
+
+    A segment is plain text while its ticks are being logged. Once the log moves past it, it
+    is compressed and its members are added to the stream's index, so query() only has to
+    decompress the part of a long run it is asked for. With keep, only the newest keep
+    compressed segments of each stream are kept on disk.
+    """
+
+    def __init__(self, directory, start, read_delay, segment_ticks, keep=0, **kwargs):
+        if segment_ticks * read_delay > 86400:
+            raise ValueError("log segments can be at most a day long")
+        self.start = start
+        self.read_delay = read_delay
+        self.segment_ticks = segment_ticks
+        self.keep = keep
+        # stream: segment number being written
+        self.segments = {}
+        with open(os.path.join(directory, META), "w") as f:
+            json.dump({"start": start, "read_delay": read_delay, "segment_ticks": segment_ticks}, f)
+        super().__init__(directory, lambda tick: time_string(start, read_delay, tick), **kwargs)
+
+    def segment_path(self, stream, segment):
+        return os.path.join(self.directory, stream, "%06d.txt" % segment)
+
+    def open_stream(self, stream):
+        path = self.segment_path(stream, self.segments[stream])
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return open(path, self.mode)
+
+    def write_rows(self, stream, rows):
+        start = 0
+        while start < len(rows):
+            segment = rows[start][0] // self.segment_ticks
+            end = start + 1
+            while end < len(rows) and rows[end][0] // self.segment_ticks == segment:
+                end += 1
+            if self.segments.get(stream) != segment:
+                self.close_segment(stream)
+                self.segments[stream] = segment
+            super().write_rows(stream, rows[start:end])
+            start = end
+
+    def close_segment(self, stream):
+        # compresses the segment stream was writing, call with flush_mutex held
+        segment = self.segments.pop(stream, None)
+        if segment is None:
+            return
+        if stream in self.handles:
+            self.handles.pop(stream).close()
+        path = self.segment_path(stream, segment)
+        if not os.path.exists(path):
+            return
+
+        with open(path, "r") as f:
+            lines = f.readlines()
+        ticks = row_ticks(self.start, self.read_delay, segment * self.segment_ticks, lines)
+        entries = []
+        # appended to, a continued run can log a segment again. No mtime, so runs of the same data
+        # give the same files
+        with open(path + ".gz", "ab") as f:
+            for n in range(0, len(lines), CHUNK_ROWS):
+                offset = f.tell()
+                f.write(gzip.compress("".join(lines[n:n + CHUNK_ROWS]).encode(), mtime=0))
+                entries.append({"file": os.path.basename(path) + ".gz", "first": ticks[n], "last": ticks[min(n + CHUNK_ROWS, len(lines)) - 1], "offset": offset, "size": f.tell() - offset})
+        with open(os.path.join(self.directory, stream, INDEX), "a") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.remove(path)
+
+        if self.keep:
+            self.drop_old(stream)
+
+    def drop_old(self, stream):
+        directory = os.path.join(self.directory, stream)
+        compressed = sorted(f for f in os.listdir(directory) if f.endswith(".txt.gz"))
+        dropped = set(compressed[:-self.keep])
+        if not dropped:
+            return
+        for f in dropped:
+            os.remove(os.path.join(directory, f))
+        entries = [entry for entry in read_index(self.directory, stream) if entry["file"] not in dropped]
+        with open(os.path.join(directory, INDEX + ".tmp"), "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(os.path.join(directory, INDEX + ".tmp"), os.path.join(directory, INDEX))
+
+    def files(self):
+        # every file in the stream directories: segments, compressed segments and indexes
+        files = []
+        for stream in os.listdir(self.directory):
+            if os.path.isdir(os.path.join(self.directory, stream)):
+                files += [os.path.join(stream, f) for f in os.listdir(os.path.join(self.directory, stream))]
+        return files
+
+    def truncate(self, positions):
+        # As LogWriter.truncate(), but a segment compressed since the snapshot is first written
+        # back as text from the members appended to its .gz, and the index keeps only the
+        # members that are still whole.
+        with self.flush_mutex:
+            self.close_handles()
+            self.segments = {}
+            for f in positions:
+                path = os.path.join(self.directory, f)
+                if not f.endswith(".txt") or os.path.exists(path) or not os.path.exists(path + ".gz"):
+                    continue
+                with open(path + ".gz", "rb") as compressed:
+                    compressed.seek(positions.get(f + ".gz", 0))
+                    data = compressed.read()
+                with open(path, "wb") as text:
+                    text.write(gzip.decompress(data)[:positions[f]] if data else b"")
+
+            streams = set()
+            for f in self.files():
+                path = os.path.join(self.directory, f)
+                streams.add(os.path.dirname(f))
+                if f not in positions:
+                    os.remove(path)
+                elif os.path.getsize(path) > positions[f] and not f.endswith(INDEX):
+                    os.truncate(path, positions[f])
+
+            for stream in streams:
+                directory = os.path.join(self.directory, stream)
+                if not os.listdir(directory):
+                    os.rmdir(directory)
+                    continue
+                # the segment being written at the snapshot is carried on or compressed as before
+                for f in os.listdir(directory):
+                    if f.endswith(".txt"):
+                        self.segments[stream] = int(f[:-4])
+                entries = [entry for entry in read_index(self.directory, stream)
+                           if os.path.exists(os.path.join(directory, entry["file"])) and entry["offset"] + entry["size"] <= os.path.getsize(os.path.join(directory, entry["file"]))]
+                with open(os.path.join(directory, INDEX + ".tmp"), "w") as index:
+                    for entry in entries:
+                        index.write(json.dumps(entry) + "\n")
+                os.replace(os.path.join(directory, INDEX + ".tmp"), os.path.join(directory, INDEX))
+
+    def close(self):
+        super().close()
+        with self.flush_mutex:
+            for stream in list(self.segments):
+                self.close_segment(stream)
+
+def read_meta(directory):
+    with open(os.path.join(directory, META), "r") as f:
+        return json.load(f)
+
+def read_index(directory, stream):
+    path = os.path.join(directory, stream, INDEX)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def query(directory, stream, first, last):
+    """Rows of stream logged between ticks first and last (inclusive) as (tick, line) pairs.
+
+    Only the compressed members whose tick range overlaps the window are read and
+    decompressed, plus any segment still being written.
+    """
+    meta = read_meta(directory)
+    rows = []
+
+    def add(start_tick, lines):
+        for tick, line in zip(row_ticks(meta["start"], meta["read_delay"], start_tick, lines), lines):
+            if first <= tick <= last:
+                rows.append((tick, line.rstrip("\n")))
+
+    for entry in read_index(directory, stream):
+        if entry["last"] < first or entry["first"] > last:
+            continue
+        with open(os.path.join(directory, stream, entry["file"]), "rb") as f:
+            f.seek(entry["offset"])
+            data = zlib.decompress(f.read(entry["size"]), 16 + zlib.MAX_WBITS)
+        add(entry["first"], data.decode().splitlines())
+
+    stream_directory = os.path.join(directory, stream)
+    if os.path.isdir(stream_directory):
+        for f in sorted(os.listdir(stream_directory)):
+            if not f.endswith(".txt"):
+                continue
+            segment_first = int(f[:-4]) * meta["segment_ticks"]
+            if segment_first > last or segment_first + meta["segment_ticks"] <= first:
+                continue
+            with open(os.path.join(stream_directory, f), "r") as text:
+                add(segment_first, text.readlines())
+
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+def window_tick(meta, time, day):
+    # first tick at hh:mm:ss on the given day of the run
+    return int((day * 86400 + (seconds(time) - meta["start"]) % 86400) // meta["read_delay"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Print the rows of a segmented CMS log in a time window')
+    parser.add_argument("directory", help="Log directory written with --log-segment")
+    parser.add_argument("stream", help="Stream, e.g. sim01, station03 or power_use")
+    parser.add_argument("--from", dest="start", required=True, help="Start of the window (hh:mm:ss)")
+    parser.add_argument("--to", dest="end", required=True, help="End of the window (hh:mm:ss)")
+    parser.add_argument("--day", dest="day", type=int, default=0, help="Day of the run the window starts on, counted in 24 hours from the start time (default: %(default)s)")
+    args = parser.parse_args()
+
+    meta = read_meta(args.directory)
+    first = window_tick(meta, args.start, args.day)
+    last = window_tick(meta, args.end, args.day)
+    if last < first:
+        # window goes past midnight
+        last += 86400 // meta["read_delay"]
+    for tick, line in query(args.directory, args.stream, first, last):
+        print(line)
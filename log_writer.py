@@ -0,0 +1,140 @@
+import os
+from collections import OrderedDict
+from threading import Thread, Lock, RLock, Event
+
+class LogWriter:
+    """Buffers log rows per stream and appends them to <directory>/<stream>.txt.
+
+    A row is a tick index and a tuple of values. Rows are kept in memory and written by
+    a background thread every flush_interval seconds, or sooner once max_rows rows are
+    waiting. At most max_handles files are kept open, the least recently written one is
+    closed when another is needed. Call close() at the end of the run to write what is left.
+
+    positions() flushes and returns the size of every log file, which a snapshot keeps so
+    that truncate() can cut the logs back to its tick when the run is continued.
+    """
+
+    extension = ".txt"
+    mode = "a"
+
+    def __init__(self, directory="logs", time_string=str, max_rows=50000, flush_interval=1.0, max_handles=256):
+        self.directory = directory
+        self.time_string = time_string
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.max_handles = max_handles
+
+        self.buffers = {}
+        self.pending = 0
+        self.buffers_mutex = Lock()
+        self.handles = OrderedDict()
+        # reentrant so positions() can flush and measure the files in one go
+        self.flush_mutex = RLock()
+        self.wake = Event()
+        self.closed = False
+        self.last_tick = None
+        self.last_time = ""
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, stream, tick, values):
+        with self.buffers_mutex:
+            if not self.closed:
+                if stream in self.buffers:
+                    self.buffers[stream].append((tick, values))
+                else:
+                    self.buffers[stream] = [(tick, values)]
+                self.pending += 1
+                if self.pending >= self.max_rows:
+                    self.wake.set()
+                return
+
+        # late writers (e.g. the Zeka thread) after close() go straight to disk
+        with self.flush_mutex:
+            self.write_rows(stream, [(tick, values)])
+            self.close_handles()
+
+    def encode(self, stream, rows):
+        # time, value, value, ... as written by the CMS before logs were buffered
+        lines = []
+        for tick, values in rows:
+            if tick != self.last_tick:
+                self.last_tick = tick
+                self.last_time = self.time_string(tick)
+            lines.append(self.last_time + ", " + ", ".join([str(value) for value in values]) + "\n")
+        return "".join(lines)
+
+    def open_stream(self, stream):
+        return open(os.path.join(self.directory, stream + self.extension), self.mode)
+
+    def handle(self, stream):
+        if stream in self.handles:
+            self.handles.move_to_end(stream)
+            return self.handles[stream]
+
+        if len(self.handles) >= self.max_handles:
+            _, file = self.handles.popitem(last=False)
+            file.close()
+        file = self.open_stream(stream)
+        self.handles[stream] = file
+        return file
+
+    def flush(self):
+        with self.buffers_mutex:
+            buffers = self.buffers
+            self.buffers = {}
+            self.pending = 0
+
+        with self.flush_mutex:
+            for stream, rows in buffers.items():
+                self.write_rows(stream, rows)
+            for file in self.handles.values():
+                file.flush()
+
+    def write_rows(self, stream, rows):
+        # call with flush_mutex held
+        self.handle(stream).write(self.encode(stream, rows))
+
+    def files(self):
+        # log files this writer appends to, relative to directory
+        return [f for f in os.listdir(self.directory) if f.endswith(self.extension)]
+
+    def positions(self):
+        # flushes, then {file: size} of every log file, where the logs end at this tick
+        with self.flush_mutex:
+            self.flush()
+            return {f: os.path.getsize(os.path.join(self.directory, f)) for f in self.files()}
+
+    def truncate(self, positions):
+        # cuts the logs back to positions(), before the first row of a continued run is written
+        with self.flush_mutex:
+            self.close_handles()
+            for f in self.files():
+                path = os.path.join(self.directory, f)
+                if f not in positions:
+                    # stream started after the snapshot
+                    os.remove(path)
+                elif os.path.getsize(path) > positions[f]:
+                    os.truncate(path, positions[f])
+
+    def close_handles(self):
+        for file in self.handles.values():
+            file.close()
+        self.handles.clear()
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self):
+        with self.buffers_mutex:
+            self.closed = True
+        self.wake.set()
+        self.thread.join()
+
+        self.flush()
+        with self.flush_mutex:
+            self.close_handles()
@@ -0,0 +1,147 @@
+from collections import deque
+
+import numpy as np
+
+def sliding_max(loads, window):
+    """Highest load of every window of window ticks, one per tick a complete window starts at.
+
+    Loads are split into blocks of window ticks, and the running maximum from the start
+    and from the end of each block is taken. A window covers the end of one block and the
+    start of the next, so its maximum is the larger of those two runs (van Herk/Gil-Werman),
+    O(1) per tick whatever the window.
+    """
+    count = len(loads) - window + 1
+    if window < 1 or count < 1:
+        return np.empty(0)
+    blocks = -(-len(loads) // window)
+    padded = np.full(blocks * window, -np.inf)
+    padded[:len(loads)] = loads
+    padded = padded.reshape(blocks, window)
+    from_start = np.maximum.accumulate(padded, axis=1).ravel()
+    from_end = np.maximum.accumulate(padded[:, ::-1], axis=1)[:, ::-1].ravel()
+    return np.maximum(from_end[:count], from_start[window - 1:window - 1 + count])
+
+def sliding_min(loads, window):
+    # lowest load of every complete window, see sliding_max()
+    return -sliding_max(-np.asarray(loads, dtype=float), window)
+
+def grow(buffer, used, size):
+    # buffer with room for size values and its first used values, at least doubled when it
+    # has to be copied so adding values one at a time is amortised O(1)
+    if len(buffer) >= size and buffer.flags.writeable:
+        return buffer
+    grown = np.empty(max(size, 2 * used, 64))
+    grown[:used] = buffer[:used]
+    return grown
+
+class Headroom:
+    """Aggregates of the building load, for planning against the load still to come.
+
+    prefix[t] is the sum of the first t loads, so the load summed over any ticks is one
+    subtraction, and window_min and window_max hold the lowest and highest load of the
+    window of window ticks starting at each tick (see sliding_max()). Loads are kW, as in
+    the building dataset, which is used as it is (a memory mapped dataset is not copied).
+
+    Readings added later (e.g. measured live) with append() or extend() go into buffers that
+    double when full. Windows they complete come from a monotonic deque each: a tick's load
+    leaves its deque for good once a later load is at least as low (or high), so append() is
+    amortised O(1). extend() with a window or more of loads works blockwise as above.
+    """
+
+    def __init__(self, window, loads=()):
+        self.window = window
+        self.loads = np.asarray(loads, dtype=float)
+        self.prefix = np.concatenate(([0.0], np.cumsum(self.loads)))
+        self.window_min = sliding_min(self.loads, window)
+        self.window_max = sliding_max(self.loads, window)
+        # what the arrays above are views of once loads are added
+        self.load_buffer = self.loads
+        self.prefix_buffer = self.prefix
+        self.min_buffer = self.window_min
+        self.max_buffer = self.window_max
+        # ticks of the window being filled whose load can still be its lowest / highest, loads
+        # increasing / decreasing. None until append() needs them.
+        self.low = None
+        self.high = None
+
+    def __len__(self):
+        return len(self.loads)
+
+    def push(self, tick):
+        # adds tick to the deques, dropping the tick that left the window
+        load = self.loads[tick]
+        while self.low and self.loads[self.low[-1]] >= load:
+            self.low.pop()
+        self.low.append(tick)
+        while self.high and self.loads[self.high[-1]] <= load:
+            self.high.pop()
+        self.high.append(tick)
+        if self.low[0] <= tick - self.window:
+            self.low.popleft()
+        if self.high[0] <= tick - self.window:
+            self.high.popleft()
+
+    def extend(self, loads):
+        loads = np.asarray(loads, dtype=float)
+        start = len(self.loads)
+        end = start + len(loads)
+        if end == start:
+            return
+
+        self.load_buffer = grow(self.load_buffer, start, end)
+        self.load_buffer[start:end] = loads
+        self.loads = self.load_buffer[:end]
+        # summed on from the last prefix, as one cumsum over all the loads would
+        self.prefix_buffer = grow(self.prefix_buffer, start + 1, end + 1)
+        self.prefix_buffer[start:end + 1] = np.cumsum(np.concatenate((self.prefix_buffer[start:start + 1], loads)))
+        self.prefix = self.prefix_buffer[:end + 1]
+
+        done = len(self.window_max)
+        count = max(end - self.window + 1, 0)
+        self.min_buffer = grow(self.min_buffer, done, count)
+        self.max_buffer = grow(self.max_buffer, done, count)
+        if len(loads) >= self.window:
+            self.min_buffer[done:count] = sliding_min(self.loads[done:], self.window)
+            self.max_buffer[done:count] = sliding_max(self.loads[done:], self.window)
+            self.low = self.high = None
+        else:
+            if self.low is None:
+                self.low, self.high = deque(), deque()
+                for tick in range(max(start - self.window + 1, 0), start):
+                    self.push(tick)
+            for tick in range(start, end):
+                self.push(tick)
+                first = tick - self.window + 1
+                if first >= 0:
+                    self.min_buffer[first] = self.loads[self.low[0]]
+                    self.max_buffer[first] = self.loads[self.high[0]]
+        self.window_min = self.min_buffer[:count]
+        self.window_max = self.max_buffer[:count]
+
+    def append(self, load):
+        self.extend((load,))
+
+    def total(self, first, last):
+        # load summed over ticks first to last (exclusive), clipped to the known loads
+        first = min(max(first, 0), len(self.loads))
+        last = min(max(last, first), len(self.loads))
+        return float(self.prefix[last] - self.prefix[first])
+
+    def count(self, first, last):
+        first = min(max(first, 0), len(self.loads))
+        return min(max(last, first), len(self.loads)) - first
+
+    def minimum(self, tick):
+        # lowest load in the window from tick on, of the loads left if it is not complete
+        if tick < len(self.window_min):
+            return float(self.window_min[tick])
+        if tick >= len(self.loads):
+            return 0.0
+        return float(self.loads[tick:].min())
+
+    def maximum(self, tick):
+        if tick < len(self.window_max):
+            return float(self.window_max[tick])
+        if tick >= len(self.loads):
+            return 0.0
+        return float(self.loads[tick:].max())
@@ -0,0 +1,190 @@
+from bisect import bisect_left
+from time import perf_counter
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# histogram bucket bounds (s), the last bucket is +Inf
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0)
+
+# columns of the trace file after the tick number, in tick order. total is the whole tick.
+PHASES = ["total", "read_chargers", "measure", "discharge", "allocate", "setpoints", "charge", "engine", "publish", "log", "control"]
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+    def lines(self, name, labels):
+        lines = []
+        total = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), self.counts):
+            total += count
+            lines.append(name + "_bucket{" + labels + ("," if labels else "") + 'le="' + str(bound) + '"} ' + str(total))
+        labels = "{" + labels + "}" if labels else ""
+        lines.append(name + "_sum" + labels + " " + repr(self.sum))
+        lines.append(name + "_count" + labels + " " + str(self.count))
+        return lines
+
+class TickMetrics:
+    """Timers for the phases of each tick, overruns, cars_mutex waits and control latency.
+
+    The tick loop calls begin() and lap() around its phases; the Simulation only calls in
+    here when metrics are on, so a run without them pays one attribute check per phase.
+    exposition() is the Prometheus text format served by serve(). With a trace file every
+    tick is also written as one CSV row of phase times in ms.
+    """
+
+    def __init__(self, trace_file=None):
+        self.phases = {phase: Histogram() for phase in PHASES}
+        # thread taking cars_mutex: Histogram of the time it waited for it
+        self.lock_wait = {}
+        self.control_latency = Histogram()
+        self.ticks = 0
+        self.overruns = 0
+        self.overrun_seconds = 0.0
+        self.last_tick = 0
+
+        self.trace = None
+        if trace_file:
+            self.trace = open(trace_file, "w")
+            self.trace.write("tick," + ",".join(PHASES) + "\n")
+        self.record = None
+        self.started = 0.0
+        self.mark = 0.0
+        self.nested = 0.0
+        self.server = None
+
+    def begin(self, tick_no):
+        self.flush()
+        self.last_tick = tick_no
+        self.ticks += 1
+        self.record = {"": tick_no}
+        self.started = self.mark = perf_counter()
+        self.nested = 0.0
+
+    def add(self, phase, seconds):
+        self.phases[phase].observe(seconds)
+        # the control thread adds to the record the tick thread is replacing
+        record = self.record
+        if record is not None:
+            record[phase] = record.get(phase, 0.0) + seconds
+
+    def lap(self, phase):
+        # time since the last lap goes to phase, less what inner() already counted
+        now = perf_counter()
+        self.add(phase, now - self.mark - self.nested)
+        self.mark = now
+        self.nested = 0.0
+
+    def inner(self, phase, seconds):
+        # a phase timed inside another one, e.g. charger setpoints during allocation
+        self.add(phase, seconds)
+        self.nested += seconds
+
+    def end(self):
+        self.add("total", perf_counter() - self.started)
+
+    def overrun(self, seconds):
+        self.overruns += 1
+        self.overrun_seconds += seconds
+
+    def waited(self, thread, seconds):
+        if thread not in self.lock_wait:
+            self.lock_wait[thread] = Histogram()
+        self.lock_wait[thread].observe(seconds)
+
+    def flush(self):
+        if self.trace and self.record is not None:
+            self.trace.write(str(self.record[""]) + "," + ",".join("%.3f" % (self.record.get(phase, 0.0) * 1000) for phase in PHASES) + "\n")
+        self.record = None
+
+    def totals(self):
+        # copy of the counters, what exposition() shows. Picklable, so a multi-site worker can
+        # send it to the process serving /metrics.
+        return {"last_tick": self.last_tick,
+                "ticks": self.ticks,
+                "overruns": self.overruns,
+                "overrun_seconds": self.overrun_seconds,
+                "phases": {phase: histogram.copy() for phase, histogram in self.phases.items()},
+                "lock_wait": {thread: histogram.copy() for thread, histogram in list(self.lock_wait.items())},
+                "control_latency": self.control_latency.copy()}
+
+    def exposition(self):
+        return exposition({"": self.totals()})
+
+    def serve(self, port, host="127.0.0.1"):
+        self.server = serve(port, self.exposition, host)
+
+    def close(self):
+        self.flush()
+        if self.trace:
+            self.trace.close()
+            self.trace = None
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def join_labels(*labels):
+    return ",".join(label for label in labels if label)
+
+def exposition(sites):
+    """Prometheus text format for {labels: TickMetrics.totals()}.
+
+    labels is "" for a single CMS, or e.g. 'site="north"' to show several side by side.
+    """
+    lines = []
+    for name, kind, key, text in [("cms_tick", "gauge", "last_tick", "Last tick started"),
+                                  ("cms_ticks_total", "counter", "ticks", "Ticks run"),
+                                  ("cms_tick_overruns_total", "counter", "overruns", "Ticks that took longer than the read delay"),
+                                  ("cms_tick_overrun_seconds_total", "counter", "overrun_seconds", "Time past the read delay of overrun ticks")]:
+        lines += ["# HELP " + name + " " + text, "# TYPE " + name + " " + kind]
+        for labels, totals in sites.items():
+            lines.append(name + ("{" + labels + "}" if labels else "") + " " + repr(totals[key]))
+
+    lines += ["# HELP cms_phase_seconds Time spent in each phase of a tick", "# TYPE cms_phase_seconds histogram"]
+    for labels, totals in sites.items():
+        for phase in PHASES:
+            lines += totals["phases"][phase].lines("cms_phase_seconds", join_labels(labels, 'phase="' + phase + '"'))
+    lines += ["# HELP cms_lock_wait_seconds Time waited for cars_mutex", "# TYPE cms_lock_wait_seconds histogram"]
+    for labels, totals in sites.items():
+        for thread in sorted(totals["lock_wait"]):
+            lines += totals["lock_wait"][thread].lines("cms_lock_wait_seconds", join_labels(labels, 'thread="' + thread + '"'))
+    lines += ["# HELP cms_control_latency_seconds From the tick waking state control to its control step finishing", "# TYPE cms_control_latency_seconds histogram"]
+    for labels, totals in sites.items():
+        lines += totals["control_latency"].lines("cms_control_latency_seconds", labels)
+    return "\n".join(lines) + "\n"
+
+def serve(port, exposition, host="127.0.0.1"):
+    # serves exposition() at http://host:port/metrics from a daemon thread, returns the server
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = exposition().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import queue
+import argparse
+import threading
+import multiprocessing
+import can
+from threading import Thread, Lock
+from time import sleep, monotonic
+from serial import Serial
+
+import cms
+from lookahead import Headroom
+from log_writer import LogWriter
+from rapi import RapiClient
+from charger_pool import ChargerPool
+from metrics import TickMetrics, exposition, serve
+from status_protocol import StatusEncoder, TOTALS
+from status_server import StatusServer
+
+# A manifest is a JSON list of sites, e.g.
+#   [{"name": "north", "building_dataset": "north_building.txt", "car_dataset": "north_cars.txt",
+#     "mode": "event", "log": "logs/north"},
+#    {"name": "lab", "building_dataset": "lab.txt", "car_dataset": "lab_cars.txt",
+#     "chargers": {"0": "/dev/ttyUSB0"}, "zeka_port": "/dev/ttyACM0", "user_port": 5001}]
+# Only name and the two datasets are required, the rest default to SITE_DEFAULTS. mode is
+# "real" (every READ_DELAY seconds, with hardware), "fast" or "event" as with --fast-sim and
+# --event-sim.
+SITE_DEFAULTS = {"start_time": "18:00:00", "mode": "real", "log": "", "allocator": "greedy", "plan": "now",
+                 "chargers": {}, "charger_deadline": 0.5, "zeka_port": "", "user_port": 0}
+MODES = ["real", "fast", "event"]
+
+def load_manifest(path):
+    with open(path, "r") as f:
+        sites = json.load(f)
+    names = set()
+    for n, site in enumerate(sites):
+        for key in ["name", "building_dataset", "car_dataset"]:
+            if key not in site:
+                raise ValueError("site " + str(n) + " has no " + key)
+        if site["name"] in names:
+            raise ValueError("two sites are named " + site["name"])
+        names.add(site["name"])
+        for key, value in SITE_DEFAULTS.items():
+            site.setdefault(key, value)
+        if site["mode"] not in MODES:
+            raise ValueError("site " + site["name"] + " has mode " + site["mode"] + ", not one of " + ", ".join(MODES))
+    return sites
+
+class SiteOutput:
+    """stdout of a worker, each line prefixed with the site of the thread that printed it.
+
+    Sites run on threads named "<site>" or "<site>:<role>", lines from any other thread
+    have no prefix. print() writes a line in pieces, so they are joined per thread first.
+    """
+
+    def __init__(self, stream, sites):
+        self.stream = stream
+        self.sites = set(sites)
+        self.local = threading.local()
+        self.mutex = Lock()
+
+    def write(self, text):
+        pending = getattr(self.local, "pending", "") + text
+        lines = pending.split("\n")
+        self.local.pending = lines.pop()
+        if lines:
+            site = threading.current_thread().name.split(":")[0]
+            prefix = "[" + site + "] " if site in self.sites else ""
+            with self.mutex:
+                self.stream.write("".join(prefix + line + "\n" for line in lines))
+                self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        pass
+
+def open_site(site, metrics):
+    # Simulation for a site, set up as cms.py sets it up from the command line
+    sim = cms.Simulation(start=site["start_time"])
+    sim.load_building(site["building_dataset"])
+    sim.load_cars(site["car_dataset"])
+    sim.allocator = site["allocator"]
+    if site["plan"] == "lookahead":
+        sim.headroom = Headroom(cms.PLAN_WINDOW // cms.READ_DELAY, sim.building_dataset)
+    if metrics:
+        sim.metrics = TickMetrics()
+
+    clients = {}
+    for station_no, port in site["chargers"].items():
+        try:
+            clients[int(station_no)] = RapiClient(Serial(port, 115200, xonxoff=True))
+        except Exception as ex:
+            print("Warn: cannot open charger " + str(station_no) + " on " + port + ": " + str(ex))
+    if clients:
+        sim.chargers = ChargerPool(clients, site["charger_deadline"])
+    if site["zeka_port"]:
+        try:
+            sim.zeka_bus = can.interface.Bus(bustype='slcan', channel=site["zeka_port"], bitrate=500000)
+        except Exception as ex:
+            print("Warn: cannot open Zeka on " + site["zeka_port"] + ": " + str(ex))
+
+    if site["log"]:
+        directory = site["log"]
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for f in os.listdir(directory):
+            if os.path.isfile(os.path.join(directory, f)):
+                os.remove(os.path.join(directory, f))
+        sim.log_writer = LogWriter(directory, lambda tick: sim.int_to_str(tick * cms.READ_DELAY))
+        sim.snapshot_path = os.path.join(directory, "snapshot.pickle")
+    return sim
+
+def run_site(site, sims, metrics):
+    # opens and runs a site to the end of its building dataset, on the thread named after it
+    name = site["name"]
+    try:
+        sim = open_site(site, metrics)
+    except Exception as ex:
+        print("Warn: cannot open site: " + str(ex))
+        return
+    sims[name] = sim
+    log = bool(site["log"])
+    if site["mode"] == "event":
+        sim.run_events(log)
+    elif site["mode"] == "fast":
+        sim.run_ticks(log)
+    else:
+        read_thread = Thread(target=sim.read, args=(log,), name=name + ":read")
+        state_control_thread = Thread(target=sim.state_control, name=name + ":control", daemon=True)
+        read_thread.start()
+        state_control_thread.start()
+        if sim.chargers and site["user_port"]:
+            Thread(target=sim.wait_for_car, args=(site["user_port"], False), name=name + ":user", daemon=True).start()
+        if sim.zeka_bus:
+            Thread(target=sim.zeka_control, name=name + ":zeka", daemon=True).start()
+        read_thread.join()
+
+    if sim.i > 0:
+        # the state of the last tick run, for the final report
+        sim.i -= 1
+        sim.state_wanted = True
+        sim.publish_state()
+        sim.i += 1
+
+    if sim.log_writer:
+        sim.log_writer.close()
+    if sim.metrics:
+        sim.metrics.close()
+    if sim.chargers:
+        sim.chargers.report()
+        sim.chargers.close()
+    print("Log: Building dataset complete")
+
+def report(site, sim, messages):
+    # what the parent aggregates, sent from the worker every period
+    state = sim.state
+    sim.state_wanted = True
+    if state is None:
+        return
+    messages.put(("status", site["name"], sim.status(state), sim.metrics.totals() if sim.metrics else None))
+
+def run_shard(sites, messages, period, metrics):
+    # Worker process: runs its sites on one thread each and reports them every period seconds
+    sys.stdout = SiteOutput(sys.stdout, [site["name"] for site in sites])
+
+    # site name: Simulation, once the site has loaded
+    sims = {}
+    running = []
+    for site in sites:
+        thread = Thread(target=run_site, args=(site, sims, metrics), name=site["name"])
+        thread.start()
+        running.append((site, thread))
+
+    while running:
+        sleep(period)
+        for site, thread in list(running):
+            # checked first so a site that just finished still sends its last state
+            finished = not thread.is_alive()
+            sim = sims.get(site["name"])
+            if sim:
+                report(site, sim, messages)
+            if finished:
+                running.remove((site, thread))
+                messages.put(("done", site["name"], sim.departed if sim else None))
+
+def shards(sites, workers):
+    # sites split round robin between at most workers shards
+    workers = max(1, min(workers, len(sites)))
+    return [sites[n::workers] for n in range(workers)]
+
+def station_offsets(sites):
+    # first combined station number of each site, in manifest order. A site has a station for
+    # each line of its car dataset plus station 0, as in Simulation.load_cars().
+    offsets = {}
+    offset = 0
+    for site in sites:
+        offsets[site["name"]] = offset
+        with open(site["car_dataset"], "r") as f:
+            offset += sum(1 for line in f) + 1
+    return offsets, offset
+
+def combine(sites, statuses, offsets, num_stations, done):
+    """One status dict of every site, for the visualization stream.
+
+    Stations are numbered one site after another in manifest order and car names are
+    prefixed with their site. Totals are summed. The time is that of the running site
+    furthest behind, or of the last one to end once all are done. The remaining time of
+    each car is its own.
+    """
+    reported = [statuses[site["name"]] for site in sites if site["name"] in statuses]
+    running = [statuses[site["name"]] for site in sites if site["name"] in statuses and site["name"] not in done]
+    if running:
+        behind = min(running, key=lambda info: info["elapsed"])
+    else:
+        behind = max(reported, key=lambda info: info["elapsed"])
+    info = {"current_time": behind["current_time"], "elapsed": behind["elapsed"], "cars": {}}
+    for key in TOTALS:
+        info[key] = sum(status[key] for status in reported)
+    for site in sites:
+        status = statuses.get(site["name"])
+        if status is None:
+            continue
+        for station_no, car in status["cars"].items():
+            if car != "empty":
+                car = dict(car, name=site["name"] + "/" + str(car["name"]))
+            info["cars"][offsets[site["name"]] + station_no] = car
+    for num in range(num_stations):
+        if num not in info["cars"]:
+            info["cars"][num] = "empty"
+    return info
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the CMS for every site in a manifest, with one status stream and metrics for all of them')
+    parser.add_argument("manifest", help="JSON list of sites, see the top of multisite.py")
+    parser.add_argument("--workers", dest="workers", type=int, default=os.cpu_count(), help="Worker processes, sites are split between them (default: %(default)s)")
+    parser.add_argument("--visualization-port", "--vp", dest="visualization_port", type=int, default=5000, help="Port of the combined status stream (default: %(default)s)")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, default=0, help="Serve every site's tick timings in Prometheus format, labelled by site, on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--period", dest="period", type=float, default=2, help="Seconds between site reports and combined status frames (default: %(default)s)")
+    args = parser.parse_args()
+
+    try:
+        sites = load_manifest(args.manifest)
+        offsets, num_stations = station_offsets(sites)
+    except Exception as ex:
+        print("Cannot open manifest: " + str(ex))
+        exit(0)
+
+    messages = multiprocessing.Queue()
+    workers = []
+    for shard in shards(sites, args.workers):
+        worker = multiprocessing.Process(target=run_shard, args=(shard, messages, args.period, bool(args.metrics_port)))
+        worker.start()
+        workers.append((worker, [site["name"] for site in shard]))
+    print("Log: Running " + str(len(sites)) + " sites on " + str(len(workers)) + " workers")
+
+    # latest status and metrics totals of each site
+    statuses = {}
+    totals = {}
+    done = set()
+    server = StatusServer(cms.ip_address, args.visualization_port)
+    encoder = StatusEncoder()
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = serve(args.metrics_port, lambda: exposition({'site="' + name + '"': totals[name] for name in sorted(totals)}))
+
+    published = monotonic()
+    while len(done) < len(sites):
+        try:
+            message = messages.get(timeout=args.period)
+        except queue.Empty:
+            message = None
+        if message and message[0] == "status":
+            _, name, status, site_totals = message
+            statuses[name] = status
+            if site_totals is not None:
+                totals[name] = site_totals
+        elif message and message[0] == "done":
+            done.add(message[1])
+            if message[2] is None:
+                print("Warn: site " + message[1] + " did not run")
+        for worker, names in workers:
+            if not worker.is_alive() and worker.exitcode != 0 and not done.issuperset(names):
+                print("Warn: worker for " + ", ".join(names) + " exited with " + str(worker.exitcode))
+                done.update(names)
+
+        if statuses and (monotonic() - published >= args.period or len(done) == len(sites)):
+            published = monotonic()
+            delta = encoder.encode(combine(sites, statuses, offsets, num_stations, done))
+            server.publish(encoder.snapshot(), delta)
+
+    for worker, names in workers:
+        worker.join()
+    server.close()
+    if metrics_server:
+        metrics_server.shutdown()
+        metrics_server.server_close()
+    print("Log: All sites complete")
@@ -0,0 +1,193 @@
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from threading import Thread, Lock
+from time import time
+
+class RapiError(Exception):
+    """The charger answered $NK."""
+
+def checksum(line):
+    # XOR of every character before the ^
+    value = 0
+    for char in line:
+        value ^= ord(char)
+    return "%02X" % value
+
+def frame(command, sequence_id=None):
+    line = "$" + command
+    if sequence_id is not None:
+        line += " :%02X" % sequence_id
+    return (line + "^" + checksum(line) + "\r").encode()
+
+def parse(line):
+    # "$OK 1234 5678^2A" -> ("OK", ["1234", "5678"], sequence id or None), None if the checksum is wrong
+    if "^" in line:
+        line, received = line.rsplit("^", 1)
+        if received.upper() != checksum(line):
+            return None
+    tokens = line[1:].split(" ")
+    sequence_id = None
+    if len(tokens) > 1 and tokens[-1].startswith(":"):
+        sequence_id = int(tokens.pop()[1:], 16)
+    return tokens[0], tokens[1:], sequence_id
+
+class RapiClient:
+    """OpenEVSE RAPI client over a serial port.
+
+    send() queues a command ("GG", "SC 16 V") and returns a Future for the reply tokens,
+    request() waits for it. Up to max_in_flight commands are written before their replies
+    come back. A background thread reads replies, checks their checksums and resolves the
+    oldest command ($NK sets RapiError). Commands without a reply after timeout seconds
+    fail with TimeoutError. With sequence_ids the charger echoes an id with every reply,
+    so a late reply to a command that timed out is dropped instead of answering the next
+    one (needs RAPI sequence id support in the firmware).
+
+    Lines the charger sends on its own ($ST state changes, $AT, $WF) go to on_notify.
+
+    If the reader thread stops on an error (e.g. the port goes away), every command
+    written or waiting fails with that error, and so does every command sent after it.
+    """
+
+    def __init__(self, port, timeout=1.0, max_in_flight=1, sequence_ids=False, on_notify=None):
+        self.port = port
+        # short reads so the reader thread can expire commands without spinning
+        self.port.timeout = 0.05
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.sequence_ids = sequence_ids
+        self.on_notify = on_notify
+
+        self.mutex = Lock()
+        self.waiting = deque()
+        self.in_flight = deque()
+        self.next_id = 0
+        self.bad_lines = 0
+        self.closed = False
+        # error the reader thread stopped on
+        self.error = None
+
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, command, timeout=None):
+        future = Future()
+        with self.mutex:
+            if self.closed:
+                raise RapiError("client is closed")
+            if self.error is not None:
+                future.set_exception(self.error)
+                return future
+            self.waiting.append((command, future, self.timeout if timeout is None else timeout))
+            self.dispatch()
+        return future
+
+    def request(self, command, timeout=None):
+        # reply tokens, e.g. ["1234", "5678"] for $OK 1234 5678. Waits at most a timeout for
+        # each command ahead of this one and for this one, and half a second more, should the
+        # reader thread not expire it.
+        timeout = self.timeout if timeout is None else timeout
+        with self.mutex:
+            ahead = len(self.waiting) + len(self.in_flight)
+        future = self.send(command, timeout)
+        try:
+            return future.result(max(timeout, self.timeout) * (ahead + 1) + 0.5)
+        except FutureTimeoutError:
+            raise TimeoutError("no reply to $" + command)
+
+    def dispatch(self):
+        # call with mutex held
+        while self.waiting and len(self.in_flight) < self.max_in_flight:
+            command, future, timeout = self.waiting.popleft()
+            sequence_id = None
+            if self.sequence_ids:
+                sequence_id = self.next_id
+                self.next_id = (self.next_id + 1) % 256
+            try:
+                self.port.write(frame(command, sequence_id))
+            except Exception as ex:
+                future.set_exception(ex)
+                continue
+            self.in_flight.append((sequence_id, future, time() + timeout, command))
+
+    def run(self):
+        try:
+            self.read_replies()
+        except Exception as ex:
+            print("Warn: RAPI reader stopped: " + str(ex))
+            self.fail(ex)
+
+    def fail(self, error):
+        # nothing will answer the commands written or waiting any more
+        with self.mutex:
+            self.error = error
+            pending = [future for _, future, _, _ in self.in_flight] + [future for _, future, _ in self.waiting]
+            self.in_flight.clear()
+            self.waiting.clear()
+        for future in pending:
+            future.set_exception(error)
+
+    def read_replies(self):
+        buffer = b""
+        while not self.closed:
+            try:
+                data = self.port.read(max(1, self.port.in_waiting))
+            except Exception:
+                if self.closed:
+                    break
+                raise
+            buffer += data
+            while b"\r" in buffer:
+                line, buffer = buffer.split(b"\r", 1)
+                self.receive(line.decode(errors="replace").strip())
+            self.expire()
+
+    def receive(self, line):
+        if not line.startswith("$"):
+            return
+        parsed = parse(line)
+        if parsed is None:
+            self.bad_lines += 1
+            return
+        kind, tokens, sequence_id = parsed
+
+        if kind not in ("OK", "NK"):
+            if self.on_notify:
+                self.on_notify(kind, tokens)
+            return
+
+        with self.mutex:
+            if not self.in_flight:
+                return
+            if self.sequence_ids:
+                if sequence_id != self.in_flight[0][0]:
+                    # reply to a command that already timed out
+                    return
+            _, future, _, command = self.in_flight.popleft()
+            self.dispatch()
+
+        if kind == "OK":
+            future.set_result(tokens)
+        else:
+            future.set_exception(RapiError("$" + command + " returned $NK"))
+
+    def expire(self):
+        now = time()
+        expired = []
+        with self.mutex:
+            while self.in_flight and self.in_flight[0][2] <= now:
+                expired.append(self.in_flight.popleft())
+            if expired:
+                self.dispatch()
+        for _, future, _, command in expired:
+            future.set_exception(TimeoutError("no reply to $" + command))
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            pending = list(self.in_flight) + [(None, future, None, command) for command, future, _ in self.waiting]
+            self.in_flight.clear()
+            self.waiting.clear()
+        self.thread.join()
+        for _, future, _, command in pending:
+            future.set_exception(RapiError("client closed before $" + command + " was answered"))
+        self.port.close()
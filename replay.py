@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import argparse
+import threading
+from bisect import bisect_right
+from time import monotonic
+import numpy as np
+
+import cms
+import log_segments
+from binlog import RECORDS, CAR, STATION, POWER, stream_kind, seconds, open_log
+from status_protocol import StatusEncoder
+from status_server import StatusServer
+
+# rows between the offsets a text stream keeps for seeking
+CHECKPOINT_ROWS = 1000
+# rows read from a binary or segmented log at a time
+CHUNK_ROWS = 1000
+
+class TextStream:
+    """Rows of a text log as (tick, values), read line by line from any tick on.
+
+    The first read from tick 0 keeps the byte offset of every CHECKPOINT_ROWS-th row, so a
+    later seek only reads from the checkpoint before it.
+    """
+
+    def __init__(self, path, start, read_delay):
+        self.path = path
+        self.start = start
+        self.read_delay = read_delay
+        self.columns = len(RECORDS[stream_kind(os.path.splitext(os.path.basename(path))[0])].names) - 1
+        # (tick, offset, day, time offset of the row before) of every checkpoint row
+        self.checkpoints = []
+
+    def rows(self, first):
+        index = max(0, bisect_right(self.checkpoints, (first, float("inf"))) - 1)
+        tick, offset, day, previous = self.checkpoints[index] if self.checkpoints else (0, 0, 0, 0)
+        record = not self.checkpoints
+        count = 0
+
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    return
+                values = line.decode().split(",")
+                if len(values) != self.columns + 1:
+                    continue
+                time_offset = (seconds(values[0]) - self.start) % 86400
+                # logs only have hh:mm:ss, count days when the time wraps around
+                row_day = day + 1 if time_offset < previous else day
+                tick = int((row_day * 86400 + time_offset) / self.read_delay)
+                if record and count % CHECKPOINT_ROWS == 0:
+                    # what reading on from this row needs
+                    self.checkpoints.append((tick, offset, day, previous))
+                day = row_day
+                previous = time_offset
+                count += 1
+                if tick >= first:
+                    yield tick, tuple(float(value) for value in values[1:])
+
+class BinaryStream:
+    """Rows of a memory mapped binary log, found with a binary search on the tick column."""
+
+    def __init__(self, path):
+        self.info, self.records = open_log(path)
+
+    def rows(self, first):
+        start = int(np.searchsorted(self.records["tick"], first))
+        for n in range(start, len(self.records), CHUNK_ROWS):
+            for row in self.records[n:n + CHUNK_ROWS].tolist():
+                yield row[0], row[1:]
+
+class SegmentedStream:
+    """Rows of a segmented log, queried CHUNK_ROWS ticks at a time."""
+
+    def __init__(self, directory, stream):
+        self.directory = directory
+        self.stream = stream
+        entries = log_segments.read_index(directory, stream)
+        meta = log_segments.read_meta(directory)
+        # a segment still being written ends where its segment does
+        self.last = max([entry["last"] for entry in entries] + [(int(f[:-4]) + 1) * meta["segment_ticks"] for f in os.listdir(os.path.join(directory, stream)) if f.endswith(".txt")] + [0])
+
+    def rows(self, first):
+        for window in range(first, self.last + 1, CHUNK_ROWS):
+            for tick, line in log_segments.query(self.directory, self.stream, window, window + CHUNK_ROWS - 1):
+                yield tick, tuple(float(value) for value in line.split(",")[1:])
+
+def open_streams(directory, start_time, read_delay):
+    # {stream: reader} of a log directory in any of the formats, and the start time in seconds
+    if os.path.exists(os.path.join(directory, log_segments.META)):
+        meta = log_segments.read_meta(directory)
+        streams = {f: SegmentedStream(directory, f) for f in sorted(os.listdir(directory)) if os.path.isdir(os.path.join(directory, f))}
+        return streams, meta["start"], meta["read_delay"]
+
+    streams = {}
+    start = seconds(start_time)
+    for f in sorted(os.listdir(directory)):
+        stream, extension = os.path.splitext(f)
+        if extension == ".bin":
+            streams[stream] = BinaryStream(os.path.join(directory, f))
+    if streams:
+        info = next(iter(streams.values())).info
+        return streams, info["start"], info["read_delay"]
+    for f in sorted(os.listdir(directory)):
+        stream, extension = os.path.splitext(f)
+        if extension == ".txt":
+            streams[stream] = TextStream(os.path.join(directory, f), start, read_delay)
+    return streams, start, read_delay
+
+def is_charger(stream):
+    return stream.startswith("openevse")
+
+def charger_station(stream):
+    # inverse of cms.charger_name()
+    return int(stream[len("openevse"):] or 0)
+
+class Replay:
+    """Rebuilds the status dicts publish_status() sent from a log directory, tick by tick.
+
+    scan() reads every stream once for where each car arrives and leaves, its station and
+    its battery capacity, keeping only those per car. frames() then reads all streams
+    together from any tick, one row at a time, so memory does not grow with the logs.
+    Without the car dataset, a car's departure is taken as the tick after its last row and
+    its capacity estimated from the energy it was given.
+    """
+
+    def __init__(self, streams, start, read_delay, voltage, sim=None):
+        self.streams = streams
+        self.start = start
+        self.read_delay = read_delay
+        self.voltage = voltage
+        # Simulation with the car and building datasets, when given
+        self.sim = sim
+        # stream: {"arrival", "last", "departure", "station_no", "capacity"} of each car
+        self.cars = {}
+        self.max_power = 0.0
+        self.end = 0
+
+    def scan(self):
+        kwh = self.voltage * self.read_delay / 3600 / 1000
+        for stream, reader in self.streams.items():
+            kind = stream_kind(stream)
+            if kind == CAR:
+                car = {"arrival": None, "last": 0, "delivered": 0.0, "soc_first": 0.0, "soc_last": 0.0}
+                for tick, values in reader.rows(0):
+                    car["last"] = tick
+                    if any(values):
+                        if car["arrival"] is None:
+                            car["arrival"] = tick
+                            car["soc_first"] = values[3]
+                        car["delivered"] += values[0] * kwh
+                        car["soc_last"] = values[3]
+                self.cars[stream] = car
+                self.end = max(self.end, car["last"] + 1)
+            else:
+                for tick, values in reader.rows(0):
+                    if kind == POWER:
+                        # available power is the max power when the building uses none
+                        self.max_power = max(self.max_power, values[1])
+                    self.end = max(self.end, tick + 1)
+        if self.sim and self.sim.max_building:
+            self.max_power = self.sim.max_building * 1000
+
+        records = {}
+        if self.sim:
+            records = {record.name: (line, record) for line, record in self.sim.car_dataset.items()}
+        simulated = [stream for stream in self.cars if not is_charger(stream)]
+        # station numbers go by arrival as in control_step(), dataset order for cars arriving together
+        simulated.sort(key=lambda stream: (self.cars[stream]["arrival"] is None, self.cars[stream]["arrival"] or 0, records[stream][0] if stream in records else 0, stream))
+        for station_no, stream in enumerate(simulated, 1):
+            self.cars[stream]["station_no"] = station_no
+        for stream in self.cars:
+            car = self.cars[stream]
+            if is_charger(stream):
+                car["station_no"] = charger_station(stream)
+            if stream in records:
+                record = records[stream][1]
+                car["departure"] = record.departure
+                car["capacity"] = cms.MAKE_MODEL[record.model]
+            else:
+                car["departure"] = int((car["last"] + 1) * self.read_delay)
+                dropped = car["soc_first"] - car["soc_last"]
+                car["capacity"] = 100 * car["delivered"] / dropped if dropped > 0 else 0.0
+        self.num_stations = len(simulated) + 1
+
+    def time_string(self, tick):
+        return log_segments.time_string(self.start, self.read_delay, tick)
+
+    def frames(self, first):
+        # (tick, status dict) of each tick from first on
+        readers = {stream: reader.rows(first) for stream, reader in self.streams.items()}
+        # next row of each stream, None once it has no more
+        pending = {stream: next(rows, None) for stream, rows in readers.items()}
+        power = [stream for stream in self.streams if stream_kind(stream) == POWER][:1]
+
+        for tick in range(first, self.end):
+            current = {}
+            for stream, row in pending.items():
+                # a continued run can log a tick twice, the last row wins
+                while row is not None and row[0] <= tick:
+                    if row[0] == tick:
+                        current[stream] = row[1]
+                    row = next(readers[stream], None)
+                pending[stream] = row
+            yield tick, self.status(tick, current, power)
+
+    def status(self, tick, current, power):
+        # whole seconds, as status_protocol packs them (binary logs store the read delay as a float)
+        info = {"current_time": self.time_string(tick), "elapsed": int(tick * self.read_delay), "cars": {}}
+        used = current.get(power[0]) if power else None
+        info["avail_building_power"] = used[1] if used else 0.0
+        info["max_power"] = self.max_power
+        info["total_building_power_used"] = used[0] if used else 0.0
+        info["total_power_used"] = used[2] if used else 0.0
+        info["total_power_to_batteries"] = 0.0
+        info["total_energy_req"] = 0.0
+
+        for stream, values in current.items():
+            kind = stream_kind(stream)
+            if kind == STATION:
+                info["total_power_to_batteries"] += values[1] * self.voltage
+            elif kind == CAR:
+                car = self.cars[stream]
+                # waiting cars and empty chargers log rows of zeros
+                if not any(values) and (is_charger(stream) or car["arrival"] is None or tick < car["arrival"]):
+                    continue
+                info["cars"][car["station_no"]] = {"name": stream, "delta_soc": values[3], "current": values[1], "battery": values[2], "remaining_time": 0 if is_charger(stream) else car["departure"] - info["elapsed"]}
+                info["total_energy_req"] += values[3] * car["capacity"] / 100
+
+        for num in range(self.num_stations):
+            if num not in info["cars"]:
+                info["cars"][num] = "empty"
+        return info
+
+class Controls:
+    """Speed, pause and seek, changed by commands on stdin while the replay runs."""
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.paused = False
+        self.seek = None
+        self.changed = threading.Event()
+
+    def command(self, line, replay):
+        words = line.split()
+        if not words:
+            return
+        if words[0] == "speed" and len(words) == 2:
+            self.speed = 0 if words[1] == "max" else float(words[1])
+        elif words[0] == "pause":
+            self.paused = True
+        elif words[0] in ["play", "resume"]:
+            self.paused = False
+        elif words[0] == "seek" and len(words) in [2, 3]:
+            self.seek = start_tick(replay, words[1], int(words[2]) if len(words) == 3 else 0)
+        else:
+            print("Warn: commands are speed N|max, pause, play and seek hh:mm:ss [day]")
+            return
+        self.changed.set()
+
+    def read(self, replay):
+        for line in sys.stdin:
+            try:
+                self.command(line, replay)
+            except ValueError as ex:
+                print("Warn: " + str(ex))
+
+def start_tick(replay, time, day):
+    return log_segments.window_tick({"start": replay.start, "read_delay": replay.read_delay}, time, day)
+
+def play(replay, server, controls, first):
+    # publishes a frame per tick, READ_DELAY / speed seconds apart (no delay at speed 0)
+    encoder = StatusEncoder()
+    while True:
+        frames = replay.frames(first)
+        base_tick = first
+        base_time = monotonic()
+        controls.changed.clear()
+        for tick, info in frames:
+            delta = encoder.encode(info)
+            server.publish_wait(encoder.snapshot(), delta)
+            if controls.speed > 0:
+                wait = base_time + (tick + 1 - base_tick) * replay.read_delay / controls.speed - monotonic()
+                if wait > 0:
+                    controls.changed.wait(wait)
+            while controls.paused and controls.seek is None:
+                controls.changed.clear()
+                controls.changed.wait()
+            if controls.seek is not None:
+                break
+            if controls.changed.is_set():
+                # new speed, or playing again after a pause
+                base_tick = tick + 1
+                base_time = monotonic()
+                controls.changed.clear()
+        if controls.seek is None:
+            return
+        first = controls.seek
+        controls.seek = None
+        print("Log: Seeking to " + replay.time_string(first))
+        # the next frame is a snapshot, so clients drop the cars of the old position
+        encoder = StatusEncoder()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay a CMS log directory into the visualization stream')
+    parser.add_argument("directory", help="Log directory (text, binary or segmented logs)")
+    parser.add_argument("--speed", dest="speed", default="1", help="Simulated seconds per second, or max for as fast as clients take them (default: %(default)s)")
+    parser.add_argument("--from", dest="start", default="", help="Time to start from (hh:mm:ss), the start of the logs if not given")
+    parser.add_argument("--day", dest="day", type=int, default=0, help="Day of the run --from is on, counted in 24 hours from the start time (default: %(default)s)")
+    parser.add_argument("--start-time", "--st", dest="start_time", default="18:00:00", help="Start time of the run, for text logs (default: %(default)s)")
+    parser.add_argument("--read-delay", dest="read_delay", type=float, default=cms.READ_DELAY, help="Seconds between log rows, for text logs (default: %(default)s)")
+    parser.add_argument("--voltage", dest="voltage", type=float, default=cms.VOLTAGE, help="Charger voltage (default: %(default)s)")
+    parser.add_argument("--car-dataset", "--cd", dest="car_file", default="", help="Car dataset of the run, for exact stations, departures and capacities")
+    parser.add_argument("--building-dataset", "--bd", dest="building_file", default="", help="Building dataset of the run, for the max building power")
+    parser.add_argument("--visualization-port", "--vp", dest="visualization_port", type=int, default=5000, help="Port to stream status frames on (default: %(default)s)")
+    args = parser.parse_args()
+
+    streams, start, read_delay = open_streams(args.directory, args.start_time, args.read_delay)
+    if not streams:
+        print("Cannot find logs in " + args.directory)
+        exit(0)
+
+    sim = None
+    if args.car_file or args.building_file:
+        sim = cms.Simulation(start=log_segments.time_string(start, read_delay, 0))
+        if args.building_file:
+            sim.load_building(args.building_file)
+        if args.car_file:
+            sim.load_cars(args.car_file)
+
+    replay = Replay(streams, start, read_delay, args.voltage, sim)
+    replay.scan()
+    print("Log: Replaying " + str(len(streams)) + " streams, " + str(round(replay.end * read_delay / 3600, 2)) + " hours from " + replay.time_string(0))
+
+    controls = Controls(0 if args.speed == "max" else float(args.speed))
+    threading.Thread(target=controls.read, args=(replay,), daemon=True).start()
+    server = StatusServer(cms.ip_address, args.visualization_port)
+    play(replay, server, controls, start_tick(replay, args.start, args.day) if args.start else 0)
+    server.close()
+    print("Log: Replay complete")
@@ -0,0 +1,81 @@
+from heapq import heappush, heappop
+
+class StationIndex:
+    """Idle station batteries ordered by capacity, for picking batteries during a tick.
+
+    Keeps a max heap of the batteries cars can borrow (every station but 0) and a min heap
+    of all batteries for recharging. Ties go to the lowest station number, the same order
+    as sorting the station list by capacity. Entries are replaced instead of removed: each
+    station has a version and older entries are skipped when they reach the top.
+
+    Call update() when a station's capacity changes and release() once a tick is over, so
+    the batteries taken during the tick are offered again.
+    """
+
+    def __init__(self, stations):
+        self.stations = stations
+        self.rebuild()
+
+    def rebuild(self):
+        self.largest = []
+        self.smallest = []
+        self.taken = []
+        self.version = [0] * len(self.stations)
+        self.capacity = [None] * len(self.stations)
+        for station in self.stations:
+            self.push(station)
+
+    def push(self, station):
+        no = station.station_no
+        self.version[no] += 1
+        self.capacity[no] = station.battery_capacity
+        if no != 0:
+            heappush(self.largest, (-station.battery_capacity, no, self.version[no]))
+        heappush(self.smallest, (station.battery_capacity, no, self.version[no]))
+
+    def update(self, station):
+        if station.battery_capacity != self.capacity[station.station_no]:
+            self.push(station)
+
+    def release(self):
+        taken = self.taken
+        self.taken = []
+        for no in set(taken):
+            self.push(self.stations[no])
+
+        # old entries pile up while capacities change, start over before they outnumber the stations
+        if len(self.smallest) > 4 * len(self.stations):
+            self.rebuild()
+
+    def top(self, heap):
+        # first current entry of an idle battery, taken batteries are put aside until release()
+        while heap:
+            _, no, version = heap[0]
+            if version != self.version[no]:
+                heappop(heap)
+            elif self.stations[no].battery_current != 0:
+                heappop(heap)
+                self.taken.append(no)
+            else:
+                return self.stations[no]
+        return None
+
+    def take(self, heap):
+        station = self.top(heap)
+        heappop(heap)
+        self.taken.append(station.station_no)
+        return station
+
+    def take_largest(self, threshold):
+        # idle battery other than station 0 with the most capacity, if it has more than threshold
+        station = self.top(self.largest)
+        if station is None or station.battery_capacity <= threshold:
+            return None
+        return self.take(self.largest)
+
+    def take_smallest(self, limit):
+        # idle battery with the least capacity, if it has less than limit
+        station = self.top(self.smallest)
+        if station is None or station.battery_capacity >= limit:
+            return None
+        return self.take(self.smallest)
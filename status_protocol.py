@@ -0,0 +1,131 @@
+import struct
+import asyncio
+
+# Status stream from publish_status(). Every frame is a length prefixed message:
+#   frame:   u32 payload length, u8 kind (SNAPSHOT or DELTA), payload
+#   payload: HEAD, then num_records station records
+#   record:  u32 station number, u8 EMPTY or CHARGING, and for a charging car
+#            u8 name length, name (utf-8), CAR
+# A snapshot has every station, a delta only the stations that changed since the last frame.
+# Cars send their departure time instead of the remaining time so they only change while
+# charging, the decoder works the remaining time out again.
+FRAME = struct.Struct("<IB")
+HEAD = struct.Struct("<8sq6dII")
+STATION = struct.Struct("<IB")
+CAR = struct.Struct("<dddq")
+
+SNAPSHOT = 0
+DELTA = 1
+
+EMPTY = 0
+CHARGING = 1
+
+TOTALS = ["avail_building_power", "max_power", "total_building_power_used", "total_power_used", "total_power_to_batteries", "total_energy_req"]
+
+def encode_station(station_no, car, elapsed):
+    if car == "empty":
+        return STATION.pack(station_no, EMPTY)
+    name = str(car["name"]).encode()[:255]
+    return (STATION.pack(station_no, CHARGING) + bytes([len(name)]) + name +
+            CAR.pack(car["delta_soc"], car["current"], car["battery"], car["remaining_time"] + elapsed))
+
+class StatusEncoder:
+    """Encodes a series of status dicts, a snapshot first and then deltas.
+
+    snapshot() gives a snapshot of the last status encoded, for clients that join later.
+    """
+
+    def __init__(self):
+        self.sent = None
+        self.head = None
+
+    def encode(self, info):
+        stations = {}
+        for station_no, car in info["cars"].items():
+            stations[station_no] = encode_station(station_no, car, info["elapsed"])
+
+        if self.sent is None:
+            kind = SNAPSHOT
+            records = [stations[station_no] for station_no in sorted(stations)]
+        else:
+            kind = DELTA
+            records = [stations[station_no] for station_no in sorted(stations) if self.sent.get(station_no) != stations[station_no]]
+        self.sent = stations
+        self.head = (info["current_time"].encode(), info["elapsed"], *[info[key] for key in TOTALS], len(stations))
+
+        return frame(kind, self.head, records)
+
+    def snapshot(self):
+        return frame(SNAPSHOT, self.head, [self.sent[station_no] for station_no in sorted(self.sent)])
+
+def frame(kind, head, records):
+    payload = HEAD.pack(*head, len(records)) + b"".join(records)
+    return FRAME.pack(len(payload), kind) + payload
+
+class StatusDecoder:
+    """Rebuilds the status dict publish_status() used to pickle from snapshot and delta frames."""
+
+    def __init__(self):
+        self.cars = None
+
+    def read(self, sock):
+        # returns the next status dict, None when the connection is closed
+        header = recv_exactly(sock, FRAME.size)
+        if header is None:
+            return None
+        length, kind = FRAME.unpack(header)
+        payload = recv_exactly(sock, length)
+        if payload is None:
+            return None
+        return self.decode(kind, payload)
+
+    async def read_stream(self, reader):
+        # same as read() for an asyncio StreamReader
+        try:
+            length, kind = FRAME.unpack(await reader.readexactly(FRAME.size))
+            payload = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return None
+        return self.decode(kind, payload)
+
+    def decode(self, kind, payload):
+        current_time, elapsed, *totals, num_stations, num_records = HEAD.unpack_from(payload)
+        if kind == SNAPSHOT:
+            self.cars = {}
+        elif self.cars is None:
+            raise ValueError("delta frame before a snapshot")
+
+        offset = HEAD.size
+        for _ in range(num_records):
+            station_no, state = STATION.unpack_from(payload, offset)
+            offset += STATION.size
+            if state == EMPTY:
+                self.cars[station_no] = "empty"
+                continue
+            length = payload[offset]
+            name = payload[offset + 1:offset + 1 + length].decode()
+            offset += 1 + length
+            delta_soc, current, battery, departure = CAR.unpack_from(payload, offset)
+            offset += CAR.size
+            self.cars[station_no] = {"name": name, "delta_soc": delta_soc, "current": current, "battery": battery, "departure": departure}
+
+        info = {"current_time": current_time.decode(), "elapsed": elapsed}
+        info.update(zip(TOTALS, totals))
+        info["cars"] = {}
+        for station_no in sorted(self.cars):
+            if station_no >= num_stations:
+                continue
+            car = self.cars[station_no]
+            if car != "empty":
+                car = {"name": car["name"], "delta_soc": car["delta_soc"], "current": car["current"], "battery": car["battery"], "remaining_time": car["departure"] - elapsed}
+            info["cars"][station_no] = car
+        return info
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return data
@@ -0,0 +1,110 @@
+import asyncio
+from threading import Thread, Event
+
+class Subscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        # False until the client has a snapshot to apply deltas to
+        self.synced = False
+        self.closed = asyncio.Event()
+
+class StatusServer:
+    """Sends status frames to any number of clients from an asyncio loop in its own thread.
+
+    publish() is called from the CMS with a snapshot and a delta frame encoded once for
+    everyone. Each client has its own queue of at most queue_size frames, so a slow client
+    only falls behind itself. When its queue is full the queued frames are dropped and
+    replaced by the snapshot, which is what the dropped deltas would have added up to.
+    """
+
+    def __init__(self, host, port, queue_size=8):
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+
+        self.subscribers = set()
+        self.snapshot = None
+        self.dropped = 0
+
+        self.loop = asyncio.new_event_loop()
+        self.started = Event()
+        # why the server could not start (e.g. the port is in use), raised here
+        self.error = None
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if self.error:
+            self.thread.join()
+            raise self.error
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(self.subscribe, self.host, self.port))
+        except Exception as ex:
+            self.error = ex
+            self.loop.close()
+            self.started.set()
+            return
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def subscribe(self, reader, writer):
+        subscriber = Subscriber()
+        if self.snapshot is not None:
+            subscriber.queue.put_nowait(self.snapshot)
+            subscriber.synced = True
+        self.subscribers.add(subscriber)
+
+        try:
+            while True:
+                frame = await subscriber.queue.get()
+                if frame is None:
+                    break
+                writer.write(frame)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.subscribers.discard(subscriber)
+            writer.close()
+            subscriber.closed.set()
+
+    def publish(self, snapshot, delta):
+        # thread safe, never waits for a client
+        self.loop.call_soon_threadsafe(self.broadcast, snapshot, delta)
+
+    def publish_wait(self, snapshot, delta):
+        # publish() that returns once the frames are queued for every client, for a caller
+        # that can make frames faster than the loop sends them (e.g. replay.py at max speed)
+        async def broadcast():
+            self.broadcast(snapshot, delta)
+        asyncio.run_coroutine_threadsafe(broadcast(), self.loop).result()
+
+    def broadcast(self, snapshot, delta):
+        self.snapshot = snapshot
+        for subscriber in self.subscribers:
+            if subscriber.synced and subscriber.queue.qsize() < self.queue_size:
+                subscriber.queue.put_nowait(delta)
+                continue
+
+            while not subscriber.queue.empty():
+                subscriber.queue.get_nowait()
+                self.dropped += 1
+            subscriber.queue.put_nowait(snapshot)
+            subscriber.synced = True
+
+    async def shutdown(self, timeout):
+        self.server.close()
+        subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            # clients get what is already queued, then the connection closes
+            subscriber.queue.put_nowait(None)
+        if subscribers:
+            await asyncio.wait([asyncio.ensure_future(subscriber.closed.wait()) for subscriber in subscribers], timeout=timeout)
+
+    def close(self, timeout=1.0):
+        asyncio.run_coroutine_threadsafe(self.shutdown(timeout), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
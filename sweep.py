@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import os
+import io
+import csv
+import sys
+import argparse
+import itertools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import cms
+from vector_engine import VectorEngine
+
+COLUMNS = ["building_dataset", "car_dataset", "battery_capacity", "control_delay", "efficiency", "voltage", "car", "left_at", "soc_remaining", "peak_building_kw"]
+
+def run(config):
+    # Runs one combination with the event sim, returns one row per car
+    building_file, car_file, battery_capacity, control_delay, efficiency, voltage, start_time, engine = config
+
+    sim = cms.Simulation(voltage=voltage, efficiency=efficiency, battery_capacity=battery_capacity, control_delay=control_delay, start=start_time)
+    sim.load_building(building_file)
+    sim.load_cars(car_file)
+    if engine == "numpy":
+        sim.engine = VectorEngine(sim.voltage, sim.efficiency, cms.READ_DELAY, sim.battery_capacity, sim.battery_charging_current)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim.run_events(False)
+
+    results = [(name, left_at, soc) for name, left_at, soc in sim.departed]
+    # cars still charging when the building dataset ends
+    results += [(car.name, "", 100 * car.delta_kWh/car.capacity) for car in sim.cars]
+
+    rows = []
+    for name, left_at, soc in results:
+        rows.append([building_file, car_file, battery_capacity, control_delay, efficiency, voltage, name.strip(), left_at, soc, sim.peak_building / 1000])
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the CMS over every combination of datasets and constants')
+    parser.add_argument("--building-dataset", "--bd", dest="building_files", nargs="+", required=True, help="Building dataset files")
+    parser.add_argument("--car-dataset", "--cd", dest="car_files", nargs="+", required=True, help="Car dataset files")
+    parser.add_argument("--battery-capacity", "--bc", dest="battery_capacity", type=float, nargs="+", default=[cms.BATTERY_CAPACITY], help="Station battery capacities in kWh (default: %(default)s)")
+    parser.add_argument("--control-delay", dest="control_delay", type=int, nargs="+", default=[cms.CONTROL_DELAY], help="Control delays in seconds (default: %(default)s)")
+    parser.add_argument("--efficiency", dest="efficiency", type=float, nargs="+", default=[cms.EFFICIENCY], help="Charging efficiencies (default: %(default)s)")
+    parser.add_argument("--voltage", dest="voltage", type=float, nargs="+", default=[cms.VOLTAGE], help="Charger voltages (default: %(default)s)")
+    parser.add_argument("--start-time", "--st", dest="start_time", default="18:00:00", help="Start time of building datasets (default: %(default)s)")
+    parser.add_argument("--engine", dest="engine", choices=["loop", "numpy"], default="loop", help="Tick engine (default: %(default)s)")
+    parser.add_argument("--workers", dest="workers", type=int, default=os.cpu_count(), help="Worker processes (default: %(default)s)")
+    parser.add_argument("--output", "-o", dest="output", default="", help="CSV file to write, stdout if not given")
+    args = parser.parse_args()
+
+    configs = [config + (args.start_time, args.engine) for config in itertools.product(args.building_files, args.car_files, args.battery_capacity, args.control_delay, args.efficiency, args.voltage)]
+    print("Log: Running " + str(len(configs)) + " configurations on " + str(args.workers) + " workers", file=sys.stderr)
+
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for rows in executor.map(run, configs):
+            writer.writerows(rows)
+    if args.output:
+        output.close()
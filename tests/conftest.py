@@ -0,0 +1,18 @@
+import os
+import sys
+import math
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def datasets(tmp_path):
+    # A 20 minute building dataset and four cars that arrive and leave during it
+    building_file = tmp_path / "building.txt"
+    building_file.write_text("".join(str(round(20 + 10 * math.sin(tick / 50), 1)) + "\n" for tick in range(600)))
+    car_file = tmp_path / "cars.txt"
+    car_file.write_text("sim01, 0, 18:15:00, nissan leaf, 40, False\n"
+                        "sim02, 30, 18:12:00, tesla model 3, 20, True\n"
+                        "sim03, 100, 18:25:00, renault zoe, 60, False\n"
+                        "sim04, 400, 18:30:00, tesla model x, 10, False\n")
+    return str(building_file), str(car_file)
@@ -0,0 +1,128 @@
+import io
+import json
+import time
+import asyncio
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from dashboard import Uploader
+from status_protocol import StatusEncoder, TOTALS
+
+class StubApi:
+    """REST API on a local port that answers with statuses in turn, then 200."""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        # (time, rows) of every POST
+        self.posts = []
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                rows = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                api.posts.append((time.time(), rows))
+                self.send_response(api.statuses.pop(0) if api.statuses else 200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:" + str(self.server.server_address[1]) + "/rows"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.fixture
+def api_statuses():
+    return []
+
+@pytest.fixture
+def api(api_statuses):
+    api = StubApi(api_statuses)
+    yield api
+    api.close()
+
+def status(n):
+    info = {"current_time": "18:00:%02d" % n, "elapsed": 2 * n, "cars": {1: "empty"}}
+    info.update({key: 0.0 for key in TOTALS})
+    info["avail_building_power"] = float(n)
+    return info
+
+def upload(uploader, frames):
+    # serves frames as the CMS status stream and uploads them
+    async def main():
+        encoder = StatusEncoder()
+        data = b"".join(encoder.encode(status(n)) for n in range(frames))
+
+        async def serve(reader, writer):
+            writer.write(data)
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(serve, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            await asyncio.wait_for(uploader.run("127.0.0.1", port, 60), 10)
+
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        asyncio.run(main())
+    return out.getvalue()
+
+def building_power(rows):
+    return sorted(float(row["building_power"]) for row in rows)
+
+def test_rows_go_out_in_batches(api):
+    uploader = Uploader(api.url, batch_size=4, batch_delay=0.2)
+    upload(uploader, 10)
+    assert uploader.uploaded == 10
+    assert all(len(rows) <= 4 for _, rows in api.posts)
+    assert len(api.posts) < 10
+    assert building_power(row for _, rows in api.posts for row in rows) == list(range(10))
+
+@pytest.mark.parametrize("api_statuses", [[500, 503]])
+def test_failed_batches_are_retried_with_backoff(api):
+    uploader = Uploader(api.url, batch_size=10, batch_delay=0.2, backoff=0.1)
+    out = upload(uploader, 5)
+    assert uploader.uploaded == 5
+    assert uploader.dropped == 0
+    assert "Warn: upload failed: 500" in out
+    # the same batch three times, waiting 0.1s then 0.2s
+    assert [rows for _, rows in api.posts] == [api.posts[0][1]] * 3
+    assert api.posts[1][0] - api.posts[0][0] >= 0.1
+    assert api.posts[2][0] - api.posts[1][0] >= 0.2
+
+@pytest.mark.parametrize("api_statuses", [[500] * 10])
+def test_batches_are_dropped_after_max_attempts(api):
+    uploader = Uploader(api.url, batch_size=10, batch_delay=0.2, max_attempts=3, backoff=0.01)
+    out = upload(uploader, 5)
+    assert len(api.posts) == 3
+    assert uploader.uploaded == 0
+    assert uploader.dropped == 5
+    assert "Warn: gave up on 5 rows after 3 attempts" in out
+
+def test_full_queue_drops_the_oldest_rows():
+    uploader = Uploader("http://127.0.0.1:9/rows", max_rows=3)
+
+    async def main():
+        uploader.rows = asyncio.Queue(uploader.max_rows)
+        reader = asyncio.StreamReader()
+        encoder = StatusEncoder()
+        for n in range(8):
+            reader.feed_data(encoder.encode(status(n)))
+        reader.feed_eof()
+        # nothing uploads, the reader must not wait for room
+        await asyncio.wait_for(uploader.read(reader), 5)
+        return [uploader.rows.get_nowait()[1] for _ in range(uploader.rows.qsize())]
+
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        rows = asyncio.run(main())
+    assert building_power(rows) == [5, 6, 7]
+    assert uploader.dropped == 5
+    assert out.getvalue().count("Warn: upload queue full") == 1
@@ -0,0 +1,46 @@
+import io
+import random
+import contextlib
+
+import building_data
+import cms
+
+def run(datasets, events):
+    sim = cms.Simulation()
+    sim.load_building(datasets[0])
+    sim.load_cars(datasets[1])
+    with contextlib.redirect_stdout(io.StringIO()):
+        if events:
+            sim.run_events(False)
+        else:
+            sim.run_ticks(False)
+    return sim
+
+def test_next_change_matches_a_scan(tmp_path):
+    rng = random.Random(5)
+    # runs of equal loads, one longer than the largest window
+    loads = []
+    for length in [1, 1, 3, 200, 1, 70000, 5, 1]:
+        loads += [round(rng.uniform(0, 60), 1)] * length
+    text_file = tmp_path / "building.txt"
+    text_file.write_text("".join(str(load) + "\n" for load in loads))
+    binary_file = tmp_path / "building.bin"
+    building_data.convert(str(text_file), str(binary_file), "18:00:00", 2)
+
+    for path in [text_file, binary_file]:
+        sim = cms.Simulation()
+        with contextlib.redirect_stdout(io.StringIO()):
+            sim.load_building(str(path))
+        for tick in list(range(0, 300)) + list(range(70150, len(loads))):
+            expected = next((later for later in range(tick + 1, len(loads)) if loads[later] != loads[tick]), len(loads))
+            assert sim.next_change(tick) == expected
+
+def test_event_sim_matches_fast_sim(datasets):
+    ticks = run(datasets, False)
+    events = run(datasets, True)
+    assert [(name, time) for name, time, soc in events.departed] == [(name, time) for name, time, soc in ticks.departed]
+    # skipped ticks are accounted for at once, which only rounds differently
+    for (_, _, expected), (_, _, soc) in zip(ticks.departed, events.departed):
+        assert abs(soc - expected) < 1e-9
+    for expected, station in zip(ticks.stations, events.stations):
+        assert abs(station.battery_capacity - expected.battery_capacity) < 1e-9
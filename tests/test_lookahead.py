@@ -0,0 +1,67 @@
+import random
+
+import numpy as np
+
+import building_data
+from lookahead import Headroom, sliding_max
+
+def test_sliding_max_matches_every_window():
+    rng = random.Random(3)
+    loads = [rng.uniform(0, 60) for tick in range(503)]
+    for window in [1, 2, 7, 50, 503, 600]:
+        expected = [max(loads[tick:tick + window]) for tick in range(len(loads) - window + 1)]
+        assert list(sliding_max(np.array(loads), window)) == expected
+
+def test_headroom_aggregates(tmp_path):
+    rng = random.Random(4)
+    loads = [round(rng.uniform(0, 60), 1) for tick in range(300)]
+    text_file = tmp_path / "building.txt"
+    text_file.write_text("".join(str(load) + "\n" for load in loads))
+    binary_file = tmp_path / "building.bin"
+    building_data.convert(str(text_file), str(binary_file), "18:00:00", 2)
+    info, dataset = building_data.open_dataset(str(binary_file))
+
+    headroom = Headroom(40, dataset)
+    # the memory mapped dataset is used without a copy
+    assert np.shares_memory(headroom.loads, dataset)
+    assert len(headroom) == 300
+    assert abs(headroom.total(10, 70) - sum(loads[10:70])) < 1e-9
+    assert headroom.total(250, 400) == headroom.total(250, 300)
+    assert headroom.count(-5, 10) == 10
+    assert headroom.count(290, 400) == 10
+    assert headroom.maximum(0) == max(loads[0:40])
+    # windows running past the end use the loads left
+    assert headroom.maximum(280) == max(loads[280:])
+    assert headroom.maximum(300) == 0.0
+
+def test_headroom_added_loads_match_a_scan():
+    rng = random.Random(6)
+    for window in [1, 3, 40]:
+        loads = [round(rng.uniform(0, 60), 1) for tick in range(25)]
+        headroom = Headroom(window, loads)
+        # one at a time, in short runs and in runs of a window or more
+        for size in [1] * 50 + [rng.randint(1, 2 * window + 1) for _ in range(60)] + [1] * 30:
+            added = [round(rng.uniform(0, 60), 1) for tick in range(size)]
+            loads += added
+            if size == 1:
+                headroom.append(added[0])
+            else:
+                headroom.extend(added)
+        assert len(headroom) == len(loads)
+        assert list(headroom.window_min) == [min(loads[tick:tick + window]) for tick in range(len(loads) - window + 1)]
+        assert list(headroom.window_max) == [max(loads[tick:tick + window]) for tick in range(len(loads) - window + 1)]
+        assert list(headroom.prefix) == list(np.cumsum([0.0] + loads))
+        for tick in range(len(loads) + 2):
+            assert headroom.minimum(tick) == min(loads[tick:tick + window], default=0.0)
+            assert headroom.maximum(tick) == max(loads[tick:tick + window], default=0.0)
+
+def test_headroom_append_doubles_its_buffers():
+    headroom = Headroom(10, [1.0] * 100)
+    copies = 0
+    for tick in range(10000):
+        buffer = headroom.load_buffer
+        headroom.append(tick % 7)
+        copies += headroom.load_buffer is not buffer
+    assert copies <= 10
+    assert headroom.minimum(10090) == 0.0
+    assert headroom.maximum(10090) == 6.0
@@ -0,0 +1,18 @@
+from metrics import TickMetrics, exposition
+
+def test_trace_columns(tmp_path):
+    trace_file = tmp_path / "trace.csv"
+    metrics = TickMetrics(str(trace_file))
+    for tick_no in range(3):
+        metrics.begin(tick_no)
+        metrics.lap("measure")
+        metrics.end()
+    metrics.close()
+
+    header, *rows = trace_file.read_text().splitlines()
+    columns = header.split(",")
+    assert len(columns) == len(set(columns))
+    assert columns[:2] == ["tick", "total"]
+    assert [row.split(",")[0] for row in rows] == ["0", "1", "2"]
+    assert all(len(row.split(",")) == len(columns) for row in rows)
+    assert 'cms_phase_seconds_count{phase="total"} 3' in exposition({"": metrics.totals()})
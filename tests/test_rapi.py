@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+
+import pytest
+from serial import Serial
+
+import rapi
+from charger_pool import ChargerPool
+
+pty = pytest.importorskip("pty")
+tty = pytest.importorskip("tty")
+
+class ChargerStandIn:
+    """Scripted OpenEVSE on a pseudo-terminal.
+
+    Commands are checked for a valid checksum and answered by replies[name](args), which
+    returns the reply lines without checksum ("$OK 1 2"), or a ready framed line as bytes
+    (e.g. with a wrong checksum). A sequence id sent with the command is echoed. Commands
+    without an entry are not answered.
+    """
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.bad_commands = 0
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def port(self):
+        return Serial(os.ttyname(self.slave), 115200)
+
+    def run(self):
+        buffer = b""
+        while True:
+            try:
+                buffer += os.read(self.master, 256)
+            except OSError:
+                return
+            while b"\r" in buffer:
+                line, buffer = buffer.split(b"\r", 1)
+                self.answer(line.decode())
+
+    def answer(self, line):
+        body, received = line.split("^")
+        if rapi.checksum(body) != received:
+            self.bad_commands += 1
+            return
+        tokens = body[1:].split(" ")
+        sequence = ""
+        if tokens[-1].startswith(":"):
+            sequence = " " + tokens.pop()
+        reply = self.replies.get(tokens[0])
+        if reply is None:
+            return
+        for line in reply(tokens[1:]):
+            if isinstance(line, str):
+                line = rapi.frame(line[1:] + sequence)
+            os.write(self.master, line)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+REPLIES = {"GG": lambda args: ["$OK 16000 208000"],
+           "SV": lambda args: ["$NK"],
+           # echoes its argument, so each reply can be matched to its command
+           "EC": lambda args: ["$OK " + args[0]],
+           "GS": lambda args: ["$ST 03", "$OK 03 0"],
+           "SL": lambda args: [time.sleep(0.3) or "$OK late"],
+           "BC": lambda args: [b"$OK 1^00\r"]}
+
+@pytest.fixture
+def charger():
+    stand_in = ChargerStandIn(REPLIES)
+    yield stand_in
+    stand_in.close()
+
+def test_ok_and_nk(charger):
+    notes = []
+    client = rapi.RapiClient(charger.port(), on_notify=lambda kind, tokens: notes.append((kind, tokens)))
+    try:
+        assert client.request("GG") == ["16000", "208000"]
+        with pytest.raises(rapi.RapiError):
+            client.request("SV 208000")
+        assert client.request("GS") == ["03", "0"]
+        assert notes == [("ST", ["03"])]
+        assert charger.bad_commands == 0
+    finally:
+        client.close()
+
+def test_bad_checksum_is_rejected(charger):
+    client = rapi.RapiClient(charger.port(), timeout=0.2)
+    try:
+        with pytest.raises(TimeoutError):
+            client.request("BC")
+        assert client.bad_lines == 1
+        assert client.request("GG") == ["16000", "208000"]
+    finally:
+        client.close()
+
+def test_pipelined_replies_in_order(charger):
+    client = rapi.RapiClient(charger.port(), max_in_flight=4)
+    try:
+        futures = [client.send("EC " + str(n)) for n in range(40)]
+        assert [future.result(5) for future in futures] == [[str(n)] for n in range(40)]
+    finally:
+        client.close()
+
+def test_timeout(charger):
+    client = rapi.RapiClient(charger.port(), timeout=0.1)
+    try:
+        start = time.time()
+        with pytest.raises(TimeoutError):
+            client.request("ZZ")
+        assert time.time() - start < 0.5
+        assert client.request("GG") == ["16000", "208000"]
+    finally:
+        client.close()
+
+def test_late_reply_dropped_with_sequence_ids(charger):
+    client = rapi.RapiClient(charger.port(), timeout=0.1, sequence_ids=True)
+    try:
+        with pytest.raises(TimeoutError):
+            client.request("SL")
+        time.sleep(0.4)
+        # the late $OK of SL does not answer the next command
+        assert client.request("GG", timeout=1) == ["16000", "208000"]
+    finally:
+        client.close()
+
+def test_close_fails_waiting_commands(charger):
+    client = rapi.RapiClient(charger.port(), timeout=5)
+    future = client.send("ZZ")
+    client.close()
+    with pytest.raises(rapi.RapiError):
+        future.result(1)
+
+def test_pool_leaves_out_late_chargers(charger):
+    silent = ChargerStandIn({})
+    pool = ChargerPool({0: rapi.RapiClient(charger.port()), 3: rapi.RapiClient(silent.port(), timeout=0.5)}, deadline=0.2)
+    try:
+        assert pool.read_currents([0, 3]) == {0: 16.0}
+        assert pool.latency[3][3] == 1
+    finally:
+        pool.close()
+        silent.close()
+
+class StuckPort:
+    """Port whose reads block until released, as if the reader thread hung."""
+
+    def __init__(self):
+        self.timeout = None
+        self.in_waiting = 0
+        self.released = threading.Event()
+
+    def write(self, data):
+        pass
+
+    def read(self, size):
+        self.released.wait()
+        return b""
+
+    def close(self):
+        pass
+
+class BrokenPort(StuckPort):
+    """Port whose reads fail once released, as if it went away."""
+
+    def read(self, size):
+        if self.released.wait(0.01):
+            raise OSError("port went away")
+        return b""
+
+def test_reader_error_fails_pending_commands(capsys):
+    port = BrokenPort()
+    client = rapi.RapiClient(port, timeout=5)
+    try:
+        futures = [client.send("ZZ"), client.send("ZZ")]
+        port.released.set()
+        for future in futures:
+            with pytest.raises(OSError, match="port went away"):
+                future.result(2)
+        start = time.time()
+        with pytest.raises(OSError, match="port went away"):
+            client.request("GG")
+        assert time.time() - start < 0.5
+        assert "Warn: RAPI reader stopped: port went away" in capsys.readouterr().out
+    finally:
+        client.close()
+
+def test_request_times_out_if_the_reader_hangs():
+    port = StuckPort()
+    client = rapi.RapiClient(port, timeout=0.1)
+    try:
+        start = time.time()
+        with pytest.raises(TimeoutError):
+            client.request("GG")
+        assert time.time() - start < 1.5
+    finally:
+        port.released.set()
+        client.close()
@@ -0,0 +1,61 @@
+import io
+import os
+import contextlib
+
+import pytest
+
+import cms
+from binlog import BinaryLogWriter, seconds
+from log_writer import LogWriter
+from log_segments import SegmentedLogWriter
+from vector_engine import VectorEngine
+
+def open_writer(sim, directory, kind):
+    if kind == "binary":
+        return BinaryLogWriter(directory, seconds(sim.start), cms.READ_DELAY)
+    if kind == "segmented":
+        return SegmentedLogWriter(directory, seconds(sim.start), cms.READ_DELAY, 100)
+    return LogWriter(directory, lambda tick: sim.int_to_str(tick * cms.READ_DELAY))
+
+def run(datasets, directory, kind, engine="loop", resume=False):
+    # fast sim logged to directory with a snapshot every 70 ticks, continued from the last
+    # snapshot there with resume
+    sim = cms.Simulation()
+    sim.load_building(datasets[0])
+    sim.load_cars(datasets[1])
+    if engine == "numpy":
+        sim.engine = VectorEngine(sim.voltage, sim.efficiency, cms.READ_DELAY, sim.battery_capacity, sim.battery_charging_current)
+    sim.log_writer = open_writer(sim, directory, kind)
+    sim.snapshot_path = os.path.join(directory, "snapshot.pickle")
+    sim.snapshot_interval = 70
+    with contextlib.redirect_stdout(io.StringIO()):
+        if resume:
+            sim.load_snapshot(sim.snapshot_path)
+        sim.run_ticks(True)
+    sim.log_writer.close()
+    return sim
+
+def contents(directory):
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name != "snapshot.pickle":
+                with open(os.path.join(root, name), "rb") as f:
+                    files[os.path.relpath(os.path.join(root, name), directory)] = f.read()
+    return files
+
+@pytest.mark.parametrize("engine", ["loop", "numpy"])
+@pytest.mark.parametrize("kind", ["text", "binary", "segmented"])
+def test_continue_does_not_log_ticks_twice(datasets, tmp_path, kind, engine):
+    once = tmp_path / "once"
+    continued = tmp_path / "continued"
+    once.mkdir()
+    continued.mkdir()
+    run(datasets, str(once), kind, engine)
+
+    # the first run logs to the end, past its last snapshot, as if it had crashed after
+    # flushing its logs
+    first = run(datasets, str(continued), kind, engine)
+    assert first.last_snapshot < len(first.building_dataset) - 1
+    run(datasets, str(continued), kind, engine, resume=True)
+    assert contents(str(continued)) == contents(str(once))
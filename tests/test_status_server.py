@@ -0,0 +1,22 @@
+import socket
+
+import pytest
+
+from status_server import StatusServer
+
+def test_port_in_use_raises():
+    server = StatusServer("127.0.0.1", 0)
+    port = server.server.sockets[0].getsockname()[1]
+    try:
+        with pytest.raises(OSError):
+            StatusServer("127.0.0.1", port)
+    finally:
+        server.close()
+
+def test_client_gets_snapshot():
+    server = StatusServer("127.0.0.1", 0)
+    port = server.server.sockets[0].getsockname()[1]
+    server.publish_wait(b"snapshot", b"delta")
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as client:
+        assert client.recv(8) == b"snapshot"
+    server.close()
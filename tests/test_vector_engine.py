@@ -0,0 +1,37 @@
+import io
+import os
+import contextlib
+
+import cms
+from log_writer import LogWriter
+from vector_engine import VectorEngine
+
+def run(datasets, directory, engine):
+    sim = cms.Simulation()
+    sim.load_building(datasets[0])
+    sim.load_cars(datasets[1])
+    if engine:
+        sim.engine = VectorEngine(sim.voltage, sim.efficiency, cms.READ_DELAY, sim.battery_capacity, sim.battery_charging_current)
+    sim.log_writer = LogWriter(directory, lambda tick: sim.int_to_str(tick * cms.READ_DELAY))
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        sim.run_ticks(True)
+    sim.log_writer.close()
+    return sim, out.getvalue()
+
+def rows(directory):
+    # log values as numbers, the engine writes some whole values as floats
+    logs = {}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), "r") as f:
+            logs[name] = [[line.split(",")[0]] + [float(value) for value in line.split(",")[1:]] for line in f]
+    return logs
+
+def test_engine_logs_match_loop(datasets, tmp_path):
+    (tmp_path / "loop").mkdir()
+    (tmp_path / "numpy").mkdir()
+    loop, loop_out = run(datasets, str(tmp_path / "loop"), False)
+    vector, vector_out = run(datasets, str(tmp_path / "numpy"), True)
+    assert rows(str(tmp_path / "numpy")) == rows(str(tmp_path / "loop"))
+    assert vector_out == loop_out
+    # the cars left are stored back from the engine's arrays at the end of the run
+    assert [(car.name, car.delta_kWh, car.battery_on) for car in vector.cars] == [(car.name, car.delta_kWh, car.battery_on) for car in loop.cars]
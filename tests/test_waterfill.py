@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+from waterfill import WaterFill
+
+def fill_total(fill, available):
+    level = fill.level(available)
+    return sum(fill.current(key, level) for key in fill)
+
+def test_max_current_below_min_current():
+    fill = WaterFill()
+    fill.update("a", 1.0, 6, 16)
+    # the car's max current is below its min current, it stays at its min
+    fill.update("b", 1.0, 6, 4)
+    fill.update("c", 2.0, 6, 32)
+    for available in [18, 20, 30, 40, 54, 100]:
+        level = fill.level(available)
+        assert fill.current("b", level) == 6
+        assert fill_total(fill, available) == pytest.approx(min(max(available, 18), 54))
+    fill.remove("b")
+    assert fill.breakpoints == sorted(fill.breakpoints) and len(fill.breakpoints) == 4
+
+def test_matches_every_car_clamped():
+    rng = random.Random(2)
+    fill = WaterFill()
+    cars = {}
+    for step in range(2000):
+        key = rng.randrange(40)
+        if key in cars and rng.random() < 0.2:
+            fill.remove(key)
+            del cars[key]
+        else:
+            weight, low, high = rng.choice([0, rng.random()]), rng.choice([0, 6]), rng.choice([4, 16, 32])
+            fill.update(key, weight, low, high)
+            cars[key] = (weight, low, max(high, low))
+        available = rng.uniform(0, 800)
+        lows = sum(low for weight, low, high in cars.values())
+        highs = sum(high if weight > 0 else low for weight, low, high in cars.values())
+        assert fill_total(fill, available) == pytest.approx(min(max(available, lows), highs))
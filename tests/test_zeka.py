@@ -0,0 +1,106 @@
+import can
+import pytest
+
+import zeka
+
+class ZekaStandIn(can.Listener):
+    """Scripted Zeka on a virtual bus: ACKs control commands, answers status requests.
+
+    Precharge is done from the third main status request on, feedback reports voltage and
+    the last current set. drop is the number of status requests to leave unanswered, nothing
+    is answered while silent.
+    """
+
+    def __init__(self, channel):
+        self.bus = can.Bus(interface="virtual", channel=channel)
+        self.voltage = 480.0
+        self.current = 1.0
+        self.status_requests = 0
+        self.drop = 0
+        self.silent = False
+        self.notifier = can.Notifier(self.bus, [self])
+
+    def reply(self, arbitration_id, data):
+        self.bus.send(can.Message(arbitration_id=arbitration_id, data=data + [0] * (8 - len(data)), is_extended_id=False))
+
+    def on_message_received(self, msg):
+        if self.silent:
+            return
+        if msg.arbitration_id == zeka.CONTROL_SEND:
+            if msg.data[0] == 0x83:
+                self.current = ((msg.data[3] << 8) | msg.data[4]) * 0.1
+            self.reply(zeka.ACK_ID, [msg.data[0]])
+        elif msg.arbitration_id == zeka.STATUS_SEND:
+            self.status_requests += 1
+            if self.drop:
+                self.drop -= 1
+            elif msg.data[0] == zeka.MAIN_STATUS_CMD:
+                self.reply(zeka.STATUS_ID, [msg.data[0], 0, 0 if self.status_requests > 2 else 1])
+            elif msg.data[0] == zeka.FEEDBACK_STATUS_CMD:
+                voltage, current = round(self.voltage * 10), round(self.current * 10)
+                self.reply(zeka.STATUS_ID, [msg.data[0], voltage >> 8, voltage & 0xFF, current >> 8, current & 0xFF])
+
+    def close(self):
+        self.notifier.stop()
+        self.bus.shutdown()
+
+@pytest.fixture
+def buses(request):
+    channel = "zeka-" + request.node.name
+    stand_in = ZekaStandIn(channel)
+    bus = can.Bus(interface="virtual", channel=channel)
+    yield bus, stand_in
+    bus.shutdown()
+    stand_in.close()
+
+def test_replies_update_state(buses, capsys):
+    bus, stand_in = buses
+    device = zeka.Zeka()
+    device.listen(bus)
+    try:
+        assert device.zeka_init(bus).result(1).data[0] == 0x80
+        while not device.zeka_precharge_done:
+            device.zeka_main_status(bus).result(1)
+        assert stand_in.status_requests == 3
+
+        device.zeka_feedback_status(bus).result(1)
+        assert device.zeka_read_voltage == pytest.approx(480.0)
+        assert device.zeka_read_current == pytest.approx(1.0)
+
+        # 480 V is more than 5 V under the set voltage, so the current goes up by 0.2 A
+        device.controller(bus, 500, 3)
+        device.setpoint.result(1)
+        device.zeka_feedback_status(bus).result(1)
+        assert device.zeka_read_current == pytest.approx(3.2)
+        assert device.pending == {}
+    finally:
+        device.stop_listening()
+
+def test_lost_reply_is_dropped(buses, capsys):
+    bus, stand_in = buses
+    device = zeka.Zeka()
+    device.listen(bus)
+    try:
+        stand_in.drop = 1
+        lost = device.zeka_feedback_status(bus)
+        with pytest.raises(TimeoutError):
+            lost.result(0.2)
+        lost.cancel()
+        # given up on, so it no longer waits and the next reply goes to the next request
+        assert device.pending == {}
+        assert device.zeka_feedback_status(bus).result(1).data[0] == zeka.FEEDBACK_STATUS_CMD
+        assert lost.cancelled()
+    finally:
+        device.stop_listening()
+
+def test_controller_without_listener(buses, capsys):
+    bus, stand_in = buses
+    device = zeka.Zeka()
+    device.controller(bus, 500, 3)
+    assert stand_in.current == pytest.approx(3.2)
+    assert device.pending == {}
+
+    # no ACK comes back, the setpoint is given up on after the receive timeout
+    stand_in.silent = True
+    device.controller(bus, 500, 2)
+    assert device.pending == {}
@@ -0,0 +1,305 @@
+import numpy as np
+
+# Car attributes the engine keeps as arrays, with their types
+CAR_FIELDS = [("simulation", bool), ("sleep_mode", bool), ("battery_on", bool), ("priority", float),
+              ("delta_kWh", float), ("min_current", float), ("max_current", float), ("charging_current", float),
+              ("prev_current", float), ("measured_current", float), ("battery_current", float),
+              ("battery_no", int), ("station_no", int), ("departure", int), ("capacity", float)]
+
+class VectorEngine:
+    """Keeps the car and station state of a run as struct-of-arrays and runs its ticks on them.
+
+    Gives the same allocations as the per-car loop in cms.py (measure_cars,
+    discharge_batteries, allocate_current, charge_batteries). Energy accounting,
+    clamping and the running used current are done as array operations. The only
+    sequential parts left are the cars that need a battery and cars that run out of
+    building current, since each of those changes what the next car sees.
+
+    Arrays are indexed like Simulation.cars and Simulation.stations. control() runs the
+    regular control step (battery check, priorities and order) on them as well, so the Car
+    and Station objects are only loaded when they change (stale: a car arrives or leaves,
+    a snapshot is loaded) and written back when something else reads them (dirty, see
+    Simulation.sync_objects()). Hardware cars are also written back every tick, since
+    their chargers are read and set through them.
+    """
+
+    def __init__(self, voltage, efficiency, read_delay, battery_capacity, battery_charging_current):
+        self.voltage = voltage
+        self.efficiency = efficiency
+        self.read_delay = read_delay
+        self.battery_capacity = battery_capacity
+        self.battery_charging_current = battery_charging_current
+
+        # arrays are behind the objects / objects are behind the arrays
+        self.stale = True
+        self.dirty = False
+
+    def load(self, cars, stations):
+        n = len(cars)
+        for name, kind in CAR_FIELDS:
+            setattr(self, name, np.fromiter((getattr(car, name) for car in cars), kind, n))
+        self.hardware = np.flatnonzero(~self.simulation).tolist()
+
+        s = len(stations)
+        self.station_capacity = np.fromiter((station.battery_capacity for station in stations), float, s)
+        self.station_battery_current = np.fromiter((station.battery_current for station in stations), float, s)
+        self.station_charging_current = np.fromiter((station.charging_current for station in stations), float, s)
+        self.stale = False
+        self.dirty = False
+
+    def store_car(self, car, k, at_max):
+        car.prev_current = _number(self.prev_current[k])
+        car.measured_current = float(self.measured_current[k])
+        car.delta_kWh = float(self.delta_kWh[k])
+        car.charging_current = car.max_current if at_max else _number(self.charging_current[k])
+        car.battery_current = _number(self.battery_current[k])
+        car.battery_no = int(self.battery_no[k])
+
+    def store(self, cars, stations):
+        at_max = (self.charging_current == self.max_current).tolist()
+        for car, prev, measured, delta, current, battery, battery_no, max_current, priority, battery_on in zip(cars,
+                _numbers(self.prev_current), self.measured_current.tolist(), self.delta_kWh.tolist(), _numbers(self.charging_current),
+                _numbers(self.battery_current), self.battery_no.tolist(), at_max, self.priority.tolist(), self.battery_on.tolist()):
+            car.prev_current = prev
+            car.measured_current = measured
+            car.delta_kWh = delta
+            car.charging_current = car.max_current if max_current else current
+            car.battery_current = battery
+            car.battery_no = battery_no
+            car.priority = priority
+            car.battery_on = battery_on
+
+        for station, capacity, battery, charging in zip(stations, self.station_capacity.tolist(),
+                _numbers(self.station_battery_current), _numbers(self.station_charging_current)):
+            station.battery_capacity = capacity
+            station.battery_current = battery
+            station.charging_current = charging
+        self.dirty = False
+
+    def tick(self, cars, stations, available_current, measure_hardware=None, set_hardware=None):
+        if self.stale:
+            self.load(cars, stations)
+        self.prev_current = self.charging_current
+        self.measure(cars, measure_hardware)
+        self.discharge_batteries()
+        used_current = self.allocate(available_current)
+        self.charge_batteries(available_current, used_current)
+        self.dirty = True
+
+        for k in self.hardware:
+            car = cars[k]
+            self.store_car(car, k, self.charging_current[k] == self.max_current[k])
+            if set_hardware and car.charging_current != car.prev_current:
+                set_hardware(car)
+
+        return used_current
+
+    def control(self, cars, stations, current_time):
+        # Simulation.control_step() for a step where no car arrives or leaves: turns batteries
+        # on, assigns priorities and returns cars in the new charging order
+        if self.stale:
+            self.load(cars, stations)
+        remaining = self.departure - current_time
+        turn_on = ~self.battery_on & (self.delta_kWh >= self.efficiency * self.max_current * self.voltage * 0.001 * remaining / 3600)
+        for k in np.flatnonzero(turn_on).tolist():
+            print("Log: Turning on battery for " + cars[k].name)
+        self.battery_on = self.battery_on | turn_on
+
+        self.priority = self.delta_kWh / remaining
+        # summed in car order, as the loop does
+        normalize = 0
+        for priority in self.priority.tolist():
+            normalize += priority
+        if normalize > 0:
+            self.priority = self.priority / normalize
+
+        sleep_mode = self.sleep_mode.tolist()
+        priority = self.priority.tolist()
+        order = sorted(range(len(cars)), key=lambda k: (sleep_mode[k], priority[k]), reverse=True)
+        for name, _ in CAR_FIELDS:
+            setattr(self, name, getattr(self, name)[order])
+        self.hardware = np.flatnonzero(~self.simulation).tolist()
+        self.dirty = True
+        return [cars[k] for k in order]
+
+    def columns(self):
+        # measured, charging and battery current, delta_kWh, battery number and priority of
+        # every car, then battery current, charging current and capacity of every station,
+        # as lists of the values the loop would hold
+        return (self.measured_current.tolist(), _numbers(self.charging_current), _numbers(self.battery_current),
+                self.delta_kWh.tolist(), self.battery_no.tolist(), self.priority.tolist(),
+                _numbers(self.station_battery_current), _numbers(self.station_charging_current), self.station_capacity.tolist())
+
+    def draw(self, draw):
+        # draw (W) plus what the cars and station batteries take from the building, added up
+        # one by one in the loop's order (cumsum adds sequentially)
+        values = np.concatenate(([draw], (self.charging_current - self.battery_current) * self.voltage, self.station_charging_current * self.voltage))
+        return float(np.cumsum(values)[-1])
+
+    def energy(self, current):
+        # kWh drawn by a current over one tick, in the same operation order as the loop
+        return current * self.voltage * (self.read_delay / 3600) * 0.001
+
+    def measure(self, cars, measure_hardware):
+        self.measured_current = self.charging_current * self.efficiency
+
+        for k in self.hardware:
+            self.measured_current[k] = measure_hardware(cars[k])
+            # saturation detection can lower max current
+            self.max_current[k] = cars[k].max_current
+
+        self.delta_kWh = self.delta_kWh - self.energy(self.measured_current)
+        self.delta_kWh[self.delta_kWh < 0] = 0
+
+    def discharge_batteries(self):
+        self.station_capacity = self.station_capacity - self.energy(self.station_battery_current) * (1.0/self.efficiency)
+        self.station_capacity = self.station_capacity + self.energy(self.station_charging_current) * self.efficiency
+        self.station_battery_current = np.zeros(len(self.station_capacity))
+
+    def pick_battery(self, k, threshold):
+        # Returns the station whose battery should support car k, or -1
+        if not self.simulation[k]:
+            return 0 if self.station_capacity[0] > threshold else -1
+
+        own = self.station_no[k]
+        if own not in self.busy and self.station_battery_current[own] == 0 and self.station_capacity[own] > threshold:
+            return own
+
+        # batteries only get busier during a tick, so one walk down the capacity order
+        # gives the same picks as sorting the idle stations for every car
+        if self.by_capacity is None:
+            idle = np.flatnonzero(self.station_battery_current == 0)
+            idle = idle[idle != 0]
+            self.by_capacity = idle[np.argsort(-self.station_capacity[idle], kind="stable")].tolist()
+            self.next_battery = 0
+        while self.next_battery < len(self.by_capacity) and self.by_capacity[self.next_battery] in self.busy:
+            self.next_battery += 1
+        if self.next_battery == len(self.by_capacity):
+            return -1
+
+        best = self.by_capacity[self.next_battery]
+        if self.station_capacity[best] > threshold:
+            return best
+        return -1
+
+    def boost(self, k):
+        # battery_on car that cannot reach max current from the building alone
+        battery_no = self.pick_battery(k, self.energy(self.max_current[k]))
+        if battery_no == -1:
+            if self.simulation[k]:
+                print("Warn: no batteries available")
+            return
+
+        self.busy.add(battery_no)
+        self.assign_batteries(k, battery_no)
+
+    def boost_many(self, ks):
+        # Cars that can run on their own station's battery are assigned together at the end.
+        # Cars that have to borrow a battery are picked one at a time in priority order.
+        own = self.station_no[ks]
+        own_ok = (self.simulation[ks] & (own != 0) & (self.station_battery_current[own] == 0)
+                  & (self.station_capacity[own] > self.energy(self.max_current[ks])))
+        own_cars = []
+        for k, station_no, ok in zip(ks.tolist(), own.tolist(), own_ok.tolist()):
+            if ok and station_no not in self.busy:
+                self.busy.add(station_no)
+                own_cars.append(k)
+            else:
+                self.boost(k)
+
+        if own_cars:
+            self.assign_batteries(own_cars, self.station_no[own_cars])
+
+    def assign_batteries(self, ks, battery_no):
+        battery_current = self.max_current[ks] - self.charging_current[ks]
+        self.station_battery_current[battery_no] = battery_current
+        self.battery_current[ks] = battery_current
+        self.battery_no[ks] = battery_no
+        self.charging_current[ks] = self.max_current[ks]
+
+    def starve(self, k, available_current, used_current):
+        # car k does not fit in the remaining building current, returns the new used current
+        self.charging_current[k] = 0
+        if not self.sleep_mode[k]:
+            return used_current
+
+        battery_no = self.pick_battery(k, self.energy(self.min_current[k]))
+        if battery_no == -1:
+            if self.simulation[k]:
+                print("Warn: no batteries available")
+            return used_current
+
+        min_current = float(self.min_current[k])
+        battery_current = min_current - (available_current - used_current)
+        self.busy.add(battery_no)
+        self.station_battery_current[battery_no] = battery_current
+        self.battery_current[k] = battery_current
+        self.battery_no[k] = battery_no
+        self.charging_current[k] = min_current
+        return used_current + (min_current - battery_current)
+
+    def allocate(self, available_current):
+        # cars are already sorted from highest priority to lowest priority
+        n = len(self.priority)
+        self.battery_current = np.zeros(n)
+        self.battery_no = np.full(n, -1)
+        requested = np.trunc(available_current * self.priority)
+        active = self.priority != 0
+        boosted = active & self.battery_on
+        free = active & ~self.battery_on
+
+        # current each car takes from the building if it is not starved
+        clamped = np.where(requested > self.max_current, self.max_current,
+                           np.where(requested < self.min_current, self.min_current, requested))
+        used = np.where(boosted, np.minimum(requested, self.max_current), 0)
+        used = np.where(free, clamped, used)
+
+        self.charging_current = np.where(free, clamped, requested)
+        at_max = boosted & (requested >= self.max_current)
+        self.charging_current[at_max] = self.max_current[at_max]
+        needs_battery = boosted & (requested < self.max_current)
+
+        self.by_capacity = None
+        self.busy = set(np.flatnonzero(self.station_battery_current != 0).tolist())
+
+        # used current before each car, summed in car order, up to the first car that does not fit
+        before = np.cumsum(np.concatenate(([0], used)))
+        starved = free & (available_current - before[:-1] < self.min_current)
+        first = int(np.argmax(starved)) if starved.any() else n
+        self.boost_many(np.flatnonzero(needs_battery[:first]))
+        if first == n:
+            return float(before[-1])
+
+        # from there each car changes what the next one sees, so go one car at a time
+        used_current = float(before[first])
+        for k, car_free, car_boost, min_current, car_used in zip(range(first, n), free[first:].tolist(), needs_battery[first:].tolist(),
+                                                                 self.min_current[first:].tolist(), used[first:].tolist()):
+            if car_free and available_current - used_current < min_current:
+                used_current = self.starve(k, available_current, used_current)
+                continue
+            if car_boost:
+                self.boost(k)
+            used_current += car_used
+
+        return used_current
+
+    def charge_batteries(self, available_current, used_current):
+        candidates = np.flatnonzero((self.station_battery_current == 0) & (self.station_capacity < (self.battery_capacity * 0.9)))
+        candidates = candidates[np.argsort(self.station_capacity[candidates], kind="stable")]
+
+        self.station_charging_current = np.zeros(len(self.station_capacity))
+
+        count = 0
+        while available_current - used_current >= self.battery_charging_current and count < len(candidates):
+            available_current -= self.battery_charging_current
+            count += 1
+        self.station_charging_current[candidates[:count]] = self.battery_charging_current
+
+def _number(value):
+    # the loop keeps whole currents as ints, keep the logs identical
+    value = float(value)
+    return int(value) if value == int(value) else value
+
+def _numbers(values):
+    whole = (values == np.trunc(values)).tolist()
+    return [int(value) if is_whole else value for value, is_whole in zip(values.tolist(), whole)]
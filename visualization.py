@@ -2,10 +2,11 @@
 
 import sys
 import socket
-import pickle
 import curses
 import signal
 
+from status_protocol import StatusDecoder
+
 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
 def signal_handler(sig, frame):
@@ -18,11 +19,11 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
     stdscr = curses.initscr()
 
+    decoder = StatusDecoder()
     while True:
-        data = s.recv(4096)
-        if len(data) == 0:
-            continue
-        visualization_info = pickle.loads(data)
+        visualization_info = decoder.read(s)
+        if visualization_info is None:
+            break
 
         stdscr.clear()
         stdscr.addstr(0, 0, "Current time: " + visualization_info["current_time"])
@@ -35,3 +36,5 @@ if __name__ == "__main__":
                 stdscr.addstr(i, 0, "Station: " + str(station_num) + " Name: " + str(car["name"]) + " SoC remaining(%): " + str(car["delta_soc"]) + " Current(A): " + str(car["current"]) + " Battery: " + str(car["battery"]) + " Remaining time: " + str(car["remaining_time"]))
             i += 1
         stdscr.refresh()
+
+    curses.endwin()
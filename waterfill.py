@@ -0,0 +1,82 @@
+from bisect import insort, bisect_left
+
+# breakpoint kinds, a car leaves its low bound before another one at the same level reaches its high
+LEAVES_LOW = 0
+REACHES_HIGH = 1
+
+class WaterFill:
+    """Splits a current between cars in proportion to their weights, within each car's bounds.
+
+    Solves for the level L where the sum of clamp(L * weight, low, high) over all cars equals
+    the available current. A car is at its low bound up to L = low / weight and at its high
+    bound from L = high / weight, so the sum is linear between these breakpoints. They are
+    kept in one sorted list: solve() is a single sweep over them, and update() for a car whose
+    weight or bounds changed moves its two breakpoints instead of sorting everything again.
+    Cars with no weight stay at their low bound.
+    """
+
+    def __init__(self):
+        # key: (weight, low, high, serial)
+        self.cars = {}
+        self.keys = {}
+        # (level, kind, serial) of every car with a weight
+        self.breakpoints = []
+        self.low_total = 0.0
+        self.next_serial = 0
+
+    def entries(self, weight, low, high, serial):
+        if weight <= 0:
+            return []
+        return [(low / weight, LEAVES_LOW, serial), (high / weight, REACHES_HIGH, serial)]
+
+    def update(self, key, weight, low, high):
+        # a car that cannot draw its min current (max current below it) is held at its min,
+        # its high breakpoint before its low one would make level() count it twice
+        high = max(high, low)
+        old = self.cars.get(key)
+        if old is not None:
+            if old[:3] == (weight, low, high):
+                return
+            self.remove(key)
+        serial = self.next_serial
+        self.next_serial += 1
+        self.cars[key] = (weight, low, high, serial)
+        self.keys[serial] = key
+        self.low_total += low
+        for entry in self.entries(weight, low, high, serial):
+            insort(self.breakpoints, entry)
+
+    def remove(self, key):
+        weight, low, high, serial = self.cars.pop(key)
+        del self.keys[serial]
+        self.low_total -= low
+        for entry in self.entries(weight, low, high, serial):
+            del self.breakpoints[bisect_left(self.breakpoints, entry)]
+
+    def __iter__(self):
+        return iter(self.cars)
+
+    def level(self, available):
+        # L for available current, 0 if it does not cover the low bounds and inf if it covers
+        # every high bound
+        if available <= self.low_total:
+            return 0.0
+        fixed = self.low_total
+        free_weight = 0.0
+        for level, kind, serial in self.breakpoints:
+            if free_weight > 0 and fixed + level * free_weight >= available:
+                return (available - fixed) / free_weight
+            weight, low, high, _ = self.cars[self.keys[serial]]
+            if kind == LEAVES_LOW:
+                fixed -= low
+                free_weight += weight
+            else:
+                fixed += high
+                free_weight -= weight
+        return float("inf")
+
+    def current(self, key, level):
+        weight, low, high, _ = self.cars[key]
+        if weight <= 0:
+            return low
+        return min(max(level * weight, low), high)
@@ -2,45 +2,91 @@ import can
 import time
 import select
 import sys
+from threading import Lock
+from concurrent.futures import Future
 
 CONTROL_SEND = 0x159
 STATUS_SEND = 0X15C
 ACK_ID = 0x459
 STATUS_ID = 0x45C
 
-class Zeka:
+# first data byte of a status request, echoed by its reply
+MAIN_STATUS_CMD = 0xA0
+FEEDBACK_STATUS_CMD = 0xA2
+
+class Zeka(can.Listener):
+    """Zeka battery converter on a CAN bus.
+
+    Every command returns a Future for its reply: the ACK (0x459) for control commands, the
+    status frame (0x45C) for status requests. Cancel a future that is given up on: it is
+    dropped from pending, so a late reply is not taken for it. Replies update the cached
+    state below.
+    listen() starts a notifier thread that handles frames as they arrive, so commands can
+    be sent without waiting; without it zeka_receive() handles one frame at a time.
+    """
+
     zeka_precharge_done = False
     zeka_fullstop_and_device_not_running = True
     zeka_read_voltage = 0
     zeka_read_current = 0
     old_current_set = 0
 
-    def zeka_init(self, bus):
-        print("Init")
-        msg = can.Message(arbitration_id=CONTROL_SEND, data=[0x80, 0x00, 0x04, 0x00, 0x03, 0xFF, 0xFF, 0xFF], is_extended_id=False)
-
+    def __init__(self):
+        self.notifier = None
+        self.pending_mutex = Lock()
+        # (arbitration id, command byte): futures waiting for that reply, oldest first
+        self.pending = {}
+        self.last_status = 0
+        # ACK future of the last setpoint controller() sent with a listener
+        self.setpoint = None
+
+    def listen(self, bus):
+        self.notifier = can.Notifier(bus, [self])
+
+    def stop_listening(self):
+        if self.notifier:
+            self.notifier.stop()
+            self.notifier = None
+
+    def expect(self, arbitration_id, command):
+        future = Future()
+        with self.pending_mutex:
+            self.pending.setdefault((arbitration_id, command), []).append(future)
+        future.add_done_callback(lambda future: self.discard((arbitration_id, command), future))
+        return future
+
+    def discard(self, key, future):
+        # called once a future is done, cancelled futures are still pending until then
+        with self.pending_mutex:
+            waiting = self.pending.get(key)
+            if waiting and future in waiting:
+                waiting.remove(future)
+            if not waiting:
+                self.pending.pop(key, None)
+
+    def send(self, bus, msg, reply_id):
+        future = self.expect(reply_id, msg.data[0])
         try:
             bus.send(msg)
-        except can.CanError:
+        except can.CanError as ex:
             print("Message not sent")
+            future.set_exception(ex)
+        return future
+
+    def zeka_init(self, bus):
+        print("Init")
+        msg = can.Message(arbitration_id=CONTROL_SEND, data=[0x80, 0x00, 0x04, 0x00, 0x03, 0xFF, 0xFF, 0xFF], is_extended_id=False)
+        return self.send(bus, msg, ACK_ID)
 
     def zeka_start(self, bus):
         print("Start")
         msg = can.Message(arbitration_id=CONTROL_SEND, data=[0x80, 0x01, 0x01, 0x00, 0x03, 0xFF, 0xFF, 0xFF], is_extended_id=False)
-
-        try: 
-            bus.send(msg)
-        except can.CanError:
-            print("Message not sent")
+        return self.send(bus, msg, ACK_ID)
 
     def zeka_stop(self, bus):
         print("Stop")
         msg = can.Message(arbitration_id=CONTROL_SEND, data=[0x80, 0x01, 0x04, 0x00, 0x03, 0xFF, 0xFF, 0xFF], is_extended_id=False)
-
-        try:
-            bus.send(msg)
-        except can.CanError:
-            print("Message not sent")
+        return self.send(bus, msg, ACK_ID)
 
     def zeka_set_voltage_current(self, bus, voltage, current):
         print("Set voltage and current")
@@ -48,42 +94,33 @@ class Zeka:
         current = int(current * 10)
         a_to_b_ctrl = [0x83, voltage>>8, voltage & 0x00FF, current>>8, current & 0x00FF, 0xFF, 0xFF, 0xFF]
         msg = can.Message(arbitration_id=CONTROL_SEND, data=a_to_b_ctrl, is_extended_id=False)
-
-        try:
-            bus.send(msg)
-        except can.CanError:
-            print("Message not sent")
+        return self.send(bus, msg, ACK_ID)
 
     def zeka_main_status(self, bus):
         print("Main status")
         msg = can.Message(arbitration_id=STATUS_SEND, data=[0xA0, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF], is_extended_id=False)
-
-        try:
-            bus.send(msg)
-            print(f"Message sent on {bus.channel_info}")
-        except can.CanError:
-            print("Message not sent")
+        return self.send(bus, msg, STATUS_ID)
 
     def zeka_feedback_status(self, bus):
 #        print("Feedback status for side B")
         msg = can.Message(arbitration_id=STATUS_SEND, data=[0xA2, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF], is_extended_id=False)
-
-        try:
-            bus.send(msg)
-        except can.CanError:
-            print("Message not sent")
-
-    def zeka_receive(self, bus):
-        msg = bus.recv()
-
-        if msg.arbitration_id == ACK_ID:
-            if msg.data[0] == 0x80:
-                zeka_prev_msg = 0x80
-            elif msg.data[0] == 0x83:
-                zeka_prev_msg = 0x83
-
-        elif msg.arbitration_id == STATUS_ID:
-            if msg.data[0] == 0xA0:
+        return self.send(bus, msg, STATUS_ID)
+
+    def zeka_receive(self, bus, timeout=1.0):
+        # handles the next frame, returns False if none came within timeout
+        msg = bus.recv(timeout)
+        if msg is None:
+            return False
+        self.handle(msg)
+        return True
+
+    def on_message_received(self, msg):
+        # called by the notifier thread
+        self.handle(msg)
+
+    def handle(self, msg):
+        if msg.arbitration_id == STATUS_ID:
+            if msg.data[0] == MAIN_STATUS_CMD:
                 if (msg.data[2] & 0b00000011) == 0b000:
                     self.zeka_precharge_done = True
                 else:
@@ -94,13 +131,22 @@ class Zeka:
                 else:
                     self.zeka_fullstop_and_device_not_running = False
 
-                zeka_prev_msg = 0xA0
-
-            if msg.data[0] == 0xA2:
+            if msg.data[0] == FEEDBACK_STATUS_CMD:
                 self.zeka_read_voltage = ((msg.data[1]<<8) | msg.data[2]) * 0.1 # 0.1V
                 self.zeka_read_current = ((msg.data[3]<<8) | msg.data[4]) * 0.1 # 0.1A
+                self.last_status = time.time()
+
+        elif msg.arbitration_id != ACK_ID:
+            return
 
-                zeka_prev_msg = 0xA2
+        with self.pending_mutex:
+            waiting = self.pending.get((msg.arbitration_id, msg.data[0]))
+            # futures cancelled after a timeout do not take the reply
+            while waiting and not waiting[0].set_running_or_notify_cancel():
+                waiting.pop(0)
+            future = waiting.pop(0) if waiting else None
+        if future:
+            future.set_result(msg)
 
     def controller(self, bus, v_set, c_set):
        current_set = 0
@@ -114,8 +160,17 @@ class Zeka:
            current_set = c_set + 0.2
 
        if current_set != self.old_current_set:
-           self.zeka_set_voltage_current(bus, v_set + 50, current_set)
-           self.zeka_receive(bus)
+           future = self.zeka_set_voltage_current(bus, v_set + 50, current_set)
+           if self.notifier:
+               # the ACK is handled when it arrives, or given up on at the next setpoint
+               if self.setpoint:
+                   self.setpoint.cancel()
+               self.setpoint = future
+           else:
+               try:
+                   self.zeka_receive(bus)
+               finally:
+                   future.cancel()
 
        self.old_current_set = current_set
 